@@ -15,6 +15,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import sys
 from dataclasses import dataclass
 from typing import TYPE_CHECKING, Any, Literal, Optional
 
@@ -24,8 +25,9 @@ import torch.nn.functional as F
 from peft import PeftModel
 from transformers import DataCollatorForSeq2Seq
 
+from ..extras import logging
 from ..extras.constants import AUDIO_PLACEHOLDER, IGNORE_INDEX, IMAGE_PLACEHOLDER
-from ..extras.packages import is_pillow_available
+from ..extras.packages import is_pillow_available, is_transformers_version_greater_than
 
 
 if is_pillow_available():
@@ -38,12 +40,20 @@ if TYPE_CHECKING:
     from .template import Template
 
 
-def prepare_4d_attention_mask(attention_mask_with_indices: "torch.Tensor", dtype: "torch.dtype") -> "torch.Tensor":
+logger = logging.get_logger(__name__)
+
+
+def prepare_4d_attention_mask(
+    attention_mask_with_indices: "torch.Tensor", dtype: "torch.dtype", chunk_size: int = 1024
+) -> "torch.Tensor":
     r"""Expand 2d attention mask to 4d attention mask.
 
     Expand the attention mask with indices from (batch_size, seq_len) to (batch_size, 1, seq_len, seq_len),
     handle packed sequences and transforms the mask to lower triangular form to prevent future peeking.
 
+    The mask is built on the device of the input, `chunk_size` query rows at a time, so the peak memory besides the
+    output is (batch_size, chunk_size, seq_len) booleans.
+
     e.g.
     ```python
     # input
@@ -64,20 +74,18 @@ def prepare_4d_attention_mask(attention_mask_with_indices: "torch.Tensor", dtype
     ```
     where `o` equals to `0.0`, `x` equals to `min_dtype`.
     """
-    _, seq_len = attention_mask_with_indices.size()
-    min_dtype = torch.finfo(dtype).min
-    zero_tensor = torch.tensor(0, dtype=dtype)
-
-    # Create a non-padding mask.
-    non_padding_mask = (attention_mask_with_indices != 0).unsqueeze(1).unsqueeze(2)
-    # Create indices for comparison.
-    indices = attention_mask_with_indices.unsqueeze(1).unsqueeze(2)  # [bsz, 1, 1, seq_len]
-    indices_t = attention_mask_with_indices.unsqueeze(1).unsqueeze(3)  # [bsz, 1, seq_len, 1]
-    # Create a lower triangular mask.
-    tril_mask = torch.tril(torch.ones((seq_len, seq_len), dtype=torch.bool))
-    attention_mask_4d = (indices == indices_t) & non_padding_mask & tril_mask
-    # Invert the attention mask.
-    attention_mask_4d = torch.where(attention_mask_4d, zero_tensor, min_dtype)
+    bsz, seq_len = attention_mask_with_indices.size()
+    device = attention_mask_with_indices.device
+    attention_mask_4d = torch.full((bsz, 1, seq_len, seq_len), torch.finfo(dtype).min, dtype=dtype, device=device)
+    positions = torch.arange(seq_len, device=device)
+    for start in range(0, seq_len, chunk_size):
+        end = min(start + chunk_size, seq_len)  # the queries in [start, end) only attend to the keys in [0, end)
+        key_indices = attention_mask_with_indices[:, None, :end]  # [bsz, 1, end]
+        query_indices = attention_mask_with_indices[:, start:end, None]  # [bsz, chunk, 1]
+        causal_mask = positions[None, :end] <= positions[start:end, None]  # [chunk, end]
+        visible_mask = (query_indices == key_indices) & (key_indices != 0) & causal_mask
+        attention_mask_4d[:, 0, start:end, :end].masked_fill_(visible_mask, 0)
+
     return attention_mask_4d
 
 
@@ -243,16 +251,121 @@ class MultiModalDataCollatorForSeq2Seq(DataCollatorForSeq2Seq):
 
 @dataclass
 class SFTDataCollatorWith4DAttentionMask(MultiModalDataCollatorForSeq2Seq):
-    r"""Data collator for 4d attention mask."""
+    r"""Data collator for 4d attention mask.
+
+    If `defer_4d_attention_mask` is enabled, the batch keeps the attention mask with indices of shape
+    (batch_size, seq_len) instead of the 4d mask, which is expanded by `expand_attention_mask` on device.
+
+    If `padding_free` is enabled, the packed features are flattened into a single sequence of shape (1, total_len),
+    where the sequences are separated by `position_ids` (and `cu_seq_lens_q/k` for flash attention) without paddings.
+    The eager and sdpa attention additionally get the attention mask with indices, unless the model builds its causal
+    mask with the masking utils of transformers, which infer the packed sequences from `position_ids`.
+    """
 
     block_diag_attn: bool = False
+    defer_4d_attention_mask: bool = False
+    padding_free: bool = False
     attn_implementation: Literal["eager", "sdpa", "flash_attention_2"] = "eager"
     compute_dtype: "torch.dtype" = torch.float32
 
+    def __post_init__(self):
+        super().__post_init__()
+        if self.padding_free and self.get_rope_func is not None:
+            raise ValueError("Padding-free packing is incompatible with mrope models.")
+
+        # remote code and older models do not use the masking utils, they would attend across the packed sequences
+        self.infer_packed_sequences = (
+            self.padding_free
+            and is_transformers_version_greater_than("4.54.0")
+            and self.model is not None
+            and hasattr(sys.modules.get(type(self.model).__module__), "create_causal_mask")
+        )
+        if self.padding_free and self.attn_implementation != "flash_attention_2" and not self.infer_packed_sequences:
+            logger.warning_rank0(
+                "The model may not infer the packed sequences from position ids, "
+                "use the 4d attention mask for padding-free training, consider using flash attention."
+            )
+
+    def _flatten_features(self, features: list[dict[str, Any]]) -> tuple[dict[str, Any], list[int], list[int]]:
+        r"""Concatenate the features into one sequence, return it with its position ids and sequence boundaries."""
+        flat_feature = {"input_ids": [], "attention_mask": [], "labels": [], "images": [], "videos": [], "audios": []}
+        position_ids, cu_seqlens = [], [0]
+        for feature in features:
+            offset, seq_len = cu_seqlens[-1], len(feature["input_ids"])
+            seq_bounds = feature.pop("cu_seqlens", None) or [0, seq_len]
+            labels = list(feature["labels"])
+            for start in seq_bounds[:-1]:  # do not predict the first token of a sequence from the previous one
+                labels[start] = IGNORE_INDEX
+
+            flat_feature["input_ids"] += feature["input_ids"]
+            flat_feature["attention_mask"] += [1] * seq_len
+            flat_feature["labels"] += labels
+            for key in ("images", "videos", "audios"):
+                flat_feature[key] += feature.get(key) or []
+
+            position_ids += feature.pop("position_ids", None) or list(range(seq_len))
+            cu_seqlens += [offset + bound for bound in seq_bounds[1:]]
+
+        return flat_feature, position_ids, cu_seqlens
+
+    def _get_padding_free_inputs(
+        self, features: dict[str, "torch.Tensor"], position_ids: list[int], cu_seqlens: list[int]
+    ) -> dict[str, "torch.Tensor"]:
+        r"""Add the position ids and the varlen attention arguments to the flattened batch."""
+        num_extra_tokens = features["input_ids"].size(1) - cu_seqlens[-1]
+        if num_extra_tokens > 0:  # the paddings and fake multimodal tokens form an extra sequence
+            if self.tokenizer.padding_side == "right":
+                position_ids = position_ids + list(range(num_extra_tokens))
+                cu_seqlens = cu_seqlens + [cu_seqlens[-1] + num_extra_tokens]
+            else:
+                position_ids = list(range(num_extra_tokens)) + position_ids
+                cu_seqlens = [0] + [bound + num_extra_tokens for bound in cu_seqlens]
+
+        features["position_ids"] = torch.tensor([position_ids], dtype=torch.long)
+        attention_mask = features.pop("attention_mask")
+        if self.attn_implementation == "flash_attention_2":
+            features["cu_seq_lens_q"] = features["cu_seq_lens_k"] = torch.tensor(cu_seqlens, dtype=torch.int32)
+            features["max_length_q"] = features["max_length_k"] = max(np.diff(cu_seqlens).tolist())
+        elif self._requires_4d_attention_mask():
+            seq_lens = torch.tensor(np.diff(cu_seqlens))
+            seq_indices = torch.repeat_interleave(torch.arange(1, len(seq_lens) + 1), seq_lens).unsqueeze(0)
+            features["attention_mask"] = seq_indices.to(attention_mask)
+            if not self.defer_4d_attention_mask:
+                features["attention_mask"] = prepare_4d_attention_mask(features["attention_mask"], self.compute_dtype)
+
+        return features
+
+    def _requires_4d_attention_mask(self) -> bool:
+        if self.attn_implementation == "flash_attention_2":  # flash attention uses the indices or `cu_seq_lens`
+            return False
+
+        if self.padding_free:  # packed sequences are inferred from position ids by the masking utils
+            return not self.infer_packed_sequences
+
+        return self.block_diag_attn
+
+    def expand_attention_mask(self, inputs: dict[str, "torch.Tensor"]) -> dict[str, "torch.Tensor"]:
+        r"""Expand the deferred attention mask with indices to the 4d attention mask on the device of the inputs."""
+        attention_mask = inputs.get("attention_mask")
+        if (
+            self.defer_4d_attention_mask
+            and self._requires_4d_attention_mask()
+            and attention_mask is not None
+            and attention_mask.dim() == 2
+        ):
+            inputs["attention_mask"] = prepare_4d_attention_mask(attention_mask, self.compute_dtype)
+
+        return inputs
+
     def __call__(self, features: list[dict[str, Any]]) -> dict[str, "torch.Tensor"]:
-        features = super().__call__(features)
-        if self.block_diag_attn and self.attn_implementation != "flash_attention_2":
-            features["attention_mask"] = prepare_4d_attention_mask(features["attention_mask"], self.compute_dtype)
+        if self.padding_free:
+            flat_feature, position_ids, cu_seqlens = self._flatten_features(features)
+            features = super().__call__([flat_feature])
+            features = self._get_padding_free_inputs(features, position_ids, cu_seqlens)
+        else:
+            features = super().__call__(features)
+            if self._requires_4d_attention_mask() and not self.defer_4d_attention_mask:
+                features["attention_mask"] = prepare_4d_attention_mask(features["attention_mask"], self.compute_dtype)
 
         for key, value in features.items():  # cast data dtype for paligemma
             if torch.is_tensor(value) and torch.is_floating_point(value):
@@ -13,6 +13,9 @@
 # limitations under the License.
 
 import json
+import threading
+from collections import OrderedDict
+from collections.abc import Hashable, Iterable
 from enum import Enum, unique
 from typing import TYPE_CHECKING, Any, Optional, TypedDict, Union
 
@@ -43,6 +46,49 @@ class Role(str, Enum):
     OBSERVATION = "observation"
 
 
+class LRUCache:
+    r"""A thread-safe least-recently-used cache.
+
+    The cache is pickled empty, so that each `datasets.map` worker builds its own copy and the dataset fingerprints
+    do not depend on the cached content.
+    """
+
+    def __init__(self, maxsize: int) -> None:
+        self.maxsize = maxsize
+        self._data: OrderedDict[Hashable, Any] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __reduce__(self):
+        return (self.__class__, (self.maxsize,))
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get_many(self, keys: Iterable[Hashable]) -> dict[Hashable, Any]:
+        r"""Return the cached values of the given keys, missing keys are omitted."""
+        values = {}
+        with self._lock:
+            for key in keys:
+                if key in self._data:
+                    self._data.move_to_end(key)
+                    values[key] = self._data[key]
+
+        return values
+
+    def put_many(self, items: dict[Hashable, Any]) -> None:
+        r"""Add the items to the cache, evicting the least recently used ones if it is full."""
+        if self.maxsize <= 0:
+            return
+
+        with self._lock:
+            for key, value in items.items():
+                self._data[key] = value
+                self._data.move_to_end(key)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+
 class DatasetModule(TypedDict):
     train_dataset: Optional[Union["Dataset", "IterableDataset"]]
     eval_dataset: Optional[Union["Dataset", "IterableDataset", dict[str, "Dataset"]]]
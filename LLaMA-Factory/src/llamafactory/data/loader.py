@@ -260,6 +260,8 @@ def _get_preprocessed_dataset(
         remove_columns=column_names,
         **kwargs,
     )
+    if isinstance(dataset_processor, PackedSupervisedDatasetProcessor):  # pack across the preprocessing batches
+        dataset = dataset_processor.pack_dataset(dataset, num_proc=kwargs.get("num_proc"))
 
     if training_args.should_log:
         try:
@@ -14,8 +14,11 @@
 
 import bisect
 from abc import ABC, abstractmethod
-from dataclasses import dataclass
-from typing import TYPE_CHECKING, Any, Optional
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any, Callable, Optional
+
+import numpy as np
 
 
 if TYPE_CHECKING:
@@ -73,6 +76,145 @@ def greedy_knapsack(numbers: list[int], capacity: int) -> list[list[int]]:
     return knapsacks
 
 
+def greedy_knapsack_indexes(lengths: list[int], capacity: int) -> list[list[int]]:
+    r"""Run `greedy_knapsack` and return the indexes of the items in each knapsack."""
+    length2indexes = defaultdict(list)
+    for index, length in enumerate(lengths):
+        length2indexes[length].append(index)
+
+    return [
+        [length2indexes[length].pop() for length in knapsack] for knapsack in greedy_knapsack(list(lengths), capacity)
+    ]
+
+
+def best_fit_decreasing(lengths: list[int], capacity: int) -> list[list[int]]:
+    r"""Implement the best-fit-decreasing algorithm for the bin packing problem.
+
+    Items are placed from the longest to the shortest, each into the fullest knapsack that can still hold it. The
+    knapsacks are bucketed by their remaining capacity, so the best fit is a binary search over the distinct
+    remaining capacities, which makes the algorithm O(n log(capacity)).
+
+    Returns:
+        The indexes of the items in each knapsack.
+    """
+    knapsacks: list[list[int]] = []
+    space2knapsacks: dict[int, list[int]] = defaultdict(list)  # remaining capacity -> knapsack ids
+    spaces: list[int] = []  # sorted remaining capacities of the knapsacks that are not full
+    for index in np.argsort(-np.asarray(lengths, dtype=np.int64), kind="stable").tolist():
+        length = lengths[index]
+        if length > capacity:
+            raise ValueError(f"Item of length {length} cannot fit into a knapsack with capacity {capacity}.")
+
+        position = bisect.bisect_left(spaces, length)
+        if position == len(spaces):  # open a new knapsack
+            knapsack_id, space = len(knapsacks), capacity - length
+            knapsacks.append([index])
+        else:
+            old_space = spaces[position]
+            knapsack_id, space = space2knapsacks[old_space].pop(), old_space - length
+            knapsacks[knapsack_id].append(index)
+            if len(space2knapsacks[old_space]) == 0:
+                del spaces[position], space2knapsacks[old_space]
+
+        if space > 0:
+            if len(space2knapsacks[space]) == 0:
+                bisect.insort(spaces, space)
+
+            space2knapsacks[space].append(knapsack_id)
+
+    return knapsacks
+
+
+PACKING_ALGORITHMS: dict[str, Callable[[list[int], int], list[list[int]]]] = {
+    "best_fit": best_fit_decreasing,
+    "greedy": greedy_knapsack_indexes,
+}
+
+
+@dataclass
+class PackingStats:
+    r"""Statistics of the packed sequences."""
+
+    num_sequences: int = 0
+    num_packs: int = 0
+    num_tokens: int = 0
+    num_padded_tokens: int = 0
+
+    def update(self, num_sequences: int, num_tokens: int, padded_length: int) -> None:
+        r"""Record a pack of `num_sequences` sequences with `num_tokens` tokens, padded to `padded_length`."""
+        self.num_sequences += num_sequences
+        self.num_packs += 1
+        self.num_tokens += num_tokens
+        self.num_padded_tokens += padded_length
+
+    @property
+    def efficiency(self) -> float:
+        r"""Fraction of non-padding tokens in the packed sequences."""
+        return self.num_tokens / self.num_padded_tokens if self.num_padded_tokens else 1.0
+
+    def __str__(self) -> str:
+        return (
+            f"packed {self.num_sequences} sequences into {self.num_packs} packs, "
+            f"{self.num_tokens} tokens, efficiency {self.efficiency:.2%}"
+        )
+
+
+@dataclass
+class StreamingPacker:
+    r"""Pack a stream of sequences, carrying the sequences of under-filled packs over to the next batch.
+
+    Sequences are identified by their position in the stream. Each call of `add` packs the new sequences together
+    with the carried-over ones, returns the packs filled to at least `min_fill` of the capacity, and keeps the rest
+    (at most `buffer_size` sequences) for the next call. `flush` packs the remaining sequences at the end.
+    """
+
+    capacity: int
+    algorithm: str = "best_fit"
+    buffer_size: int = 10000
+    min_fill: float = 0.98
+    _pending_ids: list[int] = field(default_factory=list, init=False, repr=False)
+    _pending_lengths: list[int] = field(default_factory=list, init=False, repr=False)
+    _num_seen: int = field(default=0, init=False, repr=False)
+
+    def __post_init__(self):
+        if self.algorithm not in PACKING_ALGORITHMS:
+            raise ValueError(f"Packing algorithm {self.algorithm} does not exist.")
+
+    def _pack(self) -> list[list[int]]:
+        knapsacks = PACKING_ALGORITHMS[self.algorithm](self._pending_lengths, self.capacity)
+        return [[self._pending_ids[index] for index in knapsack] for knapsack in knapsacks]
+
+    def add(self, lengths: list[int]) -> list[list[int]]:
+        r"""Add sequences to the stream and return the positions of the sequences in each complete pack."""
+        self._pending_ids += range(self._num_seen, self._num_seen + len(lengths))
+        self._pending_lengths += lengths
+        self._num_seen += len(lengths)
+        id2length = dict(zip(self._pending_ids, self._pending_lengths))
+        packs, leftovers = [], []
+        for pack in self._pack():
+            if sum(id2length[i] for i in pack) >= self.min_fill * self.capacity:
+                packs.append(pack)
+            else:
+                leftovers.append(pack)
+
+        leftovers.sort(key=lambda pack: sum(id2length[i] for i in pack))
+        num_leftovers = sum(len(pack) for pack in leftovers)
+        while num_leftovers > self.buffer_size:  # release the fullest leftovers to bound the buffer
+            pack = leftovers.pop()
+            packs.append(pack)
+            num_leftovers -= len(pack)
+
+        self._pending_ids = [i for pack in leftovers for i in pack]
+        self._pending_lengths = [id2length[i] for i in self._pending_ids]
+        return packs
+
+    def flush(self) -> list[list[int]]:
+        r"""Pack all the remaining sequences."""
+        packs = self._pack() if self._pending_ids else []
+        self._pending_ids, self._pending_lengths = [], []
+        return packs
+
+
 def infer_seqlen(source_len: int, target_len: int, cutoff_len: int) -> tuple[int, int]:
     r"""Compute the real sequence length after truncation by the cutoff_len."""
     if target_len * 2 < cutoff_len:  # truncate source
@@ -13,12 +13,16 @@
 # limitations under the License.
 
 from collections import defaultdict
+from collections.abc import Iterable, Iterator
 from dataclasses import dataclass
-from typing import TYPE_CHECKING, Any, Optional
+from typing import TYPE_CHECKING, Any, Optional, Union
+
+import numpy as np
+from datasets import Dataset, IterableDataset
 
 from ...extras import logging
 from ...extras.constants import IGNORE_INDEX
-from .processor_utils import DatasetProcessor, greedy_knapsack, infer_seqlen
+from .processor_utils import DatasetProcessor, PackingStats, StreamingPacker, infer_seqlen
 
 
 if TYPE_CHECKING:
@@ -41,10 +45,50 @@ class SupervisedDatasetProcessor(DatasetProcessor):
         audios: list["AudioInput"],
     ) -> tuple[list[int], list[int]]:
         messages = self.template.mm_plugin.process_messages(prompt + response, images, videos, audios, self.processor)
+        encoded_pairs = self.template.encode_multiturn(self.tokenizer, messages, system, tools)
+        return self._build_data_example(encoded_pairs, images, videos, audios)
+
+    def _encode_data_examples(
+        self, examples: dict[str, list[Any]], indexes: list[int]
+    ) -> list[tuple[list[int], list[int]]]:
+        r"""Encode the examples at the given indexes, tokenizing their text with one batched call."""
+        batch_messages = [
+            self.template.mm_plugin.process_messages(
+                examples["_prompt"][i] + examples["_response"][i],
+                examples["_images"][i] or [],
+                examples["_videos"][i] or [],
+                examples["_audios"][i] or [],
+                self.processor,
+            )
+            for i in indexes
+        ]
+        batch_encoded_pairs = self.template.encode_multiturn_batch(
+            self.tokenizer,
+            batch_messages,
+            [examples["_system"][i] for i in indexes],
+            [examples["_tools"][i] for i in indexes],
+        )
+        return [
+            self._build_data_example(
+                encoded_pairs,
+                examples["_images"][i] or [],
+                examples["_videos"][i] or [],
+                examples["_audios"][i] or [],
+            )
+            for i, encoded_pairs in zip(indexes, batch_encoded_pairs)
+        ]
+
+    def _build_data_example(
+        self,
+        encoded_pairs: list[tuple[list[int], list[int]]],
+        images: list["ImageInput"],
+        videos: list["VideoInput"],
+        audios: list["AudioInput"],
+    ) -> tuple[list[int], list[int]]:
+        r"""Truncate the encoded prompt-response pairs and build the input ids and labels."""
         input_ids, labels = self.template.mm_plugin.process_token_ids(
             [], [], images, videos, audios, self.tokenizer, self.processor
         )
-        encoded_pairs = self.template.encode_multiturn(self.tokenizer, messages, system, tools)
         total_length = len(input_ids) + (1 if self.template.efficient_eos else 0)
         if self.data_args.mask_history:
             encoded_pairs = encoded_pairs[::-1]  # high priority for last turns
@@ -85,10 +129,9 @@ class SupervisedDatasetProcessor(DatasetProcessor):
 
         return input_ids, labels
 
-    def preprocess_dataset(self, examples: dict[str, list[Any]]) -> dict[str, list[Any]]:
-        # build inputs with format `<bos> X Y <eos>` and labels with format `<ignore> ... <ignore> Y <eos>`
-        # for multiturn examples, we only mask the prompt part in each prompt-response pair.
-        model_inputs = defaultdict(list)
+    def _get_valid_indexes(self, examples: dict[str, list[Any]]) -> list[int]:
+        r"""Return the indexes of the examples with valid prompt-response pairs."""
+        valid_indexes = []
         for i in range(len(examples["_prompt"])):
             if len(examples["_prompt"][i]) % 2 != 1 or len(examples["_response"][i]) != 1:
                 logger.warning_rank0(
@@ -96,15 +139,16 @@ class SupervisedDatasetProcessor(DatasetProcessor):
                 )
                 continue
 
-            input_ids, labels = self._encode_data_example(
-                prompt=examples["_prompt"][i],
-                response=examples["_response"][i],
-                system=examples["_system"][i],
-                tools=examples["_tools"][i],
-                images=examples["_images"][i] or [],
-                videos=examples["_videos"][i] or [],
-                audios=examples["_audios"][i] or [],
-            )
+            valid_indexes.append(i)
+
+        return valid_indexes
+
+    def preprocess_dataset(self, examples: dict[str, list[Any]]) -> dict[str, list[Any]]:
+        # build inputs with format `<bos> X Y <eos>` and labels with format `<ignore> ... <ignore> Y <eos>`
+        # for multiturn examples, we only mask the prompt part in each prompt-response pair.
+        model_inputs = defaultdict(list)
+        valid_indexes = self._get_valid_indexes(examples)
+        for i, (input_ids, labels) in zip(valid_indexes, self._encode_data_examples(examples, valid_indexes)):
             model_inputs["input_ids"].append(input_ids)
             model_inputs["attention_mask"].append([1] * len(input_ids))
             model_inputs["labels"].append(labels)
@@ -125,79 +169,131 @@ class SupervisedDatasetProcessor(DatasetProcessor):
 @dataclass
 class PackedSupervisedDatasetProcessor(SupervisedDatasetProcessor):
     def preprocess_dataset(self, examples: dict[str, list[Any]]) -> dict[str, list[Any]]:
-        # TODO: use `position_ids` to achieve packing
-        # build inputs with format `<bos> X1 Y1 <eos> <bos> X2 Y2 <eos>`
-        # and labels with format `<ignore> ... <ignore> Y1 <eos> <ignore> ... <ignore> Y2 <eos>`
-        valid_num = 0
-        batch_input_ids, batch_labels, batch_images, batch_videos, batch_audios = [], [], [], [], []
-        lengths = []
-        length2indexes = defaultdict(list)
-        for i in range(len(examples["_prompt"])):
-            if len(examples["_prompt"][i]) % 2 != 1 or len(examples["_response"][i]) != 1:
+        # encode the examples here, they are packed across batches in `pack_dataset`
+        model_inputs = defaultdict(list)
+        valid_indexes = self._get_valid_indexes(examples)
+        for i, (input_ids, labels) in zip(valid_indexes, self._encode_data_examples(examples, valid_indexes)):
+            if len(input_ids) > self.data_args.cutoff_len:
                 logger.warning_rank0(
-                    "Dropped invalid example: {}".format(examples["_prompt"][i] + examples["_response"][i])
+                    f"Dropped lengthy example with length {len(input_ids)} > {self.data_args.cutoff_len}."
                 )
                 continue
 
-            input_ids, labels = self._encode_data_example(
-                prompt=examples["_prompt"][i],
-                response=examples["_response"][i],
-                system=examples["_system"][i],
-                tools=examples["_tools"][i],
-                images=examples["_images"][i] or [],
-                videos=examples["_videos"][i] or [],
-                audios=examples["_audios"][i] or [],
-            )
-            length = len(input_ids)
-            if length > self.data_args.cutoff_len:
-                logger.warning_rank0(f"Dropped lengthy example with length {length} > {self.data_args.cutoff_len}.")
+            model_inputs["input_ids"].append(input_ids)
+            model_inputs["labels"].append(labels)
+            model_inputs["images"].append(examples["_images"][i] or [])
+            model_inputs["videos"].append(examples["_videos"][i] or [])
+            model_inputs["audios"].append(examples["_audios"][i] or [])
+
+        return model_inputs
+
+    def _build_packed_example(self, examples: list[dict[str, Any]], stats: "PackingStats") -> dict[str, Any]:
+        r"""Concatenate the encoded examples of a pack.
+
+        The pack is padded to `cutoff_len + 1` unless `padding_free` is enabled, where it is stored unpadded along with
+        the boundaries of its sequences `cu_seqlens`, the collator then flattens the batch into one sequence.
+        """
+        # build inputs with format `<bos> X1 Y1 <eos> <bos> X2 Y2 <eos>`
+        # and labels with format `<ignore> ... <ignore> Y1 <eos> <ignore> ... <ignore> Y2 <eos>`
+        packed_input_ids, packed_attention_masks, packed_position_ids, packed_labels = [], [], [], []
+        packed_images, packed_videos, packed_audios = [], [], []
+        cu_seqlens = [0]
+        for i, example in enumerate(examples):
+            packed_input_ids += example["input_ids"]
+            packed_position_ids += list(range(len(example["input_ids"])))  # NOTE: pad_to_multiple_of ignore this
+            packed_labels += example["labels"]
+            packed_images += example["images"]
+            packed_videos += example["videos"]
+            packed_audios += example["audios"]
+            cu_seqlens.append(len(packed_input_ids))
+            if self.data_args.neat_packing:
+                packed_attention_masks += [i + 1] * len(example["input_ids"])  # start from 1
             else:
-                lengths.append(length)
-                length2indexes[length].append(valid_num)
-                batch_input_ids.append(input_ids)
-                batch_labels.append(labels)
-                batch_images.append(examples["_images"][i] or [])
-                batch_videos.append(examples["_videos"][i] or [])
-                batch_audios.append(examples["_audios"][i] or [])
-                valid_num += 1
+                packed_attention_masks += [1] * len(example["input_ids"])
 
-        model_inputs = defaultdict(list)
-        knapsacks = greedy_knapsack(lengths, self.data_args.cutoff_len)
-        for knapsack in knapsacks:
-            packed_input_ids, packed_attention_masks, packed_position_ids, packed_labels = [], [], [], []
-            packed_images, packed_videos, packed_audios = [], [], []
-            for i, length in enumerate(knapsack):
-                index = length2indexes[length].pop()
-                packed_input_ids += batch_input_ids[index]
-                packed_position_ids += list(range(len(batch_input_ids[index])))  # NOTE: pad_to_multiple_of ignore this
-                packed_labels += batch_labels[index]
-                packed_images += batch_images[index]
-                packed_videos += batch_videos[index]
-                packed_audios += batch_audios[index]
-                if self.data_args.neat_packing:
-                    packed_attention_masks += [i + 1] * len(batch_input_ids[index])  # start from 1
-                else:
-                    packed_attention_masks += [1] * len(batch_input_ids[index])
-
-            if len(packed_input_ids) < self.data_args.cutoff_len + 1:  # avoid flash_attn drops attn mask
-                pad_length = self.data_args.cutoff_len - len(packed_input_ids) + 1
-                packed_input_ids += [self.tokenizer.pad_token_id] * pad_length
-                packed_position_ids += [0] * pad_length
-                packed_labels += [IGNORE_INDEX] * pad_length
-                if self.data_args.neat_packing:
-                    packed_attention_masks += [0] * pad_length
-                else:
-                    packed_attention_masks += [1] * pad_length  # more efficient flash_attn
-
-            if len(packed_input_ids) != self.data_args.cutoff_len + 1:
-                raise ValueError("The length of packed example should be identical to the cutoff length.")
-
-            model_inputs["input_ids"].append(packed_input_ids)
-            model_inputs["attention_mask"].append(packed_attention_masks)
-            model_inputs["position_ids"].append(packed_position_ids)
-            model_inputs["labels"].append(packed_labels)
-            model_inputs["images"].append(packed_images or None)
-            model_inputs["videos"].append(packed_videos or None)
-            model_inputs["audios"].append(packed_audios or None)
+        num_tokens = len(packed_input_ids)
+        if self.data_args.padding_free:
+            stats.update(len(examples), num_tokens, num_tokens)
+            return {
+                "input_ids": packed_input_ids,
+                "attention_mask": packed_attention_masks,
+                "position_ids": packed_position_ids,
+                "cu_seqlens": cu_seqlens,
+                "labels": packed_labels,
+                "images": packed_images or None,
+                "videos": packed_videos or None,
+                "audios": packed_audios or None,
+            }
 
-        return model_inputs
+        if len(packed_input_ids) < self.data_args.cutoff_len + 1:  # avoid flash_attn drops attn mask
+            pad_length = self.data_args.cutoff_len - len(packed_input_ids) + 1
+            packed_input_ids += [self.tokenizer.pad_token_id] * pad_length
+            packed_position_ids += [0] * pad_length
+            packed_labels += [IGNORE_INDEX] * pad_length
+            if self.data_args.neat_packing:
+                packed_attention_masks += [0] * pad_length
+            else:
+                packed_attention_masks += [1] * pad_length  # more efficient flash_attn
+
+        if len(packed_input_ids) != self.data_args.cutoff_len + 1:
+            raise ValueError("The length of packed example should be identical to the cutoff length.")
+
+        stats.update(len(examples), num_tokens, len(packed_input_ids))
+        return {
+            "input_ids": packed_input_ids,
+            "attention_mask": packed_attention_masks,
+            "position_ids": packed_position_ids,
+            "labels": packed_labels,
+            "images": packed_images or None,
+            "videos": packed_videos or None,
+            "audios": packed_audios or None,
+        }
+
+    def _generate_packed_examples(self, batches: Iterable[dict[str, list[Any]]]) -> Iterator[dict[str, Any]]:
+        r"""Pack a stream of encoded batches, the under-filled packs are carried over to the next batch."""
+        packer = StreamingPacker(
+            capacity=self.data_args.cutoff_len,
+            algorithm=self.data_args.packing_algorithm,
+            buffer_size=self.data_args.packing_buffer_size,
+        )
+        stats = PackingStats()
+        id2example: dict[int, dict[str, Any]] = {}  # the packer identifies items by their stream positions
+        num_examples = 0
+        for batch in batches:
+            examples = [dict(zip(batch.keys(), values)) for values in zip(*batch.values())]
+            id2example.update(zip(range(num_examples, num_examples + len(examples)), examples))
+            num_examples += len(examples)
+            for pack in packer.add([len(example["input_ids"]) for example in examples]):
+                yield self._build_packed_example([id2example.pop(i) for i in pack], stats)
+
+        for pack in packer.flush():
+            yield self._build_packed_example([id2example.pop(i) for i in pack], stats)
+
+        logger.info_rank0(f"Sequence packing ({self.data_args.packing_algorithm}): {stats}.")
+
+    def _pack_shards(self, dataset: "Dataset", shards: list[tuple[int, int]]) -> Iterator[dict[str, Any]]:
+        r"""Pack the given row ranges of an encoded dataset as a single stream."""
+        batch_size = self.data_args.preprocessing_batch_size
+        yield from self._generate_packed_examples(
+            dataset[i : min(i + batch_size, end)] for start, end in shards for i in range(start, end, batch_size)
+        )
+
+    def _pack_iterable(self, dataset: "IterableDataset") -> Iterator[dict[str, Any]]:
+        r"""Pack an encoded streaming dataset."""
+        yield from self._generate_packed_examples(dataset.iter(batch_size=self.data_args.preprocessing_batch_size))
+
+    def pack_dataset(
+        self, dataset: Union["Dataset", "IterableDataset"], num_proc: Optional[int] = None
+    ) -> Union["Dataset", "IterableDataset"]:
+        r"""Pack the encoded dataset, each worker packs a contiguous shard of it as a stream."""
+        if isinstance(dataset, IterableDataset):
+            return IterableDataset.from_generator(self._pack_iterable, gen_kwargs={"dataset": dataset})
+
+        num_shards = max(num_proc or 1, 1)
+        bounds = np.linspace(0, len(dataset), num_shards + 1).astype(int).tolist()
+        shards = [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+        return Dataset.from_generator(
+            self._pack_shards,
+            gen_kwargs={"dataset": dataset, "shards": shards},
+            num_proc=num_proc if len(shards) > 1 else None,
+        )
@@ -14,13 +14,13 @@
 
 import re
 from copy import deepcopy
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import TYPE_CHECKING, Optional, Union
 
 from typing_extensions import override
 
 from ..extras import logging
-from .data_utils import Role
+from .data_utils import LRUCache, Role
 from .formatter import EmptyFormatter, FunctionFormatter, StringFormatter, ToolFormatter
 from .mm_plugin import get_mm_plugin
 
@@ -54,6 +54,9 @@ class Template:
     replace_jinja_template: bool
     enable_thinking: Optional[bool]
     mm_plugin: "BasePlugin"
+    fragment_cache: "LRUCache" = field(
+        default_factory=lambda: LRUCache(maxsize=4096), init=False, repr=False, compare=False
+    )
 
     def encode_oneturn(
         self,
@@ -82,6 +85,20 @@ class Template:
         encoded_messages = self._encode(tokenizer, messages, system, tools)
         return [(encoded_messages[i], encoded_messages[i + 1]) for i in range(0, len(encoded_messages), 2)]
 
+    def encode_multiturn_batch(
+        self,
+        tokenizer: "PreTrainedTokenizer",
+        batch_messages: list[list[dict[str, str]]],
+        batch_system: list[Optional[str]],
+        batch_tools: list[Optional[str]],
+    ) -> list[list[tuple[list[int], list[int]]]]:
+        r"""Return the results of `encode_multiturn` for a batch of examples, using one tokenizer call."""
+        batch_encoded_messages = self._encode_batch(tokenizer, batch_messages, batch_system, batch_tools)
+        return [
+            [(encoded_messages[i], encoded_messages[i + 1]) for i in range(0, len(encoded_messages), 2)]
+            for encoded_messages in batch_encoded_messages
+        ]
+
     def extract_tool(self, content: str) -> Union[str, list["FunctionCall"]]:
         r"""Extract tool message."""
         return self.format_tools.extract(content)
@@ -105,15 +122,24 @@ class Template:
 
     def get_thought_word_ids(self, tokenizer: "PreTrainedTokenizer") -> list[int]:
         r"""Get the token ids of thought words."""
-        return tokenizer.encode(self.add_thought(), add_special_tokens=False)
+        thought_words = self.add_thought()
+        return list(self._encode_texts(tokenizer, [thought_words], {thought_words})[thought_words])
 
-    def _convert_elements_to_ids(self, tokenizer: "PreTrainedTokenizer", elements: "SLOTS") -> list[int]:
-        r"""Convert elements to token ids."""
+    def _convert_elements_to_ids(
+        self,
+        tokenizer: "PreTrainedTokenizer",
+        elements: "SLOTS",
+        text_ids: Optional[dict[str, list[int]]] = None,
+    ) -> list[int]:
+        r"""Convert elements to token ids, strings found in `text_ids` are not tokenized again."""
         token_ids = []
         for elem in elements:
             if isinstance(elem, str):
                 if len(elem) != 0:
-                    token_ids += tokenizer.encode(elem, add_special_tokens=False)
+                    if text_ids is not None and elem in text_ids:
+                        token_ids += text_ids[elem]
+                    else:
+                        token_ids += tokenizer.encode(elem, add_special_tokens=False)
             elif isinstance(elem, dict):
                 token_ids += [tokenizer.convert_tokens_to_ids(elem.get("token"))]
             elif isinstance(elem, set):
@@ -126,28 +152,73 @@ class Template:
 
         return token_ids
 
-    def _encode(
+    def _encode_texts(
+        self, tokenizer: "PreTrainedTokenizer", texts: list[str], fragments: set[str]
+    ) -> dict[str, list[int]]:
+        r"""Encode distinct texts in one tokenizer call, reusing the cached token ids of the fragments seen before.
+
+        Only the template fragments (e.g. prefix, system prompt and tools) are cached, the message contents are
+        mostly unique and are tokenized without caching. The cache is keyed by (tokenizer, text), so templates shared
+        by different tokenizers do not collide.
+        """
+        tokenizer_key = (tokenizer.__class__.__name__, tokenizer.name_or_path, len(tokenizer))
+        cached_ids = self.fragment_cache.get_many(
+            ("token_ids", tokenizer_key, text) for text in texts if text in fragments
+        )
+        text_ids = {key[-1]: token_ids for key, token_ids in cached_ids.items()}
+        missing_texts = [text for text in texts if text not in text_ids]
+        if missing_texts:
+            missing_ids = dict(zip(missing_texts, tokenizer(missing_texts, add_special_tokens=False)["input_ids"]))
+            self.fragment_cache.put_many(
+                {
+                    ("token_ids", tokenizer_key, text): token_ids
+                    for text, token_ids in missing_ids.items()
+                    if text in fragments
+                }
+            )
+            text_ids.update(missing_ids)
+
+        return text_ids
+
+    def _format_tools(self, tools: str) -> str:
+        r"""Format the tool descriptions, the results are cached since many examples share the same tools."""
+        cache_key = ("tool_text", self.format_tools.__class__.__name__, self.format_tools.tool_format, tools)
+        cached_text = self.fragment_cache.get_many([cache_key])
+        if cache_key in cached_text:
+            return cached_text[cache_key]
+
+        tool_text = self.format_tools.apply(content=tools)[0]
+        self.fragment_cache.put_many({cache_key: tool_text})
+        return tool_text
+
+    def _format_system(self, system: Optional[str], tools: Optional[str]) -> "SLOTS":
+        r"""Format the prefix and the system message of the first turn, which are shared by many examples."""
+        system = system or self.default_system
+        elements = []
+        elements += self.format_prefix.apply()
+        if system or tools:
+            tool_text = self._format_tools(tools) if tools else ""
+            elements += self.format_system.apply(content=(system + tool_text))
+
+        return elements
+
+    def _format_messages(
         self,
-        tokenizer: "PreTrainedTokenizer",
         messages: list[dict[str, str]],
         system: Optional[str],
         tools: Optional[str],
-    ) -> list[list[int]]:
-        r"""Encode formatted inputs to pairs of token ids.
+    ) -> list["SLOTS"]:
+        r"""Format inputs to the elements of each message.
 
         Turn 0: prefix + system + query        resp
         Turn t: query                          resp.
         """
-        system = system or self.default_system
-        encoded_messages = []
+        formatted_messages = []
         for i, message in enumerate(messages):
             elements = []
 
             if i == 0:
-                elements += self.format_prefix.apply()
-                if system or tools:
-                    tool_text = self.format_tools.apply(content=tools)[0] if tools else ""
-                    elements += self.format_system.apply(content=(system + tool_text))
+                elements += self._format_system(system, tools)
 
             if message["role"] == Role.USER:
                 elements += self.format_user.apply(content=message["content"], idx=str(i // 2))
@@ -160,9 +231,53 @@ class Template:
             else:
                 raise NotImplementedError("Unexpected role: {}".format(message["role"]))
 
-            encoded_messages.append(self._convert_elements_to_ids(tokenizer, elements))
+            formatted_messages.append(elements)
 
-        return encoded_messages
+        return formatted_messages
+
+    def _encode(
+        self,
+        tokenizer: "PreTrainedTokenizer",
+        messages: list[dict[str, str]],
+        system: Optional[str],
+        tools: Optional[str],
+    ) -> list[list[int]]:
+        r"""Encode formatted inputs to pairs of token ids."""
+        return self._encode_batch(tokenizer, [messages], [system], [tools])[0]
+
+    def _encode_batch(
+        self,
+        tokenizer: "PreTrainedTokenizer",
+        batch_messages: list[list[dict[str, str]]],
+        batch_system: list[Optional[str]],
+        batch_tools: list[Optional[str]],
+    ) -> list[list[list[int]]]:
+        r"""Encode a batch of formatted inputs, the distinct string slots are tokenized in one call.
+
+        Only the slots of the prefix and the system message are cached, see `_encode_texts`.
+        """
+        batch_formatted_messages = [
+            self._format_messages(messages, system, tools)
+            for messages, system, tools in zip(batch_messages, batch_system, batch_tools)
+        ]
+        texts = dict.fromkeys(
+            elem
+            for formatted_messages in batch_formatted_messages
+            for elements in formatted_messages
+            for elem in elements
+            if isinstance(elem, str) and len(elem) != 0
+        )
+        fragments = {
+            elem
+            for system, tools in dict.fromkeys(zip(batch_system, batch_tools))
+            for elem in self._format_system(system, tools)
+            if isinstance(elem, str)
+        }
+        text_ids = self._encode_texts(tokenizer, list(texts), fragments)
+        return [
+            [self._convert_elements_to_ids(tokenizer, elements, text_ids) for elements in formatted_messages]
+            for formatted_messages in batch_formatted_messages
+        ]
 
     @staticmethod
     def _add_or_replace_eos_token(tokenizer: "PreTrainedTokenizer", eos_token: str) -> None:
@@ -330,15 +445,14 @@ class Llama2Template(Template):
     r"""A template that fuse the system message to first user message."""
 
     @override
-    def _encode(
+    def _format_messages(
         self,
-        tokenizer: "PreTrainedTokenizer",
         messages: list[dict[str, str]],
         system: str,
         tools: str,
-    ) -> list[list[int]]:
+    ) -> list["SLOTS"]:
         system = system or self.default_system
-        encoded_messages = []
+        formatted_messages = []
         for i, message in enumerate(messages):
             elements = []
 
@@ -346,7 +460,7 @@ class Llama2Template(Template):
             if i == 0:
                 elements += self.format_prefix.apply()
                 if system or tools:
-                    tool_text = self.format_tools.apply(content=tools)[0] if tools else ""
+                    tool_text = self._format_tools(tools) if tools else ""
                     system_text = self.format_system.apply(content=(system + tool_text))[0]
 
             if message["role"] == Role.USER:
@@ -360,9 +474,9 @@ class Llama2Template(Template):
             else:
                 raise NotImplementedError("Unexpected role: {}".format(message["role"]))
 
-            encoded_messages.append(self._convert_elements_to_ids(tokenizer, elements))
+            formatted_messages.append(elements)
 
-        return encoded_messages
+        return formatted_messages
 
     def _get_jinja_template(self, tokenizer: "PreTrainedTokenizer") -> str:
         prefix = self._convert_slots_to_jinja(self.format_prefix.apply(), tokenizer)
@@ -434,12 +548,38 @@ class ReasoningTemplate(Template):
         system: Optional[str] = None,
         tools: Optional[str] = None,
     ) -> list[tuple[list[int], list[int]]]:
+        messages = self._remove_multiturn_thoughts(messages)
+        encoded_messages = self._encode(tokenizer, messages, system, tools)
+        return self._add_multiturn_thoughts(tokenizer, messages, encoded_messages)
+
+    @override
+    def encode_multiturn_batch(
+        self,
+        tokenizer: "PreTrainedTokenizer",
+        batch_messages: list[list[dict[str, str]]],
+        batch_system: list[Optional[str]],
+        batch_tools: list[Optional[str]],
+    ) -> list[list[tuple[list[int], list[int]]]]:
+        batch_messages = [self._remove_multiturn_thoughts(messages) for messages in batch_messages]
+        batch_encoded_messages = self._encode_batch(tokenizer, batch_messages, batch_system, batch_tools)
+        return [
+            self._add_multiturn_thoughts(tokenizer, messages, encoded_messages)
+            for messages, encoded_messages in zip(batch_messages, batch_encoded_messages)
+        ]
+
+    def _remove_multiturn_thoughts(self, messages: list[dict[str, str]]) -> list[dict[str, str]]:
+        r"""Copy the messages and remove all cot if thinking is disabled."""
         messages = deepcopy(messages)
         if self.enable_thinking is False:  # remove all cot
             for i in range(1, len(messages), 2):
                 messages[i]["content"] = self.remove_thought(messages[i]["content"])
 
-        encoded_messages = self._encode(tokenizer, messages, system, tools)
+        return messages
+
+    def _add_multiturn_thoughts(
+        self, tokenizer: "PreTrainedTokenizer", messages: list[dict[str, str]], encoded_messages: list[list[int]]
+    ) -> list[tuple[list[int], list[int]]]:
+        r"""Add empty cot to the encoded turns without thought and pair prompts and responses."""
         for i in range(0, len(messages), 2):
             if (
                 self.thought_words[0].strip() not in messages[i + 1]["content"]
@@ -617,6 +757,7 @@ def get_template_and_fix_tokenizer(tokenizer: "PreTrainedTokenizer", data_args:
         template.default_system = data_args.default_system
 
     template.enable_thinking = data_args.enable_thinking
+    template.fragment_cache = LRUCache(maxsize=data_args.template_cache_size)
     template.fix_special_tokens(tokenizer)
     template.fix_jinja_template(tokenizer)
     return template
@@ -111,6 +111,18 @@ class DataArguments:
         default=False,
         metadata={"help": "Enable sequence packing without cross-attention."},
     )
+    padding_free: bool = field(
+        default=False,
+        metadata={"help": "Enable sequence packing without padding, each batch is flattened into one sequence."},
+    )
+    packing_algorithm: Literal["best_fit", "greedy"] = field(
+        default="best_fit",
+        metadata={"help": "The bin packing algorithm used to pack sequences, best fit decreasing or greedy."},
+    )
+    packing_buffer_size: int = field(
+        default=10000,
+        metadata={"help": "Max number of sequences carried over to the next batch when packing sequences."},
+    )
     tool_format: Optional[str] = field(
         default=None,
         metadata={"help": "Tool format to use for constructing function calling examples."},
@@ -123,6 +135,15 @@ class DataArguments:
         default=True,
         metadata={"help": "Whether or not to enable thinking mode for reasoning models."},
     )
+    template_cache_size: int = field(
+        default=4096,
+        metadata={
+            "help": (
+                "Maximum number of text fragments (e.g. system prompts and tool descriptions) "
+                "whose token ids are cached by the template. Use 0 to disable the cache."
+            )
+        },
+    )
     tokenized_path: Optional[str] = field(
         default=None,
         metadata={
@@ -176,10 +197,13 @@ class DataArguments:
         if self.mask_history and self.train_on_prompt:
             raise ValueError("`mask_history` is incompatible with `train_on_prompt`.")
 
-        if self.neat_packing:
+        if self.neat_packing and self.padding_free:
+            raise ValueError("`neat_packing` is incompatible with `padding_free`.")
+
+        if self.neat_packing or self.padding_free:
             self.packing = True
 
-        if self.packing:
+        if self.packing and not self.padding_free:
             self.cutoff_len -= 1  # avoid pad_to_multiple_of, needs improve
 
     def to_dict(self) -> dict[str, Any]:
@@ -227,8 +227,8 @@ def get_train_args(args: Optional[Union[dict[str, Any], list[str]]] = None) -> _
         if training_args.predict_with_generate:
             raise ValueError("`predict_with_generate` cannot be set as True except SFT.")
 
-        if data_args.neat_packing:
-            raise ValueError("`neat_packing` cannot be set as True except SFT.")
+        if data_args.neat_packing or data_args.padding_free:
+            raise ValueError("`neat_packing` or `padding_free` cannot be set as True except SFT.")
 
         if data_args.train_on_prompt or data_args.mask_history:
             raise ValueError("`train_on_prompt` or `mask_history` cannot be set as True except SFT.")
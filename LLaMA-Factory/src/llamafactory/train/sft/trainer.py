@@ -25,6 +25,7 @@ import torch
 from transformers import Seq2SeqTrainer
 from typing_extensions import override
 
+from ...data import SFTDataCollatorWith4DAttentionMask
 from ...extras import logging
 from ...extras.constants import IGNORE_INDEX
 from ...extras.packages import is_transformers_version_greater_than
@@ -112,6 +113,14 @@ class CustomSeq2SeqTrainer(Seq2SeqTrainer):
 
         return super()._get_train_sampler(*args, **kwargs)
 
+    @override
+    def _prepare_inputs(self, inputs: dict[str, Union["torch.Tensor", Any]]) -> dict[str, Union["torch.Tensor", Any]]:
+        inputs = super()._prepare_inputs(inputs)
+        if isinstance(self.data_collator, SFTDataCollatorWith4DAttentionMask):  # expand the deferred mask on device
+            inputs = self.data_collator.expand_attention_mask(inputs)
+
+        return inputs
+
     @override
     def compute_loss(self, model, inputs, *args, **kwargs):
         return super().compute_loss(model, inputs, *args, **kwargs)
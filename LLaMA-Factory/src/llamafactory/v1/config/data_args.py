@@ -31,3 +31,23 @@ class DataArguments:
         default=2048,
         metadata={"help": "Cutoff length for the dataset."},
     )
+    shuffle: bool = field(
+        default=True,
+        metadata={"help": "Whether to shuffle the dataset when iterating over it."},
+    )
+    seed: int = field(
+        default=42,
+        metadata={"help": "Random seed for shuffling, combined with the epoch number."},
+    )
+    shuffle_buffer_size: int = field(
+        default=10000,
+        metadata={"help": "Size of the shuffle buffer for streaming datasets."},
+    )
+    prefetch_size: int = field(
+        default=64,
+        metadata={"help": "Number of converted samples to prefetch in the async iterator."},
+    )
+    data_index_dir: Optional[str] = field(
+        default=None,
+        metadata={"help": "Path to the folder to cache the data index in, it is memory-mapped on restart."},
+    )
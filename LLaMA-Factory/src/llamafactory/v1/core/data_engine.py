@@ -12,17 +12,28 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
+import hashlib
+import json
+import math
 import os
-from collections.abc import AsyncIterable, Iterable
-from typing import Any, Union
-
+import threading
+from collections.abc import AsyncIterator, Iterator
+from typing import Any, Callable, Optional, Union
+
+import numpy as np
+import torch
+import torch.distributed as dist
+from datasets import Dataset as MapDataset
 from datasets import load_dataset
+from datasets.distributed import split_dataset_by_node
 from huggingface_hub import hf_hub_download
 from omegaconf import OmegaConf
 from torch.utils.data import Dataset
 
 from ..config.data_args import DataArguments
 from ..extras.types import DatasetInfo, HFDataset, Sample
+from ..plugins.data_plugins.loader import DATA_INDEX_DTYPE
 
 
 class DataEngine(Dataset):
@@ -35,10 +46,16 @@ class DataEngine(Dataset):
         """Dict of (dataset_name, dataset)"""
         self.dataset_infos: dict[str, DatasetInfo] = {}
         """Dict of (dataset_name, dataset_info)"""
-        self.data_index: list[tuple[str, int]] = []
-        """List of (dataset_name, sample_index)"""
+        self.converters: dict[str, Optional[Callable[[dict], Sample]]] = {}
+        """Dict of (dataset_name, converter), resolved on first use."""
+        self.dataset_names: list[str] = []
+        """List of dataset names, indexed by dataset_id."""
+        self.data_index: np.ndarray = np.empty(0, dtype=DATA_INDEX_DTYPE)
+        """Array of (dataset_id, sample_index)"""
         self.streaming: bool = False
         """Whether dataset is streaming."""
+        self.epoch: int = 0
+        """Current epoch, used to reseed shuffling."""
         self.get_dataset_info()
         self.load_dataset()
         self.build_data_index()
@@ -72,21 +89,74 @@ class DataEngine(Dataset):
                 self.datasets[key] = DataLoaderPlugin(args=self.args).auto_load_data(value)
 
     def build_data_index(self) -> None:
-        """Build dataset index."""
-        for dataset_name, dataset in self.datasets.items():
+        """Build dataset index.
+
+        If `data_index_dir` is set, the index is saved there and memory-mapped on the next run with the same
+        datasets, instead of being rebuilt.
+        """
+        self.dataset_names = list(self.datasets.keys())
+        if len(self.dataset_names) > np.iinfo(np.int16).max:
+            raise ValueError(f"At most {np.iinfo(np.int16).max} datasets are supported.")
+
+        if self.streaming:  # streaming datasets are sized and mixed lazily in `__iter__`
+            return
+
+        cache_path = None
+        if self.args.data_index_dir is not None:
+            cache_path = os.path.join(self.args.data_index_dir, f"data_index-{self._get_index_fingerprint()}.npy")
+            if os.path.isfile(cache_path):
+                self.data_index = np.load(cache_path, mmap_mode="r")
+                return
+
+        data_indexes = []
+        for dataset_id, (dataset_name, dataset) in enumerate(self.datasets.items()):
             size = self.dataset_infos[dataset_name].get("size")
             weight = self.dataset_infos[dataset_name].get("weight")
-            if self.streaming:
-                data_index = [(dataset_name, -1) for _ in range(1000)]
-            else:
-                data_index = [(dataset_name, sample_index) for sample_index in range(len(dataset))]
+            data_index = np.empty(len(dataset), dtype=DATA_INDEX_DTYPE)
+            data_index["dataset_id"] = dataset_id
+            data_index["sample_index"] = np.arange(len(dataset))
 
             if size or weight:  # data index plugin
                 from ..plugins.data_plugins.loader import DataIndexPlugin
 
-                data_index = DataIndexPlugin().adjust_data_index(data_index, size, weight)
+                data_index = DataIndexPlugin(seed=self.args.seed).adjust_data_index(data_index, size, weight)
+
+            data_indexes.append(data_index)
+
+        self.data_index = np.concatenate(data_indexes) if data_indexes else np.empty(0, dtype=DATA_INDEX_DTYPE)
+        if cache_path is not None:
+            os.makedirs(self.args.data_index_dir, exist_ok=True)
+            tmp_path = f"{cache_path}.{os.getpid()}.tmp.npy"
+            np.save(tmp_path, self.data_index)
+            os.replace(tmp_path, cache_path)
+            self.data_index = np.load(cache_path, mmap_mode="r")
+
+    def _get_index_fingerprint(self) -> str:
+        """Get the fingerprint of the dataset infos, dataset sizes and seed that determine the data index."""
+        dataset_infos = OmegaConf.to_container(OmegaConf.create(dict(self.dataset_infos)), resolve=True)
+        dataset_sizes = {dataset_name: len(dataset) for dataset_name, dataset in self.datasets.items()}
+        content = json.dumps([dataset_infos, dataset_sizes, self.args.seed], sort_keys=True, default=str)
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()[:16]
+
+    def _get_converter(self, dataset_name: str) -> Optional[Callable[[dict], Sample]]:
+        """Get the converter of a dataset, resolving it only once.
+
+        Args:
+            dataset_name (str): Dataset name.
+
+        Returns:
+            Optional[Callable[[dict], Sample]]: Dataset converter, None if samples are used as-is.
+        """
+        if dataset_name not in self.converters:
+            converter = self.dataset_infos[dataset_name].get("converter")
+            if converter is not None:
+                from ..plugins.data_plugins.converter import get_converter
 
-            self.data_index.extend(data_index)
+                converter = get_converter(converter)
+
+            self.converters[dataset_name] = converter
+
+        return self.converters[dataset_name]
 
     def _convert_data_sample(self, raw_sample: dict[str, Any], dataset_name: str) -> Sample:
         """Convert dataset sample.
@@ -98,14 +168,30 @@ class DataEngine(Dataset):
         Returns:
             Sample: Dataset sample.
         """
-        converter = self.dataset_infos[dataset_name].get("converter")
+        converter = self._get_converter(dataset_name)
         if converter is not None:
-            from ..plugins.data_plugins.converter import get_converter
-
-            return {"_dataset_name": dataset_name, **get_converter(converter)(raw_sample)}
+            return {"_dataset_name": dataset_name, **converter(raw_sample)}
         else:
             return {"_dataset_name": dataset_name, **raw_sample}
 
+    def _convert_data_batch(self, raw_batch: dict[str, list[Any]], dataset_name: str) -> list[Sample]:
+        """Convert a batch of dataset samples in column format.
+
+        Args:
+            raw_batch (dict[str, list[Any]]): Raw dataset samples, a dict of columns.
+            dataset_name (str): Dataset name.
+
+        Returns:
+            list[Sample]: Dataset samples.
+        """
+        converter = self._get_converter(dataset_name)
+        columns = list(raw_batch.keys())
+        raw_samples = (dict(zip(columns, values)) for values in zip(*raw_batch.values()))
+        if converter is not None:
+            return [{"_dataset_name": dataset_name, **converter(raw_sample)} for raw_sample in raw_samples]
+        else:
+            return [{"_dataset_name": dataset_name, **raw_sample} for raw_sample in raw_samples]
+
     def __len__(self) -> int:
         """Get dataset length.
 
@@ -129,49 +215,176 @@ class DataEngine(Dataset):
         if self.streaming:
             raise ValueError("Streaming dataset does not support index access.")
 
-        if isinstance(index, int):
-            dataset_name, sample_index = self.data_index[index]
-            return self._convert_data_sample(self.datasets[dataset_name][sample_index], dataset_name)
+        if isinstance(index, (int, np.integer)):
+            dataset_id, sample_index = self.data_index[index]
+            dataset_name = self.dataset_names[dataset_id]
+            return self._convert_data_sample(self.datasets[dataset_name][int(sample_index)], dataset_name)
         else:
             from ..plugins.data_plugins.loader import DataSelectorPlugin
 
             selected_index = DataSelectorPlugin(data_index=self.data_index).select(index)
-            if isinstance(selected_index, list):
-                return [
-                    self._convert_data_sample(self.datasets[dataset_name][sample_index], dataset_name)
-                    for dataset_name, sample_index in selected_index
-                ]
-            else:
-                dataset_name, sample_index = selected_index
-                return self._convert_data_sample(self.datasets[dataset_name][sample_index], dataset_name)
-
-    def __iter__(self) -> Iterable:
-        """Get dataset iterator.
+            samples: list[Optional[Sample]] = [None] * len(selected_index)
+            dataset_ids = selected_index["dataset_id"]
+            for dataset_id in np.unique(dataset_ids).tolist():  # fetch the samples of each dataset in one batch
+                positions = np.flatnonzero(dataset_ids == dataset_id)
+                dataset_name = self.dataset_names[dataset_id]
+                raw_batch = self.datasets[dataset_name][selected_index["sample_index"][positions].tolist()]
+                for position, sample in zip(positions.tolist(), self._convert_data_batch(raw_batch, dataset_name)):
+                    samples[position] = sample
+
+            return samples
+
+    def __getitems__(self, indices: list[int]) -> list[Sample]:
+        """Get a batch of dataset items, used by the dataloader to fetch a batch at once.
+
+        Args:
+            indices (list[int]): Dataset indices.
 
         Returns:
-            Iterable: Dataset iterator.
+            list[Sample]: Dataset items.
         """
-        if self.streaming:
-            pass
+        return self[indices]
+
+    def set_epoch(self, epoch: int) -> None:
+        """Set the epoch so that each epoch is iterated in a different (but reproducible) order.
+
+        Args:
+            epoch (int): Epoch number.
+        """
+        self.epoch = epoch
+
+    def _iter_map_dataset(self) -> Iterator[Sample]:
+        """Iterate over map-style datasets with an epoch-seeded permutation of the data index."""
+        rank, world_size, worker_id, num_workers = _get_shard_info()
+        num_samples = len(self.data_index)
+        if self.args.shuffle:
+            order = np.random.default_rng([self.args.seed, self.epoch]).permutation(num_samples)
         else:
-            # TODO: add shuffle here
-            pass
+            order = np.arange(num_samples)
 
-        raise NotImplementedError()
+        if num_samples % world_size != 0:  # repeat samples so that all ranks take the same number of steps
+            order = np.resize(order, math.ceil(num_samples / world_size) * world_size)
 
-    async def __aiter__(self) -> AsyncIterable:
-        """Get dataset async iterator.
+        for index in order[rank::world_size][worker_id::num_workers]:
+            yield self[int(index)]
+
+    def _iter_streaming_dataset(self) -> Iterator[Sample]:
+        """Iterate over streaming datasets, mixing them by weight until all of them are exhausted.
+
+        Each dataset is shuffled with a buffer of `shuffle_buffer_size` samples and split across ranks. Inside
+        dataloader workers, the shards (files) of each rank are further split across workers by `datasets`.
+        """
+        rank, world_size, worker_id, _ = _get_shard_info()
+        dataset_names, iterators, weights = [], [], []
+        for dataset_name, dataset in self.datasets.items():
+            dataset_info = self.dataset_infos[dataset_name]
+            if isinstance(dataset, MapDataset):
+                dataset = dataset.to_iterable_dataset()
+
+            if self.args.shuffle:
+                dataset = dataset.shuffle(seed=self.args.seed, buffer_size=self.args.shuffle_buffer_size)
+                dataset.set_epoch(self.epoch)
+
+            if dataset_info.get("size") is not None:
+                dataset = dataset.take(dataset_info["size"])
+
+            if world_size > 1:
+                dataset = split_dataset_by_node(dataset, rank=rank, world_size=world_size)
+
+            dataset_names.append(dataset_name)
+            iterators.append(iter(dataset))
+            weights.append(dataset_info.get("weight", 1.0))
+
+        rng = np.random.default_rng([self.args.seed, self.epoch, rank, worker_id])
+        while iterators:
+            probs = np.asarray(weights, dtype=np.float64)
+            i = int(rng.choice(len(iterators), p=probs / probs.sum())) if len(iterators) > 1 else 0
+            try:
+                raw_sample = next(iterators[i])
+            except StopIteration:
+                del dataset_names[i], iterators[i], weights[i]
+                continue
+
+            yield self._convert_data_sample(raw_sample, dataset_names[i])
+
+    def __iter__(self) -> Iterator[Sample]:
+        """Get dataset iterator.
 
         Returns:
-            AsyncIterable: Dataset async iterator.
+            Iterator[Sample]: Dataset iterator, sharded across ranks and dataloader workers.
         """
         if self.streaming:
-            pass
+            yield from self._iter_streaming_dataset()
         else:
-            # TODO: add shuffle here
-            pass
+            yield from self._iter_map_dataset()
+
+    async def __aiter__(self) -> AsyncIterator[Sample]:
+        """Get dataset async iterator.
 
-        raise NotImplementedError()
+        Samples are loaded and converted in a background thread, which keeps up to `prefetch_size` samples ahead
+        of the consumer.
+
+        Returns:
+            AsyncIterator[Sample]: Dataset async iterator.
+        """
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue(maxsize=max(self.args.prefetch_size, 1))
+        stop_event = threading.Event()
+        end_of_data = object()
+        errors: list[Exception] = []
+
+        def produce() -> None:
+            try:
+                try:
+                    for sample in self:
+                        if stop_event.is_set():
+                            return
+
+                        asyncio.run_coroutine_threadsafe(queue.put(sample), loop).result()
+                except Exception as e:  # noqa: BLE001 - re-raised by the consumer after the queued samples
+                    errors.append(e)
+
+                if not stop_event.is_set():
+                    asyncio.run_coroutine_threadsafe(queue.put(end_of_data), loop).result()
+            except RuntimeError:  # event loop closed before the consumer finished
+                pass
+
+        producer = threading.Thread(target=produce, name="data-engine-prefetch", daemon=True)
+        producer.start()
+        try:
+            while True:
+                sample = await queue.get()
+                if sample is end_of_data:
+                    if errors:
+                        raise errors[0]
+
+                    return
+
+                yield sample
+        finally:
+            stop_event.set()
+            while not queue.empty():  # unblock the producer if it is waiting on a full queue
+                queue.get_nowait()
+
+
+def _get_shard_info() -> tuple[int, int, int, int]:
+    """Get the shard of the current process.
+
+    Returns:
+        tuple[int, int, int, int]: Rank, world size, dataloader worker id and number of dataloader workers.
+    """
+    if dist.is_available() and dist.is_initialized():
+        rank, world_size = dist.get_rank(), dist.get_world_size()
+    else:
+        rank, world_size = 0, 1
+
+    worker_info = torch.utils.data.get_worker_info()
+    if worker_info is not None:
+        worker_id, num_workers = worker_info.id, worker_info.num_workers
+    else:
+        worker_id, num_workers = 0, 1
+
+    return rank, world_size, worker_id, num_workers
 
 
 if __name__ == "__main__":
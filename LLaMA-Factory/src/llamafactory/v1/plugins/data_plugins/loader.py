@@ -17,12 +17,17 @@ import os
 from dataclasses import dataclass
 from typing import Any, Literal, Optional, Union
 
+import numpy as np
 from datasets import load_dataset
 
 from ...config.data_args import DataArguments
 from ...extras.types import DatasetInfo, HFDataset
 
 
+DATA_INDEX_DTYPE = np.dtype([("dataset_id", np.int16), ("sample_index", np.int64)])
+"""Data index entry: position of the dataset in `DataEngine.dataset_names` and index of the sample in it."""
+
+
 @dataclass
 class DataLoaderPlugin:
     """Plugin for loading dataset."""
@@ -71,18 +76,19 @@ class DataLoaderPlugin:
 class DataIndexPlugin:
     """Plugin for adjusting dataset index."""
 
-    def adjust_data_index(
-        self, data_index: list[tuple[str, int]], size: Optional[int], weight: Optional[float]
-    ) -> list[tuple[str, int]]:
+    seed: int = 42
+    """Random seed for sampling."""
+
+    def adjust_data_index(self, data_index: np.ndarray, size: Optional[int], weight: Optional[float]) -> np.ndarray:
         """Adjust dataset index by size and weight.
 
         Args:
-            data_index (list[tuple[str, int]]): List of (dataset_name, sample_index).
+            data_index (np.ndarray): Array of (dataset_id, sample_index), see `DATA_INDEX_DTYPE`.
             size (Optional[int]): Desired dataset size.
             weight (Optional[float]): Desired dataset weight.
 
         Returns:
-            list[tuple[str, int]]: Adjusted dataset index.
+            np.ndarray: Adjusted dataset index.
         """
         if size is not None:
             data_index = self.adjust_by_size(data_index, size)
@@ -92,32 +98,64 @@ class DataIndexPlugin:
 
         return data_index
 
-    def adjust_by_size(self, data_index: list[tuple[str, int]], size: int) -> list[tuple[str, int]]:
-        raise NotImplementedError()
+    def adjust_by_size(self, data_index: np.ndarray, size: int) -> np.ndarray:
+        """Down-sample without replacement, or repeat the whole dataset and up-sample the remainder.
+
+        Args:
+            data_index (np.ndarray): Dataset index.
+            size (int): Desired dataset size.
+
+        Returns:
+            np.ndarray: Dataset index of length `size`.
+        """
+        if size < 0:
+            raise ValueError(f"Dataset size should be non-negative, got {size}.")
+
+        if len(data_index) == 0 or size == len(data_index):
+            return data_index
 
-    def adjust_by_weight(self, data_index: list[tuple[str, int]], weight: float) -> list[tuple[str, int]]:
-        raise NotImplementedError()
+        rng = np.random.default_rng(self.seed)
+        num_repeats, remainder = divmod(size, len(data_index))
+        sampled = np.sort(rng.choice(len(data_index), size=remainder, replace=False))
+        return np.concatenate([np.tile(data_index, num_repeats), data_index[sampled]])
+
+    def adjust_by_weight(self, data_index: np.ndarray, weight: float) -> np.ndarray:
+        """Scale the dataset size by weight, e.g. 0.5 keeps half of the samples and 2.0 doubles them.
+
+        Args:
+            data_index (np.ndarray): Dataset index.
+            weight (float): Desired dataset weight.
+
+        Returns:
+            np.ndarray: Dataset index of length `round(len(data_index) * weight)`.
+        """
+        if weight < 0:
+            raise ValueError(f"Dataset weight should be non-negative, got {weight}.")
+
+        return self.adjust_by_size(data_index, round(len(data_index) * weight))
 
 
 @dataclass
 class DataSelectorPlugin:
     """Plugin for selecting dataset samples."""
 
-    data_index: list[tuple[str, int]]
-    """List of (dataset_name, sample_index)"""
+    data_index: np.ndarray
+    """Array of (dataset_id, sample_index), see `DATA_INDEX_DTYPE`."""
 
-    def select(self, index: Union[slice, list[int], Any]) -> Union[tuple[str, int], list[tuple[str, int]]]:
+    def select(self, index: Union[slice, list[int], Any]) -> np.ndarray:
         """Select dataset samples.
 
+        Slices return a view of the data index, lists gather the selected entries.
+
         Args:
             index (Union[slice, list[int], Any]): Index of dataset samples.
 
         Returns:
-            Union[tuple[str, int], list[tuple[str, int]]]: Selected dataset samples.
+            np.ndarray: Selected dataset samples.
         """
         if isinstance(index, slice):
-            return [self.data_index[i] for i in range(*index.indices(len(self.data_index)))]
-        elif isinstance(index, list):
-            return [self.data_index[i] for i in index]
+            return self.data_index[index]
+        elif isinstance(index, (list, np.ndarray)):
+            return self.data_index[np.asarray(index, dtype=np.int64)]
         else:
             raise ValueError(f"Invalid index type {type(index)}.")
@@ -13,9 +13,22 @@
 # limitations under the License.
 
 
+import random
+
 import pytest
 
-from llamafactory.data.processor.processor_utils import infer_seqlen
+from llamafactory.data.processor.processor_utils import (
+    PackingStats,
+    StreamingPacker,
+    best_fit_decreasing,
+    greedy_knapsack_indexes,
+    infer_seqlen,
+)
+
+
+def _check_packs(packs: list[list[int]], lengths: list[int], capacity: int) -> None:
+    assert sorted(index for pack in packs for index in pack) == list(range(len(lengths)))
+    assert all(sum(lengths[index] for index in pack) <= capacity for pack in packs)
 
 
 @pytest.mark.parametrize(
@@ -32,3 +45,42 @@ from llamafactory.data.processor.processor_utils import infer_seqlen
 )
 def test_infer_seqlen(test_input: tuple[int, int, int], test_output: tuple[int, int]):
     assert test_output == infer_seqlen(*test_input)
+
+
+@pytest.mark.parametrize("num_items", [0, 1, 100, 1000])
+def test_best_fit_decreasing(num_items: int):
+    rng = random.Random(42)
+    lengths = [min(int(rng.paretovariate(1.2) * 64), 1024) for _ in range(num_items)]
+    packs = best_fit_decreasing(lengths, 1024)
+    _check_packs(packs, lengths, 1024)
+    assert len(packs) <= len(greedy_knapsack_indexes(lengths, 1024))
+    with pytest.raises(ValueError):
+        best_fit_decreasing([1025], 1024)
+
+
+@pytest.mark.parametrize("buffer_size", [10, 10000])
+def test_streaming_packer(buffer_size: int):
+    rng = random.Random(42)
+    lengths = [min(int(rng.paretovariate(1.2) * 64), 1024) for _ in range(1000)]
+    packer = StreamingPacker(capacity=1024, buffer_size=buffer_size)
+    packs = []
+    for i in range(0, len(lengths), 100):
+        new_packs = packer.add(lengths[i : i + 100])
+        assert len(packer._pending_ids) <= buffer_size
+        if buffer_size == 10000:  # under-filled packs are only released when the buffer overflows
+            assert all(sum(lengths[index] for index in pack) >= 0.98 * 1024 for pack in new_packs)
+
+        packs += new_packs
+
+    packs += packer.flush()
+    _check_packs(packs, lengths, 1024)
+    assert packer.flush() == []
+
+
+def test_packing_stats():
+    stats = PackingStats()
+    assert stats.efficiency == 1.0
+    stats.update(num_sequences=2, num_tokens=90, padded_length=100)
+    stats.update(num_sequences=3, num_tokens=60, padded_length=100)
+    assert (stats.num_sequences, stats.num_packs) == (5, 2)
+    assert stats.efficiency == 0.75
@@ -14,13 +14,19 @@
 
 import os
 
+import pytest
 import torch
 from PIL import Image
-from transformers import AutoConfig, AutoModelForVision2Seq
+from transformers import AutoConfig, AutoModelForCausalLM, AutoModelForVision2Seq
 
 from llamafactory.data import get_template_and_fix_tokenizer
-from llamafactory.data.collator import MultiModalDataCollatorForSeq2Seq, prepare_4d_attention_mask
+from llamafactory.data.collator import (
+    MultiModalDataCollatorForSeq2Seq,
+    SFTDataCollatorWith4DAttentionMask,
+    prepare_4d_attention_mask,
+)
 from llamafactory.extras.constants import IGNORE_INDEX
+from llamafactory.extras.packages import is_transformers_version_greater_than
 from llamafactory.hparams import get_infer_args
 from llamafactory.model import load_tokenizer
 
@@ -71,6 +77,60 @@ def test_base_collator():
         assert batch_input[k].eq(torch.tensor(expected_input[k])).all()
 
 
+@pytest.mark.parametrize("attn_implementation", ["sdpa", "flash_attention_2"])
+@pytest.mark.parametrize("use_model", [True, False])
+def test_padding_free_collator(attn_implementation: str, use_model: bool):
+    model_args, data_args, *_ = get_infer_args({"model_name_or_path": TINY_LLAMA3, "template": "default"})
+    tokenizer_module = load_tokenizer(model_args)
+    template = get_template_and_fix_tokenizer(tokenizer_module["tokenizer"], data_args)
+    model = None
+    if use_model:  # llama builds the causal mask with the masking utils
+        with torch.device("meta"):
+            model = AutoModelForCausalLM.from_config(AutoConfig.from_pretrained(TINY_LLAMA3))
+
+    data_collator = SFTDataCollatorWith4DAttentionMask(
+        template=template,
+        model=model,
+        pad_to_multiple_of=8,
+        label_pad_token_id=IGNORE_INDEX,
+        defer_4d_attention_mask=True,
+        padding_free=True,
+        attn_implementation=attn_implementation,
+        **tokenizer_module,
+    )
+    p = tokenizer_module["tokenizer"].pad_token_id
+    q = IGNORE_INDEX
+    features = [
+        {
+            "input_ids": [0, 1, 2, 3, 4],
+            "attention_mask": [1, 1, 1, 1, 1],
+            "position_ids": [0, 1, 2, 0, 1],
+            "cu_seqlens": [0, 3, 5],
+            "labels": [q, 1, 2, 3, 4],
+        },
+        {
+            "input_ids": [6, 7],
+            "attention_mask": [1, 1],
+            "labels": [6, 7],
+        },
+    ]
+    batch_input = data_collator(features)
+    expected_input = {
+        "input_ids": [[0, 1, 2, 3, 4, 6, 7, p]],
+        "labels": [[q, 1, 2, q, 4, q, 7, q]],
+        "position_ids": [[0, 1, 2, 0, 1, 0, 1, 0]],
+    }
+    if attn_implementation == "flash_attention_2":
+        expected_input["cu_seq_lens_q"] = expected_input["cu_seq_lens_k"] = [0, 3, 5, 7, 8]
+        assert batch_input.pop("max_length_q") == batch_input.pop("max_length_k") == 3
+    elif not (use_model and is_transformers_version_greater_than("4.54.0")):  # sequences cannot be inferred
+        expected_input["attention_mask"] = [[1, 1, 1, 2, 2, 3, 3, 4]]
+
+    assert batch_input.keys() == expected_input.keys()
+    for k in batch_input:
+        assert batch_input[k].eq(torch.tensor(expected_input[k])).all()
+
+
 def test_multimodal_collator():
     model_args, data_args, *_ = get_infer_args(
         {"model_name_or_path": "Qwen/Qwen2-VL-2B-Instruct", "template": "qwen2_vl"}
@@ -165,5 +225,37 @@ def test_4d_attention_mask():
     assert torch.all(attention_mask_computed == attention_mask_expected)
 
 
+@pytest.mark.parametrize("chunk_size", [1, 3, 4, 1024])
+def test_4d_attention_mask_chunked(chunk_size: int):
+    attention_mask_with_indices = torch.tensor(
+        [
+            [1, 1, 2, 2, 2, 3, 3, 0],
+            [1, 2, 2, 2, 2, 2, 2, 2],
+        ]
+    )
+    attention_mask_expected = prepare_4d_attention_mask(attention_mask_with_indices, torch.float32, chunk_size=8)
+    attention_mask_computed = prepare_4d_attention_mask(attention_mask_with_indices, torch.float32, chunk_size)
+    assert torch.all(attention_mask_computed == attention_mask_expected)
+
+
+def test_deferred_4d_attention_mask():
+    model_args, data_args, *_ = get_infer_args({"model_name_or_path": TINY_LLAMA3, "template": "default"})
+    tokenizer_module = load_tokenizer(model_args)
+    template = get_template_and_fix_tokenizer(tokenizer_module["tokenizer"], data_args)
+    features = [
+        {"input_ids": [0, 1, 2, 3, 4], "attention_mask": [1, 1, 2, 2, 2], "labels": [0, 1, 2, 3, 4]},
+        {"input_ids": [5, 6, 7], "attention_mask": [1, 2, 3], "labels": [5, 6, 7]},
+    ]
+    collator_kwargs = dict(template=template, block_diag_attn=True, attn_implementation="sdpa", **tokenizer_module)
+    batch_input = SFTDataCollatorWith4DAttentionMask(**collator_kwargs)([dict(f) for f in features])
+    data_collator = SFTDataCollatorWith4DAttentionMask(defer_4d_attention_mask=True, **collator_kwargs)
+    deferred_input = data_collator([dict(f) for f in features])
+    assert deferred_input["attention_mask"].eq(torch.tensor([[1, 1, 2, 2, 2], [1, 2, 3, 0, 0]])).all()
+    deferred_input = data_collator.expand_attention_mask(deferred_input)
+    assert batch_input.keys() == deferred_input.keys()
+    for k in batch_input:
+        assert batch_input[k].eq(deferred_input[k]).all()
+
+
 if __name__ == "__main__":
     test_multimodal_collator()
@@ -13,6 +13,7 @@
 # limitations under the License.
 
 import os
+import pickle
 from typing import TYPE_CHECKING
 
 import pytest
@@ -180,6 +181,35 @@ def test_reasoning_encode_multiturn(use_fast: bool, cot_messages: bool, enable_t
     )
 
 
+@pytest.mark.parametrize("use_fast", [True, False])
+@pytest.mark.parametrize("template_name", ["llama3", "qwen3"])
+def test_encode_multiturn_batch(use_fast: bool, template_name: str):
+    model_id = TINY_LLAMA3 if template_name == "llama3" else "Qwen/Qwen3-8B"
+    tokenizer = AutoTokenizer.from_pretrained(model_id, use_fast=use_fast)
+    template = get_template_and_fix_tokenizer(tokenizer, DataArguments(template=template_name))
+    batch_messages = [MESSAGES, MESSAGES_WITH_THOUGHT, MESSAGES[:2]]
+    batch_system = [None, "You are a helpful assistant.", "You are a helpful assistant."]
+    tools = '[{"name": "get_weather", "parameters": {"type": "object", "properties": {}}}]'
+    batch_tools = [None, tools, ""]
+    batch_encoded_pairs = template.encode_multiturn_batch(tokenizer, batch_messages, batch_system, batch_tools)
+    for messages, system, tools, encoded_pairs in zip(batch_messages, batch_system, batch_tools, batch_encoded_pairs):
+        assert encoded_pairs == template.encode_multiturn(tokenizer, messages, system, tools)
+
+
+def test_fragment_cache():
+    tokenizer = AutoTokenizer.from_pretrained(TINY_LLAMA3)
+    template = get_template_and_fix_tokenizer(tokenizer, DataArguments(template="llama3", template_cache_size=4))
+    tools = '[{"name": "get_weather", "parameters": {"type": "object", "properties": {}}}]'
+    encoded_pairs = template.encode_multiturn(tokenizer, MESSAGES, "You are a helpful assistant.", tools)
+    assert len(template.fragment_cache) == 2  # formatted tools and system slot, message contents are not cached
+    assert template.encode_multiturn(tokenizer, MESSAGES, "You are a helpful assistant.", tools) == encoded_pairs
+    for i in range(4):
+        template.encode_multiturn(tokenizer, MESSAGES, f"System prompt {i}.", tools)
+
+    assert len(template.fragment_cache) == 4  # bounded by template_cache_size
+    assert len(pickle.loads(pickle.dumps(template)).fragment_cache) == 0
+
+
 @pytest.mark.parametrize("use_fast", [True, False])
 def test_jinja_template(use_fast: bool):
     tokenizer = AutoTokenizer.from_pretrained(TINY_LLAMA3, use_fast=use_fast)
@@ -12,15 +12,35 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
+import json
 import random
 
+import numpy as np
 import pytest
 from datasets import load_dataset
 
 from llamafactory.v1.config.data_args import DataArguments
+from llamafactory.v1.core import data_engine as data_engine_module
 from llamafactory.v1.core.data_engine import DataEngine
 
 
+def _write_local_datasets(dataset_dir, streaming: bool) -> None:
+    for name, num_samples in (("a", 30), ("b", 10)):
+        with open(dataset_dir / f"{name}.jsonl", "w", encoding="utf-8") as f:
+            f.writelines(json.dumps({"instruction": f"{name}{i}", "output": name}) + "\n" for i in range(num_samples))
+
+    with open(dataset_dir / "dataset_info.yaml", "w", encoding="utf-8") as f:
+        for name in ("a", "b"):
+            f.write(
+                f"{name}:\n  file_name: {name}.jsonl\n  converter: alpaca\n  streaming: {str(streaming).lower()}\n"
+            )
+
+
+def _get_instruction(sample) -> str:
+    return sample["messages"][0]["content"][0]["value"]
+
+
 @pytest.mark.parametrize("num_samples", [16])
 def test_map_dataset(num_samples: int):
     data_args = DataArguments(dataset="llamafactory/v1-sft-demo")
@@ -32,5 +52,86 @@ def test_map_dataset(num_samples: int):
         assert data_engine[index] == {"_dataset_name": "default", **original_data[index]}
 
 
+def test_iter_map_dataset(tmp_path):
+    _write_local_datasets(tmp_path, streaming=False)
+    data_engine = DataEngine(DataArguments(dataset="dataset_info.yaml", dataset_dir=str(tmp_path), seed=1))
+    first_epoch = [_get_instruction(sample) for sample in data_engine]
+    assert first_epoch == [_get_instruction(sample) for sample in data_engine]
+    data_engine.set_epoch(1)
+    second_epoch = [_get_instruction(sample) for sample in data_engine]
+    assert first_epoch != second_epoch
+    assert sorted(first_epoch) == sorted(second_epoch)
+    assert len(first_epoch) == len(set(first_epoch)) == 40
+
+
+def test_iter_map_dataset_sharding(tmp_path, monkeypatch):
+    _write_local_datasets(tmp_path, streaming=False)
+    data_engine = DataEngine(DataArguments(dataset="dataset_info.yaml", dataset_dir=str(tmp_path)))
+    shards = []
+    for rank in range(3):
+        for worker_id in range(2):
+            monkeypatch.setattr(data_engine_module, "_get_shard_info", lambda r=rank, w=worker_id: (r, 3, w, 2))
+            shards.append([_get_instruction(sample) for sample in data_engine])
+
+    assert all(len(shards[2 * rank]) + len(shards[2 * rank + 1]) == 14 for rank in range(3))  # 40 padded to 42
+    assert len({instruction for shard in shards for instruction in shard}) == 40
+
+
+def test_data_index_cache(tmp_path):
+    _write_local_datasets(tmp_path, streaming=False)
+    with open(tmp_path / "dataset_info.yaml", "a", encoding="utf-8") as f:
+        f.write("  size: 25\n")  # applies to dataset b
+
+    data_args = DataArguments(
+        dataset="dataset_info.yaml", dataset_dir=str(tmp_path), data_index_dir=str(tmp_path / "index")
+    )
+    data_engine = DataEngine(data_args)
+    assert len(data_engine) == 55
+    assert data_engine[slice(30, None)] == data_engine[list(range(30, 55))]
+    assert {sample["_dataset_name"] for sample in data_engine[30:]} == {"b"}
+
+    cached_engine = DataEngine(data_args)
+    assert isinstance(cached_engine.data_index, np.memmap)
+    assert (cached_engine.data_index == data_engine.data_index).all()
+
+
+def test_batched_getitem(tmp_path):
+    _write_local_datasets(tmp_path, streaming=False)
+    data_engine = DataEngine(DataArguments(dataset="dataset_info.yaml", dataset_dir=str(tmp_path)))
+    indexes = random.choices(range(len(data_engine)), k=16)
+    assert data_engine[indexes] == [data_engine[index] for index in indexes]
+    assert data_engine.__getitems__(indexes) == data_engine[indexes]
+    assert data_engine[25:35] == [data_engine[index] for index in range(25, 35)]
+    assert data_engine[[]] == []
+
+
+def test_iter_streaming_dataset(tmp_path):
+    _write_local_datasets(tmp_path, streaming=True)
+    data_engine = DataEngine(
+        DataArguments(dataset="dataset_info.yaml", dataset_dir=str(tmp_path), shuffle_buffer_size=4)
+    )
+    assert len(data_engine.data_index) == 0
+    samples = [_get_instruction(sample) for sample in data_engine]
+    assert sorted(samples) == sorted([f"a{i}" for i in range(30)] + [f"b{i}" for i in range(10)])
+    assert samples != [f"a{i}" for i in range(30)] + [f"b{i}" for i in range(10)]
+
+
+def test_aiter_dataset(tmp_path):
+    _write_local_datasets(tmp_path, streaming=True)
+    data_engine = DataEngine(DataArguments(dataset="dataset_info.yaml", dataset_dir=str(tmp_path), prefetch_size=2))
+
+    async def consume(limit=None):
+        samples = []
+        async for sample in data_engine:
+            samples.append(_get_instruction(sample))
+            if len(samples) == limit:
+                break
+
+        return samples
+
+    assert asyncio.run(consume()) == [_get_instruction(sample) for sample in data_engine]
+    assert len(asyncio.run(consume(limit=3))) == 3
+
+
 if __name__ == "__main__":
     test_map_dataset(1)
@@ -0,0 +1,61 @@
+# Copyright 2025 the LlamaFactory team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+import pytest
+
+from llamafactory.v1.plugins.data_plugins.loader import DATA_INDEX_DTYPE, DataIndexPlugin, DataSelectorPlugin
+
+
+def _build_data_index(num_samples: int, dataset_id: int = 0) -> np.ndarray:
+    data_index = np.empty(num_samples, dtype=DATA_INDEX_DTYPE)
+    data_index["dataset_id"] = dataset_id
+    data_index["sample_index"] = np.arange(num_samples)
+    return data_index
+
+
+@pytest.mark.parametrize("size", [0, 7, 10, 25])
+def test_adjust_by_size(size: int):
+    data_index = _build_data_index(10)
+    adjusted = DataIndexPlugin().adjust_by_size(data_index, size)
+    assert len(adjusted) == size
+    assert adjusted.dtype == DATA_INDEX_DTYPE
+    counts = np.bincount(adjusted["sample_index"], minlength=10)
+    assert counts.max() - counts.min() <= 1  # every sample is repeated size // 10 or size // 10 + 1 times
+    np.testing.assert_array_equal(adjusted, DataIndexPlugin().adjust_by_size(data_index, size))
+
+
+def test_adjust_by_weight():
+    data_index = _build_data_index(10, dataset_id=3)
+    assert len(DataIndexPlugin().adjust_data_index(data_index, size=None, weight=0.5)) == 5
+    adjusted = DataIndexPlugin().adjust_data_index(data_index, size=20, weight=1.5)
+    assert len(adjusted) == 30
+    assert (adjusted["dataset_id"] == 3).all()
+
+
+def test_select():
+    data_index = _build_data_index(10)
+    selector = DataSelectorPlugin(data_index=data_index)
+    selected = selector.select(slice(2, 8, 2))
+    assert np.shares_memory(selected, data_index)
+    assert selected["sample_index"].tolist() == [2, 4, 6]
+    assert selector.select([9, 0, 9])["sample_index"].tolist() == [9, 0, 9]
+    with pytest.raises(ValueError):
+        selector.select("0")
+
+
+if __name__ == "__main__":
+    test_adjust_by_size(25)
+    test_adjust_by_weight()
+    test_select()
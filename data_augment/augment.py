@@ -1,18 +1,24 @@
 import os
+import time
 import random
 import logging
+import socket
 import argparse
+import multiprocessing as mp
 from tqdm import trange
 from src.extract_main import extract
-from src.translate import back_translate
+from src.translate import TranslationError, back_translate_batch
 from src.replace import replace
 from src.regenerate import regenerate
 from src.structure import structure
+from src.api_utils import call_with_retry, get_rate_limiter, run_concurrent
+from src.ledger import JobLedger
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 support_language = ['en', 'ko', 'de']
+METHODS = ['translate', 'replace', 'regenerate', 'structure']
 
 def store_single(output_dir, sample, output):
     with open(os.path.join(output_dir, sample['path']), 'w', encoding='utf-8') as f:
@@ -25,70 +31,197 @@ def store_list(output_dir, sample_list, output_list):
     for i in range(len(output_list)):
         store_single(output_dir, sample_list[i], output_list[i])
 
-def main(args):
-    if os.path.isdir(args.orin_dir):
-        samples = os.listdir(args.orin_dir)
-        done_list = os.listdir(args.output_dir)
-        sample_list, input_list = [], []
-        for sample in samples:
-            with open(os.path.join(args.orin_dir, sample), 'r', encoding='utf-8') as f:
-                sample_data = f.read()
-                title, body = extract(sample_data)
-                if title is None or body is None:
-                    continue
-                sample_list.append({'title': title, 'body': body, 'path': sample})
-                input_list.append(body)
-        
-        total_length = len(sample_list)
-        n_share = args.n_share
-        n_size = total_length // n_share
-        idx = args.idx
-        
-        sample_list = sample_list[(idx * n_size):((idx + 1) * n_size)]
-        input_list = input_list[(idx * n_size):((idx + 1) * n_size)]
-        # input_list = input_list[:10]
-        # sample_list = sample_list[:10]
-        
-        result_list = []
-        
-        if args.method == 'translate':
-            for i in trange(len(sample_list)):
-                sample = sample_list[i]
-                if sample['path'] in done_list:
-                    continue
-                tgt_lang = random.choice(support_language)
-                output = back_translate(sample['body'], api=args.transapi, src_lang='zh', tgt_lang=tgt_lang)
-                if output is None:
-                    continue
-                store_single(args.output_dir, sample, output)
-        elif args.method == 'replace':
-            output_list = replace(input_list)
-            store_list(args.output_dir, sample_list, output_list)
-        elif args.method == 'regenerate':
-            for i in trange(len(sample_list)):
-                sample = sample_list[i]
-                if sample['path'] in done_list:
-                    continue
-                try:
-                    output = regenerate(sample['title'], sample['body'], 'deepseek')
-                    store_single(args.output_dir, sample, output)
-                except Exception as err:
-                    print(err)
-                    continue
-        elif args.method == 'structure':
+def job_model(args):
+    """台账中的模型标识，同一 (方法, 模型) 下的样本共享断点状态。"""
+    if args.method == 'translate':
+        return args.trans_api
+    return {'replace': 'word2vec', 'regenerate': 'deepseek', 'structure': 'ark'}[args.method]
+
+def ledger_path(args):
+    return args.ledger_path or args.output_dir.rstrip('/\\') + '.ledger.sqlite'
+
+def load_samples(orin_dir, paths):
+    """读取并解析领取到的文件，返回 (样本列表, 解析失败的文件名)。"""
+    sample_list, invalid = [], []
+    for sample in paths:
+        with open(os.path.join(orin_dir, sample), 'r', encoding='utf-8') as f:
+            sample_data = f.read()
+            title, body = extract(sample_data)
+            if title is None or body is None:
+                invalid.append(sample)
+                continue
+            sample_list.append({'title': title, 'body': body, 'path': sample})
+    return sample_list, invalid
+
+def process_samples(args, sample_list, ledger, model):
+    """对一批样本执行增强，每条样本的结果立即写入输出目录和台账。"""
+    input_list = [sample['body'] for sample in sample_list]
+
+    def on_result(sample, result):
+        output, usage, latency = result
+        if output is None:
+            ledger.record(sample['path'], args.method, model, 'rejected', latency=latency, usage=usage)
+            return
+        store_single(args.output_dir, sample, output)
+        ledger.record(sample['path'], args.method, model, 'done', latency=latency, usage=usage)
+
+    def on_error(sample, err):
+        logger.error(f"{sample['path']}: {err}")
+        ledger.record(sample['path'], args.method, model, 'failed', error=str(err))
+
+    if args.method == 'translate':
+        # 每批随机选择一种中间语言，整批回译并计算相似度
+        for i in trange(0, len(sample_list), args.translate_batch_size):
+            batch = sample_list[i:i + args.translate_batch_size]
+            tgt_lang = random.choice(support_language)
+            start = time.time()
+            try:
+                output_list = back_translate_batch([sample['body'] for sample in batch], api=args.trans_api,
+                                                   src_lang='zh', tgt_lang=tgt_lang)
+            except Exception as err:
+                for sample in batch:
+                    on_error(sample, err)
+                continue
+            latency = (time.time() - start) / len(batch)
+            for sample, output in zip(batch, output_list):
+                if isinstance(output, TranslationError):  # 服务调用失败记为 failed，--retry_failed 会重跑
+                    on_error(sample, output)
+                else:
+                    on_result(sample, (output, None, latency))
+    elif args.method == 'replace':
+        start = time.time()
+        output_list = replace(input_list)
+        latency = (time.time() - start) / max(len(output_list), 1)
+        for sample, output in zip(sample_list, output_list):
+            on_result(sample, (output, None, latency))
+    elif args.method in ('regenerate', 'structure'):
+        if args.method == 'regenerate':
+            limiter = get_rate_limiter('deepseek', args.rate_limit)
+
+            def generate(sample):
+                return call_with_retry(regenerate, sample['title'], sample['body'], 'deepseek', with_usage=True,
+                                       limiter=limiter, max_retries=args.max_retries)
+        else:
             model_list = ['deepseek-v3-2-251201', 'deepseek-v3-250324', 
                           'deepseek-r1-250528', 'doubao-seed-1-6-251015', 'doubao-seed-1-6-flash-250828']
-            for i in trange(len(sample_list)):
-                model = random.choice(model_list)
-                sample = sample_list[i]
-                if sample['path'] in done_list:
+            # 以上模型都通过火山方舟接入，共用一个限流器
+            limiter = get_rate_limiter('doubao', args.rate_limit)
+
+            def generate(sample):
+                return call_with_retry(structure, sample['title'], sample['body'], random.choice(model_list),
+                                       with_usage=True, limiter=limiter, max_retries=args.max_retries)
+
+        def timed_generate(sample):
+            start = time.time()
+            output, usage = generate(sample)
+            return output, usage, time.time() - start
+
+        run_concurrent(timed_generate, sample_list, concurrency=args.concurrency,
+                       on_result=on_result, on_error=on_error, desc=args.method)
+
+def claim_size(args):
+    """每次从队列领取的样本数：回译按批次大小，API 方法保证并发管道是满的，replace 一次领完。"""
+    if args.claim_size:
+        return args.claim_size
+    if args.method == 'translate':
+        return args.translate_batch_size
+    if args.method in ('regenerate', 'structure'):
+        return args.concurrency * 4
+    return 1 << 30
+
+def worker_main(args, worker_id):
+    """
+    worker 循环：从台账队列领取一批文件 -> 解析 -> 增强 -> 从队列移除，直到队列为空。
+    解析放在 worker 中进行，协调进程只列目录、不读文件。
+    """
+    model = job_model(args)
+    ledger = JobLedger(ledger_path(args))
+    n = claim_size(args)
+    try:
+        while True:
+            paths = ledger.claim(worker_id, args.method, model, n)
+            if not paths:
+                break
+            # 被回收的文件可能已被异常退出的 worker 处理了一部分
+            todo = paths if args.retry_failed else ledger.unfinished(paths, args.method, model)
+            sample_list, invalid = load_samples(args.orin_dir, todo)
+            for sample in invalid:
+                ledger.record(sample, args.method, model, 'rejected', error='extract failed')
+            if sample_list:
+                process_samples(args, sample_list, ledger, model)
+            ledger.complete(paths, args.method, model)
+    finally:
+        ledger.close()
+
+def coordinate(args, model):
+    """
+    协调进程：只列一次目录并写入台账队列，然后启动 num_workers 个本地 worker。
+    worker 异常退出时归还它未完成的文件，并在仍有剩余任务时启动替补 worker。
+    """
+    ledger = JobLedger(ledger_path(args))
+    # 首次使用台账时，把输出目录中已有的文件登记为已完成
+    bootstrapped = ledger.bootstrap(os.listdir(args.output_dir), args.method, model)
+    if bootstrapped:
+        logger.info(f'Registered {bootstrapped} existing outputs in the ledger')
+
+    # random_dataset.py 在样本旁写有 manifest.jsonl，只取逐样本的 txt 文件
+    samples = [sample for sample in os.listdir(args.orin_dir) if sample.endswith('.txt')]
+    if args.retry_failed:
+        failed_set = ledger.failed_paths(args.method, model)
+        samples = [sample for sample in samples if sample in failed_set]
+    else:
+        finished_set = ledger.finished_paths(args.method, model)
+        samples = [sample for sample in samples if sample not in finished_set]
+    ledger.enqueue(samples, args.method, model)
+    logger.info(f'{len(samples)} samples to process for {args.method}/{model}')
+
+    num_workers = args.num_workers
+    if args.method == 'replace' and num_workers > 1:
+        # replace 需要在整个语料上统计 TF-IDF，且内部已经并行分词，只用一个 worker
+        logger.warning('replace runs in a single worker; --num_workers is ignored')
+        num_workers = 1
+
+    if num_workers <= 1 or not samples:
+        worker_main(args, f'{socket.gethostname()}-{os.getpid()}')
+    else:
+        ctx = mp.get_context('spawn')
+        workers, restarts = {}, 0
+
+        def spawn(worker_id):
+            process = ctx.Process(target=worker_main, args=(args, worker_id), name=worker_id)
+            process.start()
+            workers[worker_id] = process
+
+        for i in range(num_workers):
+            spawn(f'{socket.gethostname()}-w{i}')
+        while workers:
+            time.sleep(1)
+            for worker_id, process in list(workers.items()):
+                if process.is_alive():
                     continue
-                try:
-                    output = structure(sample['title'], sample['body'], model)
-                    store_single(args.output_dir, sample, output)
-                except Exception as err:
-                    print(err)
+                del workers[worker_id]
+                if process.exitcode == 0:
                     continue
+                released = ledger.release_worker(worker_id)
+                logger.warning(f'Worker {worker_id} exited with code {process.exitcode}, released {released} samples')
+                if ledger.pending_count(args.method, model) and restarts < args.max_worker_restarts:
+                    restarts += 1
+                    spawn(f'{worker_id}-r{restarts}')
+
+    remaining = ledger.pending_count(args.method, model)
+    if remaining:
+        logger.warning(f'{remaining} samples are still queued; rerun to process them')
+    logger.info(f'Ledger summary for {args.method}/{model}: {ledger.summary(args.method, model)}')
+    ledger.close()
+
+def main(args):
+    # 在打开台账之前检查参数：台账按 (方法, 模型) 记录状态，模型不能为空
+    if args.method not in METHODS:
+        raise ValueError(f'--method must be one of {METHODS}, got {args.method}')
+    if args.method == 'translate' and args.trans_api is None:
+        raise ValueError('--trans_api is required for --method translate')
+    if os.path.isdir(args.orin_dir):
+        coordinate(args, job_model(args))
     else:
         logging.warning('Please enter the existing oringinal dataset dir')
 
@@ -97,10 +230,17 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--orin_dir", default="/home/ruansikai/Limerence/assignments/LLM/datasets/cleaned_data")
     parser.add_argument("--output_dir", default="/home/ruansikai/Limerence/assignments/LLM/translate")
-    parser.add_argument("--method", choices=['translate', 'replace', 'regenerate', 'structure', 'all'])
-    parser.add_argument("--trans_api", choices=['aliyun', 'tencent', 'baidu'])
-    parser.add_argument("--n_share", type=int, default=8)
-    parser.add_argument("--idx", type=int, default=4)
+    parser.add_argument("--method", choices=METHODS, required=True)
+    parser.add_argument("--trans_api", choices=['aliyun', 'tencent', 'baidu', 'local'])
+    parser.add_argument("--translate_batch_size", type=int, default=32, help="translate 每批回译的样本数")
+    parser.add_argument("--num_workers", type=int, default=1, help="本地 worker 进程数，共享台账中的任务队列")
+    parser.add_argument("--claim_size", type=int, default=None, help="worker 每次从队列领取的样本数，默认按方法自动选择")
+    parser.add_argument("--max_worker_restarts", type=int, default=8, help="worker 异常退出后最多启动多少个替补 worker")
+    parser.add_argument("--concurrency", type=int, default=16, help="regenerate/structure 同时在途的请求数")
+    parser.add_argument("--rate_limit", type=float, default=10, help="每个 provider 每秒请求数上限，<=0 表示不限流")
+    parser.add_argument("--max_retries", type=int, default=5, help="单条样本失败后的最大重试次数（指数退避）")
+    parser.add_argument("--ledger_path", default=None, help="任务台账 SQLite 路径，默认为 <output_dir>.ledger.sqlite")
+    parser.add_argument("--retry_failed", action="store_true", help="只重跑台账中状态为 failed 的样本")
     
     args = parser.parse_args()
     
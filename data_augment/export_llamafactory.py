@@ -0,0 +1,179 @@
+import os
+import json
+import glob
+import shutil
+import logging
+import argparse
+import pyarrow as pa
+import pyarrow.parquet as pq
+from tqdm import tqdm
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 导出为 LLaMA-Factory 可直接加载的数据集：
+#   - 输入：逐样本 .txt 目录（cleaned_data / augmented_data）、remapping.py 生成的汇总 JSONL/Parquet、
+#           read_data.py / random_dataset.py 写出的 Parquet/JSONL 分片
+#   - 输出：<dataset_dir>/<name>/ 下的 Parquet 或 Arrow 分片，并在 <dataset_dir>/dataset_info.json 中注册
+#   python export_llamafactory.py --input augmented_data.jsonl --name news_train_augmented_shards --task pt
+MANIFEST_NAME = 'manifest.jsonl'  # random_dataset.py 写在 txt 样本旁的清单，只含路径不含文本
+
+
+# --- 1. 读取输入 ---
+def _record_text(record):
+    """优先使用 text 字段，否则用 title + content 拼接（与清洗后 .txt 文件的格式一致）。"""
+    if record.get('text'):
+        return record['text'].replace('\n', '')
+    title, content = record.get('title') or '', record.get('content') or ''
+    return (title + ' ' + content).strip()
+
+
+def _iter_file_records(path):
+    if path.endswith('.parquet'):
+        parquet_file = pq.ParquetFile(path)
+        for batch in parquet_file.iter_batches():
+            yield from batch.to_pylist()
+    elif path.endswith('.jsonl') or path.endswith('.json'):
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+    else:
+        with open(path, 'r', encoding='utf-8') as f:
+            yield {'text': f.read(), 'name': os.path.basename(path)}
+
+
+def iter_texts(input_path):
+    """流式产出输入中每个样本的文本，目录按文件名排序以保证导出结果可复现。"""
+    if os.path.isdir(input_path):
+        paths = sorted(glob.glob(os.path.join(input_path, '*.parquet'))) or \
+            sorted(path for path in glob.glob(os.path.join(input_path, '*.jsonl'))
+                   if os.path.basename(path) != MANIFEST_NAME) or \
+            sorted(os.path.join(input_path, name) for name in os.listdir(input_path) if name.endswith('.txt'))
+    else:
+        paths = [input_path]
+    for path in paths:
+        for record in _iter_file_records(path):
+            text = _record_text(record)
+            if text:
+                yield text
+
+
+# --- 2. 转换为 alpaca / sharegpt 格式 ---
+def split_prompt(text, prompt_chars):
+    """新闻续写任务：前 prompt_chars 个字符作为开头，其余作为续写目标。"""
+    return text[:prompt_chars], text[prompt_chars:]
+
+
+def to_example(text, formatting, task, prompt_chars):
+    if task == 'pt':
+        return {'text': text}
+    prompt, response = split_prompt(text, prompt_chars)
+    if formatting == 'sharegpt':
+        return {'conversations': [{'from': 'human', 'value': prompt}, {'from': 'gpt', 'value': response}]}
+    return {'instruction': prompt, 'input': '', 'output': response}
+
+
+def dataset_info_entry(name, formatting, task):
+    """与 converter.py::align_dataset 读取的列名一一对应的 dataset_info.json 条目。"""
+    if task == 'pt':
+        return {'file_name': name, 'columns': {'prompt': 'text'}}
+    if formatting == 'sharegpt':
+        return {'file_name': name, 'formatting': 'sharegpt', 'columns': {'messages': 'conversations'}}
+    return {'file_name': name, 'columns': {'prompt': 'instruction', 'query': 'input', 'response': 'output'}}
+
+
+# --- 3. 写出分片 ---
+def _write_shard(examples, path, file_format):
+    table = pa.Table.from_pylist(examples)
+    if file_format == 'parquet':
+        pq.write_table(table, path)
+    else:
+        # datasets 的 "arrow" 加载器读取 Arrow IPC 流格式，加载后直接内存映射
+        with pa.OSFile(path, 'wb') as sink, pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+
+
+def export_dataset(input_path, dataset_dir, name, formatting='alpaca', task='pt', file_format='parquet',
+                   shard_size=50000, prompt_chars=128):
+    """
+    把输入转换为分片数据集并注册到 dataset_info.json。
+    分片先写入临时目录，全部完成后再整体替换，避免 LLaMA-Factory 读到不完整的数据集。
+    :return: 导出的样本数
+    """
+    if task == 'pt' and formatting == 'sharegpt':
+        raise ValueError('预训练数据只支持 alpaca 格式（text 列）')
+    _check_dataset_name(dataset_dir, name)
+    output_dir = os.path.join(dataset_dir, name)
+    tmp_dir = output_dir + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    shard_paths, examples, total = [], [], 0
+    for text in tqdm(iter_texts(input_path), desc=f'exporting {name}', unit='sample'):
+        examples.append(to_example(text, formatting, task, prompt_chars))
+        if len(examples) >= shard_size:
+            shard_paths.append(os.path.join(tmp_dir, f'{len(shard_paths):05d}.{file_format}'))
+            _write_shard(examples, shard_paths[-1], file_format)
+            total += len(examples)
+            examples = []
+    if examples:
+        shard_paths.append(os.path.join(tmp_dir, f'{len(shard_paths):05d}.{file_format}'))
+        _write_shard(examples, shard_paths[-1], file_format)
+        total += len(examples)
+    if total == 0:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise ValueError(f'{input_path} 中没有可导出的文本，未写入也未注册 {name}')
+
+    # 分片统一命名为 <name>-00000-of-00003.<ext>
+    for i, path in enumerate(shard_paths):
+        os.rename(path, os.path.join(tmp_dir, f'{name}-{i:05d}-of-{len(shard_paths):05d}.{file_format}'))
+    shutil.rmtree(output_dir, ignore_errors=True)
+    os.replace(tmp_dir, output_dir)
+
+    register_dataset(dataset_dir, name, dataset_info_entry(name, formatting, task))
+    logger.info(f'Exported {total} samples to {output_dir} ({len(shard_paths)} {file_format} shards)')
+    return total
+
+
+def _check_dataset_name(dataset_dir, name):
+    """dataset_info.json 中已有同名条目且指向其他文件时拒绝覆盖（例如原有的 news_train_augmented.jsonl）。"""
+    info_path = os.path.join(dataset_dir, 'dataset_info.json')
+    if not os.path.exists(info_path):
+        return
+    with open(info_path, 'r', encoding='utf-8') as f:
+        entry = json.load(f).get(name)
+    if entry is not None and entry.get('file_name') != name:
+        raise ValueError(f"dataset_info.json 中的 {name} 已指向 {entry.get('file_name')}，请通过 --name 换一个名称")
+
+
+def register_dataset(dataset_dir, name, entry):
+    """写入（或覆盖）dataset_info.json 中的条目，保留其他条目。"""
+    info_path = os.path.join(dataset_dir, 'dataset_info.json')
+    dataset_info = {}
+    if os.path.exists(info_path):
+        with open(info_path, 'r', encoding='utf-8') as f:
+            dataset_info = json.load(f)
+    dataset_info[name] = entry
+    with open(info_path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(dataset_info, f, ensure_ascii=False, indent=2)
+        f.write('\n')
+    os.replace(info_path + '.tmp', info_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", default="/home/ruansikai/Limerence/assignments/LLM/augmented_data.jsonl",
+                        help=".txt 目录、JSONL/Parquet 文件或分片目录")
+    parser.add_argument("--dataset_dir", default="../LLaMA-Factory/data", help="LLaMA-Factory 的 dataset_dir")
+    parser.add_argument("--name", default="news_train_augmented_shards", help="dataset_info.json 中的数据集名称")
+    parser.add_argument("--formatting", choices=['alpaca', 'sharegpt'], default='alpaca')
+    parser.add_argument("--task", choices=['pt', 'sft'], default='pt', help="pt：text 列；sft：开头/续写两段")
+    parser.add_argument("--file_format", choices=['parquet', 'arrow'], default='parquet')
+    parser.add_argument("--shard_size", type=int, default=50000, help="每个分片的样本数")
+    parser.add_argument("--prompt_chars", type=int, default=128, help="sft 任务中作为新闻开头的字符数")
+
+    args = parser.parse_args()
+
+    export_dataset(args.input, args.dataset_dir, args.name, args.formatting, args.task, args.file_format,
+                   args.shard_size, args.prompt_chars)
@@ -1,38 +1,145 @@
 import os
-import os
-import shutil
 import json
+import time
+import fcntl
+import shutil
+import sqlite3
 import logging
 import argparse
-from tqdm import trange
+from tqdm import tqdm
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+FICLONE = 0x40049409  # Linux ioctl：在支持的文件系统（btrfs/xfs）上创建写时复制的 reflink
+# 汇总数据集的默认路径：jsonl 模式为单个文件，parquet 模式为分片目录
+DEFAULT_DATASET_PATHS = {
+    'jsonl': "/home/ruansikai/Limerence/assignments/LLM/augmented_data.jsonl",
+    'parquet': "/home/ruansikai/Limerence/assignments/LLM/augmented_data_parquet",
+}
+
+def remap_name(filename, new_id):
+    # cleaned_sample_31.txt -> cleaned_sample_<new_id>.txt
+    prefix_list = filename.split('_')
+    prefix_list[2] = f'{new_id}' + '.txt'
+    return '_'.join(prefix_list)
+
+def _max_mapped_id(mapping_path):
+    """从已有的 mapping 文件中找出最大编号，用于首次创建分配器时接上旧的编号。"""
+    max_id = 0
+    if os.path.exists(mapping_path):
+        with open(mapping_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    max_id = max(max_id, int(json.loads(line)['cur_name'].rsplit('_', 1)[-1].split('.')[0]))
+                except (ValueError, KeyError, IndexError, json.JSONDecodeError):
+                    continue
+    return max_id
+
+def allocate_ids(counter_path, n, initial=0):
+    """
+    原子地分配 n 个连续编号，返回第一个编号。
+    计数器保存在 SQLite 中，BEGIN IMMEDIATE 保证并发运行的多个 remapping 不会拿到重叠的编号。
+    """
+    conn = sqlite3.connect(counter_path, timeout=60, isolation_level=None)
+    try:
+        conn.execute('CREATE TABLE IF NOT EXISTS counter (name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+        conn.execute('BEGIN IMMEDIATE')
+        row = conn.execute("SELECT value FROM counter WHERE name = 'sample'").fetchone()
+        start = (row[0] if row else initial) + 1
+        conn.execute("INSERT OR REPLACE INTO counter VALUES ('sample', ?)", (start + n - 1,))
+        conn.execute('COMMIT')
+    finally:
+        conn.close()
+    return start
+
+def append_locked(path, lines):
+    """持有排他锁一次性追加多行，多个进程同时写同一文件时各自的内容不会交错。"""
+    with open(path, 'a', encoding='utf-8') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.write(''.join(lines))
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def reflink_or_copy(src, dst):
+    """优先使用 reflink（不复制数据块），文件系统不支持时退化为普通复制。"""
+    try:
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        return True
+    except OSError:
+        shutil.copy(src, dst)
+        return False
+
+def link_files(orin_dir, output_dir, pairs, mode):
+    """copy / hardlink / reflink 模式：仍然为每个样本生成单独的文件。"""
+    os.makedirs(output_dir, exist_ok=True)
+    fallback = 0
+    for filename, output_name in tqdm(pairs, desc=mode, unit="file"):
+        orin_path = os.path.join(orin_dir, filename)
+        output_path = os.path.join(output_dir, output_name)
+        if mode == 'hardlink':
+            try:
+                os.link(orin_path, output_path)
+                continue
+            except OSError:
+                fallback += 1
+                shutil.copy(orin_path, output_path)
+        elif mode == 'reflink':
+            fallback += not reflink_or_copy(orin_path, output_path)
+        else:
+            shutil.copy(orin_path, output_path)
+    if fallback:
+        logger.warning(f'{fallback} files could not be {mode}ed and were copied instead')
+
+def write_dataset(orin_dir, dataset_path, records, mode):
+    """
+    汇总模式：把全部样本的文本读出后一次顺序写入。
+    - jsonl：加锁追加到 dataset_path
+    - parquet：dataset_path 为目录，每次运行写一个分片（先写临时文件再原子重命名）
+    """
+    for record in tqdm(records, desc="reading", unit="file"):
+        with open(os.path.join(orin_dir, record['orin_name']), 'r', encoding='utf-8') as f:
+            record['text'] = f.read()
+    if mode == 'jsonl':
+        append_locked(dataset_path, [json.dumps(record, ensure_ascii=False) + '\n' for record in records])
+        return dataset_path
+    import pandas as pd
+    os.makedirs(dataset_path, exist_ok=True)
+    part_path = os.path.join(dataset_path, f"part-{records[0]['method']}-{records[0]['id']:08d}.parquet")
+    pd.DataFrame(records).to_parquet(part_path + '.tmp', index=False)
+    os.replace(part_path + '.tmp', part_path)
+    return part_path
+
 def main(args):
     if os.path.isdir(args.orin_dir):
-        orin_list = os.listdir(args.orin_dir)
-        output_list = os.listdir(args.output_dir)
-        output_count = len(output_list)
-        
-        with open(args.mapping_path, 'a+', encoding='utf-8') as mp:
-            for i, filename in enumerate(orin_list):
-                orin_path = os.path.join(args.orin_dir, filename)
-                # cleaned_sample_31.txt
-                prefix_list = filename.split('_')
-                prefix_list[2] = f'{output_count + i + 1}' + '.txt'
-                output_name = '_'.join(prefix_list)
-                output_path = os.path.join(args.output_dir, output_name)
-                shutil.copy(orin_path, output_path)
-                new_dict = {
-                    "cur_name": output_name,
-                    "orin_name": filename,
-                    "method": args.method
-                }
-                data = json.dumps(new_dict)
-                mp.write(data)
-                mp.write('\n')
-        
+        orin_list = sorted(os.listdir(args.orin_dir))
+        if not orin_list:
+            logger.info('Nothing to remap')
+            return
+        counter_path = args.counter_path or args.mapping_path + '.ids.sqlite'
+        initial = 0 if os.path.exists(counter_path) else _max_mapped_id(args.mapping_path)
+        first_id = allocate_ids(counter_path, len(orin_list), initial)
+
+        records = [{
+            "id": first_id + i,
+            "cur_name": remap_name(filename, first_id + i),
+            "orin_name": filename,
+            "method": args.method
+        } for i, filename in enumerate(orin_list)]
+
+        if args.mode in ('jsonl', 'parquet'):
+            target = write_dataset(args.orin_dir, args.dataset_path, records, args.mode)
+            logger.info(f'Wrote {len(records)} samples ({args.method}) to {target}')
+        else:
+            link_files(args.orin_dir, args.output_dir, [(r['orin_name'], r['cur_name']) for r in records], args.mode)
+
+        mapping = [{"cur_name": r['cur_name'], "orin_name": r['orin_name'], "method": r['method']} for r in records]
+        append_locked(args.mapping_path, [json.dumps(m) + '\n' for m in mapping])
+        logger.info(f'Allocated ids {first_id}-{first_id + len(records) - 1} for {args.method}')
     else:
         logging.warning('Please enter the existing oringinal dataset dir')
 
@@ -40,10 +147,20 @@ def main(args):
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--orin_dir", default="/home/ruansikai/Limerence/assignments/LLM/translate")
-    parser.add_argument("--output_dir", default="/home/ruansikai/Limerence/assignments/LLM/augmented_data")
+    parser.add_argument("--output_dir", default="/home/ruansikai/Limerence/assignments/LLM/augmented_data",
+                        help="copy / hardlink / reflink 模式下的输出目录")
     parser.add_argument("--method", choices=['translate', 'replace', 'regenerate', 'structure'])
     parser.add_argument("--mapping_path", default="/home/ruansikai/Limerence/assignments/LLM/mapping.jsonl")
-    
+    parser.add_argument("--mode", choices=['jsonl', 'parquet', 'copy', 'hardlink', 'reflink'], default='jsonl',
+                        help="jsonl/parquet：写入汇总数据集；copy/hardlink/reflink：逐个生成文件")
+    parser.add_argument("--dataset_path", default=None,
+                        help="汇总数据集路径（parquet 模式下为目录），默认按 --mode 选择 augmented_data.jsonl 或 augmented_data_parquet")
+    parser.add_argument("--counter_path", default=None, help="编号分配器 SQLite 路径，默认为 <mapping_path>.ids.sqlite")
+
     args = parser.parse_args()
-    
-    main(args)
\ No newline at end of file
+    if args.dataset_path is None:
+        args.dataset_path = DEFAULT_DATASET_PATHS.get(args.mode)
+    elif args.mode == 'parquet' and args.dataset_path.endswith('.jsonl'):
+        parser.error("--mode parquet 需要目录形式的 --dataset_path，不能以 .jsonl 结尾")
+
+    main(args)
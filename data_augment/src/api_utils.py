@@ -0,0 +1,133 @@
+import os
+import time
+import random
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from tqdm import tqdm
+from openai import OpenAI, APIConnectionError, APIStatusError, APITimeoutError, RateLimitError
+
+logger = logging.getLogger(__name__)
+
+_clients = {}
+_limiters = {}
+_lock = threading.Lock()
+
+
+def get_client(api: str, base_url: str):
+    """
+    每个 provider 共享一个 OpenAI 客户端（内部复用 HTTP 连接池），避免每次请求都重新建立连接。
+    api key 从环境变量 {API}_APIKEY 读取。
+    """
+    key = (api, base_url)
+    with _lock:
+        if key not in _clients:
+            _clients[key] = OpenAI(api_key=os.getenv(f"{api.upper()}_APIKEY"), base_url=base_url)
+        return _clients[key]
+
+
+def usage_to_dict(*responses):
+    """汇总一个或多个 chat.completions 响应的 token 用量。"""
+    usage = {'prompt_tokens': 0, 'completion_tokens': 0}
+    for response in responses:
+        if getattr(response, 'usage', None) is not None:
+            usage['prompt_tokens'] += response.usage.prompt_tokens or 0
+            usage['completion_tokens'] += response.usage.completion_tokens or 0
+    return usage
+
+
+class TokenBucket():
+    """
+    令牌桶限流：平均每秒 rate 个请求，允许 burst 个请求的突发。线程安全。
+    """
+    def __init__(self, rate: float, burst: int = None):
+        self.rate = rate
+        self.capacity = burst if burst is not None else max(1, int(rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+
+def get_rate_limiter(provider: str, rate: float):
+    """每个 provider 一个令牌桶，rate <= 0 表示不限流。"""
+    if rate is None or rate <= 0:
+        return None
+    with _lock:
+        if provider not in _limiters:
+            _limiters[provider] = TokenBucket(rate)
+        return _limiters[provider]
+
+
+def is_retryable(err):
+    """只有限流、超时、连接错误和 5xx 值得重试；鉴权失败、参数错误等重试也不会成功。"""
+    if isinstance(err, (RateLimitError, APITimeoutError, APIConnectionError, TimeoutError, ConnectionError)):
+        return True
+    if isinstance(err, APIStatusError):
+        return err.status_code in (408, 409, 429) or err.status_code >= 500
+    return False
+
+
+def call_with_retry(fn, *args, limiter=None, max_retries=5, base_delay=1.0, max_delay=60.0, **kwargs):
+    """
+    调用 fn，失败时按指数退避（带随机抖动）重试；每次尝试前先从限流器获取令牌。
+    超过 max_retries 次仍失败、或错误不可重试（见 is_retryable）时抛出异常。
+    """
+    for attempt in range(max_retries + 1):
+        if limiter is not None:
+            limiter.acquire()
+        try:
+            return fn(*args, **kwargs)
+        except Exception as err:
+            if attempt == max_retries or not is_retryable(err):
+                raise
+            delay = min(max_delay, base_delay * (2 ** attempt)) * (0.5 + random.random() / 2)
+            logger.warning(f"{getattr(fn, '__name__', fn)} failed ({err}), retry {attempt + 1}/{max_retries} in {delay:.1f}s")
+            time.sleep(delay)
+
+
+def run_concurrent(fn, items, concurrency=8, on_result=None, on_error=None, desc=None):
+    """
+    用线程池并发执行 fn(item)，最多 concurrency 个请求同时在途。
+    每个任务完成后立即在主线程回调 on_result(item, result) / on_error(item, err)，
+    因此结果可以边完成边落盘，中途崩溃不会丢失已完成的部分。
+    """
+    items = iter(items)
+    pending = {}
+    with ThreadPoolExecutor(max_workers=concurrency) as executor, tqdm(desc=desc, unit="sample") as pbar:
+        def submit_next():
+            for item in items:
+                pending[executor.submit(fn, item)] = item
+                return True
+            return False
+
+        for _ in range(concurrency):
+            if not submit_next():
+                break
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                item = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as err:
+                    if on_error is not None:
+                        on_error(item, err)
+                    else:
+                        logger.error(f"{item}: {err}")
+                else:
+                    if on_result is not None:
+                        on_result(item, result)
+                pbar.update(1)
+                submit_next()
@@ -0,0 +1,192 @@
+import time
+import sqlite3
+import threading
+
+TERMINAL_STATUS = ('done', 'rejected')
+
+
+class JobLedger():
+    """
+    增强任务台账（SQLite，WAL 模式），主键为 (输入文件名, 增强方法, 模型)。
+    每条样本完成或失败后立即提交，进程崩溃后重新运行即可从断点继续。
+    status:
+        done     - 已生成并写入输出目录
+        rejected - 已处理但结果被过滤（如回译相似度过低），不再重试
+        failed   - 重试后仍失败，可用 --retry_failed 单独重跑
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        # 多个 worker 进程共享同一个台账文件，写锁冲突时最多等待 timeout 秒
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                path TEXT NOT NULL,
+                method TEXT NOT NULL,
+                model TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                latency REAL,
+                prompt_tokens INTEGER,
+                completion_tokens INTEGER,
+                error TEXT,
+                updated_at REAL,
+                PRIMARY KEY (path, method, model)
+            )
+        ''')
+        # 待处理队列：协调进程写入，worker 通过 claim 领取；worker 字段为空表示尚未被领取
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS queue (
+                path TEXT NOT NULL,
+                method TEXT NOT NULL,
+                model TEXT NOT NULL,
+                worker TEXT,
+                lease_until REAL,
+                PRIMARY KEY (path, method, model)
+            )
+        ''')
+        self.conn.commit()
+
+    def record(self, path, method, model, status, latency=None, usage=None, error=None):
+        usage = usage or {}
+        with self.lock:
+            self.conn.execute('''
+                INSERT INTO jobs (path, method, model, status, attempts, latency, prompt_tokens, completion_tokens, error, updated_at)
+                VALUES (?, ?, ?, ?, 1, ?, ?, ?, ?, ?)
+                ON CONFLICT (path, method, model) DO UPDATE SET
+                    status = excluded.status,
+                    attempts = jobs.attempts + 1,
+                    latency = excluded.latency,
+                    prompt_tokens = excluded.prompt_tokens,
+                    completion_tokens = excluded.completion_tokens,
+                    error = excluded.error,
+                    updated_at = excluded.updated_at
+            ''', (path, method, model, status, latency, usage.get('prompt_tokens'),
+                  usage.get('completion_tokens'), error, time.time()))
+            self.conn.commit()
+
+    def paths_with_status(self, method, model, statuses):
+        """返回指定状态的文件名集合，用于 O(1) 的跳过判断。"""
+        placeholders = ','.join('?' * len(statuses))
+        with self.lock:
+            rows = self.conn.execute(
+                f'SELECT path FROM jobs WHERE method = ? AND model = ? AND status IN ({placeholders})',
+                (method, model, *statuses)
+            ).fetchall()
+        return {row[0] for row in rows}
+
+    def finished_paths(self, method, model):
+        return self.paths_with_status(method, model, TERMINAL_STATUS)
+
+    def failed_paths(self, method, model):
+        return self.paths_with_status(method, model, ('failed',))
+
+    def bootstrap(self, paths, method, model):
+        """
+        兼容旧的输出目录：台账中还没有该任务的记录时，把输出目录中已存在的文件登记为 done。
+        """
+        with self.lock:
+            exists = self.conn.execute(
+                'SELECT 1 FROM jobs WHERE method = ? AND model = ? LIMIT 1', (method, model)
+            ).fetchone()
+            if exists:
+                return 0
+            now = time.time()
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO jobs (path, method, model, status, updated_at) VALUES (?, ?, ?, ?, ?)',
+                [(path, method, model, 'done', now) for path in paths]
+            )
+            self.conn.commit()
+        return len(paths)
+
+    def unfinished(self, paths, method, model):
+        """从 paths 中去掉已经处于终态的文件名（如崩溃的 worker 已处理了一部分）。"""
+        finished = set()
+        with self.lock:
+            for i in range(0, len(paths), 500):
+                batch = paths[i:i + 500]
+                placeholders = ','.join('?' * len(batch))
+                rows = self.conn.execute(
+                    f'SELECT path FROM jobs WHERE method = ? AND model = ? AND status IN (?, ?) AND path IN ({placeholders})',
+                    (method, model, *TERMINAL_STATUS, *batch)
+                ).fetchall()
+                finished.update(row[0] for row in rows)
+        return [path for path in paths if path not in finished]
+
+    def enqueue(self, paths, method, model):
+        """
+        重建 (方法, 模型) 的待处理队列。调用时不应有 worker 在运行，因此旧的领取记录一并清空。
+        :return: 队列长度
+        """
+        with self.lock:
+            self.conn.execute('DELETE FROM queue WHERE method = ? AND model = ?', (method, model))
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO queue (path, method, model) VALUES (?, ?, ?)',
+                [(path, method, model) for path in paths]
+            )
+            self.conn.commit()
+        return len(paths)
+
+    def claim(self, worker, method, model, n, lease=3600):
+        """
+        原子地领取最多 n 个未被领取（或租约已过期）的文件名。
+        BEGIN IMMEDIATE 保证多个进程不会领到同一个文件。
+        """
+        now = time.time()
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                rows = self.conn.execute('''
+                    SELECT path FROM queue WHERE method = ? AND model = ?
+                    AND (worker IS NULL OR lease_until < ?) LIMIT ?
+                ''', (method, model, now, n)).fetchall()
+                paths = [row[0] for row in rows]
+                self.conn.executemany(
+                    'UPDATE queue SET worker = ?, lease_until = ? WHERE path = ? AND method = ? AND model = ?',
+                    [(worker, now + lease, path, method, model) for path in paths]
+                )
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+        return paths
+
+    def complete(self, paths, method, model):
+        """处理完毕（无论成功与否，结果已写入 jobs）后从队列中移除。"""
+        with self.lock:
+            self.conn.executemany('DELETE FROM queue WHERE path = ? AND method = ? AND model = ?',
+                                  [(path, method, model) for path in paths])
+            self.conn.commit()
+
+    def release_worker(self, worker):
+        """worker 异常退出时归还它领取但未完成的文件，供其他 worker 重新领取。"""
+        with self.lock:
+            released = self.conn.execute(
+                'UPDATE queue SET worker = NULL, lease_until = NULL WHERE worker = ?', (worker,)
+            ).rowcount
+            self.conn.commit()
+        return released
+
+    def pending_count(self, method, model):
+        with self.lock:
+            return self.conn.execute(
+                'SELECT COUNT(*) FROM queue WHERE method = ? AND model = ?', (method, model)
+            ).fetchone()[0]
+
+    def summary(self, method, model):
+        with self.lock:
+            rows = self.conn.execute('''
+                SELECT status, COUNT(*), AVG(latency), SUM(prompt_tokens), SUM(completion_tokens)
+                FROM jobs WHERE method = ? AND model = ? GROUP BY status
+            ''', (method, model)).fetchall()
+        return {
+            status: {'count': count, 'avg_latency': avg_latency,
+                     'prompt_tokens': prompt_tokens or 0, 'completion_tokens': completion_tokens or 0}
+            for status, count, avg_latency, prompt_tokens, completion_tokens in rows
+        }
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -2,7 +2,7 @@
 import os
 import random
 from tqdm import trange
-from openai import OpenAI
+from .api_utils import get_client, usage_to_dict
 
 base_setting = {
     'qwen': {
@@ -61,14 +61,8 @@ def build_rewrite_prompt(title, content):
     """
     return prompt
 
-def regenerate(title: str, content: str, api: str):
-    api_upper = f"{api.upper()}_APIKEY"
-    api_key = os.getenv(api_upper)
-    client = OpenAI(
-        # api_key = 'sk-4d4a7ad014a74ed4a9ce15628bfaa347',
-        api_key = api_key,
-        base_url=base_setting[api]['url']
-    )
+def regenerate(title: str, content: str, api: str, with_usage: bool = False):
+    client = get_client(api, base_setting[api]['url'])
     
     prompt = build_rewrite_prompt(title, content)
     
@@ -80,4 +74,6 @@ def regenerate(title: str, content: str, api: str):
     )
     result = response.choices[0].message.content
     
+    if with_usage:
+        return result, usage_to_dict(response)
     return result
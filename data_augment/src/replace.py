@@ -1,4 +1,7 @@
 import os
+import json
+import pickle
+import hashlib
 import jieba
 import numpy as np
 from tqdm import tqdm
@@ -7,8 +10,14 @@ from gensim.models import KeyedVectors, TfidfModel
 from gensim.corpora import Dictionary
 from gensim import matutils
 from itertools import islice
+from multiprocessing import Pool
 
 wv_path = '/home/ruansikai/Limerence/assignments/LLM/src/tfidf_word2vec/tecent-200d/light_Tencent_AILab_ChineseEmbedding.bin'
+# 近义词表（语料词 -> 词向量空间中的 top-k 近邻），与 tfidf.model 放在同一目录
+synonym_path = '/home/ruansikai/Limerence/assignments/LLM/src/tfidf_word2vec/synonyms.json'
+# 分词结果缓存目录，文件名为输入文本的哈希
+token_cache_dir = '/home/ruansikai/Limerence/assignments/LLM/src/tfidf_word2vec/token_cache'
+num_workers = os.cpu_count() or 1
 
 def isChinese(word):
     """是否为中文字符
@@ -20,24 +29,141 @@ def isChinese(word):
             return True
     return False
 
+def corpus_hash(samples):
+    """对输入文本整体计算哈希，作为分词缓存的键。"""
+    h = hashlib.sha1()
+    for sample in samples:
+        h.update(sample.encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+def _chunks(items, n_chunks):
+    size = max(1, (len(items) + n_chunks - 1) // n_chunks)
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+def _lcut(text):
+    return jieba.lcut(text)
+
+def tokenize_corpus(samples, workers=num_workers, cache_dir=token_cache_dir):
+    """
+    多进程 jieba 分词，并按输入哈希缓存结果；对同一份清洗数据重复运行时直接读取缓存。
+    :return: 每条样本的 token 列表
+    """
+    cache_path = os.path.join(cache_dir, f'{corpus_hash(samples)}.pkl')
+    if os.path.exists(cache_path):
+        with open(cache_path, 'rb') as f:
+            return pickle.load(f)
+
+    if workers > 1 and len(samples) > workers:
+        with Pool(workers) as pool:
+            tokens = list(tqdm(pool.imap(_lcut, samples, chunksize=64), total=len(samples), desc='tokenizing'))
+    else:
+        tokens = [jieba.lcut(sample) for sample in samples]
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = cache_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(tokens, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, cache_path)
+    return tokens
+
+_shared_dct = None
+
+def _init_doc2bow(dct):
+    global _shared_dct
+    _shared_dct = dct
+
+def _doc2bow_chunk(docs):
+    return [_shared_dct.doc2bow(doc) for doc in docs]
+
+def build_dictionary(docs, workers=num_workers):
+    """每个进程为一个分片构建 Dictionary，再依次 merge（文档频率与文档数会一并合并）。"""
+    if workers <= 1 or len(docs) <= workers:
+        return Dictionary(docs)
+    with Pool(workers) as pool:
+        shards = pool.map(Dictionary, _chunks(docs, workers))
+    dct = shards[0]
+    for shard in shards[1:]:
+        dct.merge_with(shard)
+    return dct
+
+def docs2bow(dct, docs, workers=num_workers):
+    """分块并行计算词袋表示。"""
+    if workers <= 1 or len(docs) <= workers:
+        return [dct.doc2bow(doc) for doc in docs]
+    with Pool(workers, initializer=_init_doc2bow, initargs=(dct,)) as pool:
+        chunks = pool.map(_doc2bow_chunk, _chunks(docs, workers * 4))
+    return [bow for chunk in chunks for bow in chunk]
+
 class EmbedReplace():
-    def __init__(self, samples):
-        self.samples = samples
-        self.samples = [list(jieba.cut(sample)) for sample in self.samples]
-        self.wv = KeyedVectors.load_word2vec_format(wv_path, binary=True)
+    def __init__(self, samples, workers=num_workers):
+        self.samples = tokenize_corpus(samples, workers)
+        self._wv = None
 
         if os.path.exists('/home/ruansikai/Limerence/assignments/LLM/src/tfidf_word2vec/tfidf.model'):
             self.tfidf_model = TfidfModel.load('/home/ruansikai/Limerence/assignments/LLM/src/tfidf_word2vec/tfidf.model')
             self.dct = Dictionary.load('/home/ruansikai/Limerence/assignments/LLM/src/tfidf_word2vec/tfidf.dict')
-            self.corpus = [self.dct.doc2bow(doc) for doc in self.samples]
+            self.corpus = docs2bow(self.dct, self.samples, workers)
         else:
-            self.dct = Dictionary(self.samples)
-            self.corpus = [self.dct.doc2bow(doc) for doc in self.samples]
-            self.tfidf_model = TfidfModel(self.corpus)
+            self.dct = build_dictionary(self.samples, workers)
+            self.corpus = docs2bow(self.dct, self.samples, workers)
+            # idf 只依赖文档频率和文档数，直接由合并后的词典构建
+            self.tfidf_model = TfidfModel(dictionary=self.dct)
             self.dct.save('/home/ruansikai/Limerence/assignments/LLM/src/tfidf_word2vec/tfidf.dict')
             self.tfidf_model.save('/home/ruansikai/Limerence/assignments/LLM/src/tfidf_word2vec/tfidf.model')
             self.vocab_size = len(self.dct.token2id)
 
+        self.synonyms = self.build_synonym_index()
+
+    @property
+    def wv(self):
+        """词向量只在近义词表缺词时才加载。"""
+        if self._wv is None:
+            self._wv = KeyedVectors.load_word2vec_format(wv_path, binary=True)
+        return self._wv
+
+    def build_synonym_index(self, topk=5, path=synonym_path, memory_budget=1 << 28):
+        """
+        预先计算语料中所有中文词的 top-k 近义词并缓存到磁盘。
+        在归一化后的词向量矩阵上分批做矩阵乘法，结果与逐词调用 most_similar 相同，
+        但每个词只计算一次；已缓存的词直接复用（不在词表中的词记为空列表）。
+        :param memory_budget: 单批相似度矩阵占用的字节数上限
+        :return: {词: [近义词, ...]}
+        """
+        synonyms = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                synonyms = json.load(f)
+
+        vocab = {token for sample in self.samples for token in sample}
+        missing = sorted(t for t in vocab if t not in synonyms and isChinese(t))
+        if not missing:
+            return synonyms
+
+        for token in missing:
+            if token not in self.wv:
+                synonyms[token] = []
+        missing = [t for t in missing if synonyms.get(t) is None]
+
+        normed = self.wv.get_normed_vectors()
+        batch_size = max(1, memory_budget // (normed.shape[0] * normed.itemsize))
+        for start in tqdm(range(0, len(missing), batch_size), desc='building synonym index'):
+            batch = missing[start:start + batch_size]
+            indexes = np.array([self.wv.key_to_index[t] for t in batch])
+            sims = normed[indexes] @ normed.T
+            sims[np.arange(len(batch)), indexes] = -np.inf  # 排除词本身
+            top = np.argpartition(-sims, topk, axis=1)[:, :topk]
+            order = np.argsort(-np.take_along_axis(sims, top, axis=1), axis=1)
+            top = np.take_along_axis(top, order, axis=1)
+            for token, neighbours in zip(batch, top):
+                synonyms[token] = [self.wv.index_to_key[i] for i in neighbours]
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(synonyms, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        return synonyms
+
     def vectorize(self, docs, vocab_size):
         return matutils.corpus2dense(docs, vocab_size)
 
@@ -67,8 +193,8 @@ class EmbedReplace():
         indexes = np.random.choice(len(sample), num)
         for index in indexes:
             token = sample[index]
-            if isChinese(token) and token not in keywords and token in self.wv:
-                new_tokens[index] = self.wv.most_similar(positive=token, negative=None, topn=1)[0][0]
+            if token not in keywords and self.synonyms.get(token):
+                new_tokens[index] = self.synonyms[token][0]
 
         return ''.join(new_tokens)
 
@@ -1,11 +1,10 @@
 import os
-from openai import OpenAI
+from .api_utils import get_client, usage_to_dict
 
-# 从环境变量中获取您的API KEY，配置方法见：https://www.volcengine.com/docs/82379/1399008
-# api_key = os.getenv('ARK_API_KEY')
-api_key = os.getenv('DOUBAO_APIKEY')
+# 从环境变量 DOUBAO_APIKEY 中获取您的API KEY，配置方法见：https://www.volcengine.com/docs/82379/1399008
+ARK_BASE_URL = "https://ark.cn-beijing.volces.com/api/v3"
 
-def structure(title: str, body: str, model: str):
+def structure(title: str, body: str, model: str, with_usage: bool = False):
     news_length = len(body)
     prompt_structure = f'''
     你是一名信息抽取系统，负责从中文新闻文本中提取结构化事实信息。
@@ -35,10 +34,7 @@ def structure(title: str, body: str, model: str):
     {body}
     '''
     
-    client = OpenAI(
-        base_url="https://ark.cn-beijing.volces.com/api/v3",
-        api_key=api_key,
-    )
+    client = get_client('doubao', ARK_BASE_URL)
 
     structure = client.chat.completions.create(
         model=model,
@@ -92,6 +88,8 @@ def structure(title: str, body: str, model: str):
         ]
     )
 
+    if with_usage:
+        return rewrite.choices[0].message.content, usage_to_dict(structure, rewrite)
     return rewrite.choices[0].message.content
 
 if __name__ == "__main__":
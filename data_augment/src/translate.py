@@ -9,6 +9,7 @@ import random
 import json
 import hashlib
 import urllib
+from functools import lru_cache
 from sentence_transformers import SentenceTransformer, util
 
 from tencentcloud.common import credential
@@ -22,9 +23,27 @@ from alibabacloud_tea_openapi import models as open_api_models
 from alibabacloud_alimt20181012 import models as alimt_20181012_models
 from alibabacloud_tea_util import models as util_models
 
+from .api_utils import get_rate_limiter
+
 threshold = 0.8
 
-def aliyun_translate(q, src_lang="zh", tgt_lang="en"):
+
+class TranslationError(Exception):
+    """翻译服务调用失败（网络、限额、SDK 异常等），与"相似度低于阈值"不同，应记为 failed 以便重试。"""
+
+
+similarity_model_name = 'shibing624/text2vec-base-chinese'
+
+# 各翻译服务的批量限制与限流（QPS），按账号套餐调整；百度的长度限制按 UTF-8 字节计（汉字约 3 字节）
+provider_limits = {
+    'tencent': {'max_items': 50, 'max_chars': 6000, 'qps': 5},
+    'baidu': {'max_items': 50, 'max_bytes': 6000, 'qps': 10},
+    'aliyun': {'max_items': 50, 'max_chars': 8000, 'qps': 50},
+    'local': {'max_items': 1024, 'max_chars': 10 ** 9, 'qps': 0},
+}
+
+@lru_cache(maxsize=None)
+def aliyun_client():
     ACCESS_KEY_ID = 'Access_key_id'
     ACCESS_KEY_SECRET = 'Access_key_secret'
 
@@ -33,7 +52,11 @@ def aliyun_translate(q, src_lang="zh", tgt_lang="en"):
         access_key_secret=ACCESS_KEY_SECRET
     )
     config.endpoint = f'mt.cn-hangzhou.aliyuncs.com'
-    client = alimt20181012Client(config)
+    return alimt20181012Client(config)
+
+
+def aliyun_translate(q, src_lang="zh", tgt_lang="en"):
+    client = aliyun_client()
 
     translate_general_request = alimt_20181012_models.TranslateGeneralRequest(
         format_type = 'text',
@@ -47,22 +70,45 @@ def aliyun_translate(q, src_lang="zh", tgt_lang="en"):
     return resp.body.data.__dict__['translated']
 
 
+def aliyun_translate_batch(q_list, src_lang="zh", tgt_lang="en"):
+    client = aliyun_client()
+    request = alimt_20181012_models.GetBatchTranslateRequest(
+        api_type = 'translate_standard',
+        format_type = 'text',
+        source_language = src_lang,
+        target_language = tgt_lang,
+        source_text = json.dumps({str(i): q for i, q in enumerate(q_list)}, ensure_ascii=False),
+        scene = 'general'
+    )
+    runtime = util_models.RuntimeOptions()
+    resp = client.get_batch_translate_with_options(request, runtime)
+    results = [None] * len(q_list)
+    for item in resp.body.translated_list:
+        results[int(item['index'])] = item.get('translated')
+    return results
+
+
+@lru_cache(maxsize=None)
+def tencent_client():
+    SecretId = 'SecretId'
+    SecretKey = 'SecretKey'
+    cred = credential.Credential(SecretId, SecretKey)
+    # 使用临时密钥示例
+    # cred = credential.Credential("SecretId", "SecretKey", "Token")
+    # 实例化一个http选项，可选的，没有特殊需求可以跳过
+    httpProfile = HttpProfile()
+    httpProfile.endpoint = "tmt.tencentcloudapi.com"
+
+    # 实例化一个client选项，可选的，没有特殊需求可以跳过
+    clientProfile = ClientProfile()
+    clientProfile.httpProfile = httpProfile
+    # 实例化要请求产品的client对象,clientProfile是可选的
+    return tmt_client.TmtClient(cred, "ap-beijing", clientProfile)
+
+
 def tencent_translate(q, src_lang="zh", tgt_lang="en"):
     try:
-        SecretId = 'SecretId'
-        SecretKey = 'SecretKey'
-        cred = credential.Credential(SecretId, SecretKey)
-        # 使用临时密钥示例
-        # cred = credential.Credential("SecretId", "SecretKey", "Token")
-        # 实例化一个http选项，可选的，没有特殊需求可以跳过
-        httpProfile = HttpProfile()
-        httpProfile.endpoint = "tmt.tencentcloudapi.com"
-
-        # 实例化一个client选项，可选的，没有特殊需求可以跳过
-        clientProfile = ClientProfile()
-        clientProfile.httpProfile = httpProfile
-        # 实例化要请求产品的client对象,clientProfile是可选的
-        client = tmt_client.TmtClient(cred, "ap-beijing", clientProfile)
+        client = tencent_client()
 
         # 实例化一个请求对象,每个接口都会对应一个request对象
         req = models.TextTranslateRequest()
@@ -81,8 +127,27 @@ def tencent_translate(q, src_lang="zh", tgt_lang="en"):
 
     except TencentCloudSDKException as err:
         print(err)
-        
-def baidu_translate(q, src_lang="zh", tgt_lang="en"):
+
+
+def tencent_translate_batch(q_list, src_lang="zh", tgt_lang="en"):
+    try:
+        client = tencent_client()
+        req = models.TextTranslateBatchRequest()
+        params = {
+            "SourceTextList": q_list,
+            "Source": src_lang,
+            "Target": tgt_lang,
+            "ProjectId": 0
+        }
+        req.from_json_string(json.dumps(params))
+        resp = client.TextTranslateBatch(req)
+        return list(resp.TargetTextList)
+
+    except TencentCloudSDKException as err:
+        raise TranslationError(f'tencent: {err}') from err
+
+
+def baidu_translate(q, src_lang="zh", tgt_lang="en", return_all=False):
     appid = os.getenv('BAIDU_APPID')
     secretKey = os.getenv('SECRET_KEY')
 
@@ -102,6 +167,8 @@ def baidu_translate(q, src_lang="zh", tgt_lang="en"):
         result_all = response.read().decode("utf-8")
         result = json.loads(result_all)
 
+        if return_all:
+            return result['trans_result']
         return result['trans_result'][0]['dst']
 
     except Exception as e:
@@ -111,18 +178,114 @@ def baidu_translate(q, src_lang="zh", tgt_lang="en"):
             httpClient.close()
     
 
-def cosine_simalarity(source, target):
-    model = SentenceTransformer('shibing624/text2vec-base-chinese')
+def baidu_translate_batch(q_list, src_lang="zh", tgt_lang="en"):
+    """百度接口按换行拆分多段文本，一次请求可翻译多条。"""
+    q_list = [q.replace('\n', ' ') for q in q_list]
+    joined = baidu_translate('\n'.join(q_list), src_lang, tgt_lang, return_all=True)
+    if joined is None or len(joined) != len(q_list):
+        raise TranslationError(f'baidu: expected {len(q_list)} translations, got {None if joined is None else len(joined)}')
+    return [item['dst'] for item in joined]
+
+
+def local_translate_batch(q_list, src_lang="zh", tgt_lang="en"):
+    """离线替身翻译器：原样返回文本，用于在没有翻译 API 时测试整条流水线。"""
+    return list(q_list)
+
+
+batch_translators = {
+    'tencent': tencent_translate_batch,
+    'baidu': baidu_translate_batch,
+    'aliyun': aliyun_translate_batch,
+    'local': local_translate_batch,
+}
+
+
+@lru_cache(maxsize=None)
+def similarity_model():
+    """句向量模型只加载一次。"""
+    return SentenceTransformer(similarity_model_name)
+
+
+def similarity_scores(sources, targets, batch_size=64):
+    """对整批 (原文, 回译) 计算余弦相似度，每侧只调用一次 encode。"""
+    model = similarity_model()
+    emb1 = model.encode(sources, batch_size=batch_size, convert_to_tensor=True)
+    emb2 = model.encode(targets, batch_size=batch_size, convert_to_tensor=True)
+    return util.pairwise_cos_sim(emb1, emb2).tolist()
 
-    emb1 = model.encode(source, convert_to_tensor=True)
-    emb2 = model.encode(target, convert_to_tensor=True)
-    similarity = util.cos_sim(emb1, emb2).item()
-    similarity = round(similarity, 4)  
+
+def cosine_simalarity(source, target):
+    similarity = round(similarity_scores([source], [target])[0], 4)
     
     if similarity < threshold:
         return None
     else:
         return target
+
+
+def make_batches(texts, max_items, max_chars=None, max_bytes=None):
+    """按条数和总长度（max_chars 按字符、max_bytes 按 UTF-8 字节）切分批次，返回下标列表。"""
+    if max_bytes is not None:
+        max_size, size_of = max_bytes, lambda text: len(text.encode('utf-8'))
+    else:
+        max_size, size_of = max_chars, len
+    batches, current, current_size = [], [], 0
+    for i, text in enumerate(texts):
+        text_size = size_of(text)
+        if current and (len(current) >= max_items or current_size + text_size > max_size):
+            batches.append(current)
+            current, current_size = [], 0
+        current.append(i)
+        current_size += text_size
+    if current:
+        batches.append(current)
+    return batches
+
+
+def translate_batch(texts, api, src_lang, tgt_lang):
+    """
+    按服务商的批量限制分批调用，并用令牌桶限流代替固定 sleep。
+    某一批调用失败时只影响该批，对应位置为 TranslationError 实例。
+    """
+    limits = provider_limits[api]
+    limiter = get_rate_limiter(api, limits['qps'])
+    results = [None] * len(texts)
+    for batch in make_batches(texts, limits['max_items'], limits.get('max_chars'), limits.get('max_bytes')):
+        if limiter is not None:
+            limiter.acquire()
+        try:
+            outputs = batch_translators[api]([texts[i] for i in batch], src_lang, tgt_lang)
+        except Exception as err:
+            error = err if isinstance(err, TranslationError) else TranslationError(f'{api}: {err}')
+            outputs = [error] * len(batch)
+        for i, output in zip(batch, outputs):
+            results[i] = output if output else TranslationError(f'{api}: empty translation')
+    return results
+
+
+def back_translate_batch(samples, api = 'tencent', src_lang="zh", tgt_lang="en"):
+    """
+    批量回译：src -> tgt -> src，再整批计算与原文的相似度。
+    返回与 samples 等长的列表：相似度低于阈值的位置为 None，翻译失败的位置为 TranslationError 实例。
+    """
+    middle = translate_batch(samples, api, src_lang, tgt_lang)
+    results = [text if isinstance(text, TranslationError) else None for text in middle]
+    valid = [i for i, text in enumerate(middle) if not isinstance(text, TranslationError)]
+    targets = translate_batch([middle[i] for i in valid], api, tgt_lang, src_lang)
+
+    pairs = []
+    for i, target in zip(valid, targets):
+        if isinstance(target, TranslationError):
+            results[i] = target
+        else:
+            pairs.append((i, target))
+    if not pairs:
+        return results
+    scores = similarity_scores([samples[i] for i, _ in pairs], [target for _, target in pairs])
+    for (i, target), score in zip(pairs, scores):
+        if round(score, 4) >= threshold:
+            results[i] = target
+    return results
     
 
 def back_translate(sample, api = 'tencent', src_lang="zh", tgt_lang="en"):
@@ -131,22 +294,10 @@ def back_translate(sample, api = 'tencent', src_lang="zh", tgt_lang="en"):
     src_lang: 源语言
     tgt_lang: 目标语言
     """
-    if api == 'tencent':
-        en = tencent_translate(sample, src_lang, tgt_lang)
-        time.sleep(1)
-        target = tencent_translate(en, tgt_lang, src_lang)
-        time.sleep(1)
-    elif api == 'baidu':
-        en = baidu_translate(sample, src_lang, tgt_lang)
-        time.sleep(1)
-        target = baidu_translate(en, tgt_lang, src_lang)
-        time.sleep(1)
-    elif api == 'aliyun':
-        en = aliyun_translate(sample, src_lang, tgt_lang)
-        time.sleep(1)
-        target = aliyun_translate(en, tgt_lang, src_lang)
-        time.sleep(1)
-    return cosine_simalarity(sample, target)
+    result = back_translate_batch([sample], api, src_lang, tgt_lang)[0]
+    if isinstance(result, TranslationError):
+        raise result
+    return result
 
 
 if __name__ == '__main__':
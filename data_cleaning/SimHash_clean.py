@@ -1,9 +1,16 @@
 import os
+import re
+import hashlib
+from functools import lru_cache
+import jieba
+import numpy as np
 import pandas as pd
 from tqdm import tqdm
 from collections import Counter
 import matplotlib.pyplot as plt
 import seaborn as sns
+from text_cleaner import clean_dataframe
+from plot_utils import HEADLESS, show_or_save_figure
 
 # ==========================================================
 # 全局配置 (Global Configuration)
@@ -12,6 +19,17 @@ THUCNEWS_ROOT = r"E:\Graduate_doc\school_life\THUCNEWS_data\THUCNews1\THUCNews1"
 
 TARGET_CATEGORIES = ["财经", "房产","教育", "科技", "社会", "时尚", "时政", "体育", "星座", "游戏", "娱乐"]
 
+# 近似去重配置
+DEDUP_METHOD = "simhash"          # "simhash" 或 "minhash"
+TOKEN_MODE = "char"               # "char"（字符）或 "jieba"（分词）
+SHINGLE_SIZE = 3                  # shingle 由多少个字符/词组成
+HAMMING_THRESHOLD = 3             # SimHash 汉明距离阈值（<= 该值视为近似重复）
+MINHASH_NUM_PERM = 128            # MinHash 置换个数
+MINHASH_BANDS = 32                # LSH 分桶数（每个桶 MINHASH_NUM_PERM // MINHASH_BANDS 行）
+JACCARD_THRESHOLD = 0.8           # MinHash 估计 Jaccard 相似度阈值
+MAX_BUCKET_SIZE = 1000            # 单个桶超过该大小时只与桶内首个样本配对，避免平方级爆炸
+CLUSTER_OUTPUT_PATH = "near_duplicate_clusters.csv"
+
 
 # ==========================================================
 # 函数 1: 数据读取 (Data Loading)
@@ -64,32 +82,18 @@ def read_thucnews(root_dir, target_categories):
 # ==========================================================
 # 函数 2: 数据分析 (EDA 和质量检查) (Enhanced version with cleaning)
 # ==========================================================
-def perform_eda_and_quality_check_enhanced(df: pd.DataFrame):
+def perform_eda_and_quality_check_enhanced(df: pd.DataFrame, clean_config=None, headless=HEADLESS):
     """
     对已加载的 THUCNews DataFrame 进行探索性数据分析和质量检查（已修复中文乱码，包含清洗步骤）。
+    headless 为 True 时不弹出图窗，图表保存到 FIGURE_DIR。
     """
 
-    # 清理特殊字符（全角空格，换行符，不间断空格，制表符）
-    def clean_text(text):
-        if isinstance(text, str):
-            text = text.replace("\u3000", "")  # 替换全角空格
-            text = text.replace("\n", " ")  # 替换换行符
-            text = text.replace("\xa0", "")  # 替换不间断空格
-            text = text.replace("\t", " ")  # 替换制表符
-        return text
-
-    # 应用文本清洗到标题和正文
-    df["title"] = df["title"].apply(clean_text)
-    df["content"] = df["content"].apply(clean_text)
-
-    # 长度过滤：删除正文长度小于50个字符的样本
-    df = df[df["content"].apply(len) >= 50]
+    # 清理特殊字符（全角空格，换行符，不间断空格，制表符）并过滤过短正文，长度列只计算一次
+    df = clean_dataframe(df, clean_config)
 
     # ==========================================================
     # 基本信息与长度计算
     # ==========================================================
-    df["title_len"] = df["title"].fillna("").apply(len)
-    df["content_len"] = df["content"].fillna("").apply(len)
     category_counts = df["category"].value_counts()
 
     # 设置字体以避免中文乱码
@@ -110,7 +114,7 @@ def perform_eda_and_quality_check_enhanced(df: pd.DataFrame):
     plt.ylabel('样本数量', fontsize=14)
     plt.xticks(rotation=45, ha='right')
     plt.tight_layout()
-    plt.show()
+    show_or_save_figure("category_counts.png", headless)
 
     # 绘制正文长度分布图
     plt.figure(figsize=(12, 6))
@@ -120,7 +124,7 @@ def perform_eda_and_quality_check_enhanced(df: pd.DataFrame):
     plt.xlabel('正文长度 (字符数)', fontsize=14)
     plt.ylabel('样本数量', fontsize=14)
     plt.tight_layout()
-    plt.show()
+    show_or_save_figure("content_len_hist.png", headless)
 
     # 检查缺失值
     print("\n缺失值统计：")
@@ -140,6 +144,235 @@ def perform_eda_and_quality_check_enhanced(df: pd.DataFrame):
     return df
 
 
+# ==========================================================
+# 函数 3: 去重 (Exact & Near-duplicate Detection)
+# ==========================================================
+def find_exact_duplicates(df: pd.DataFrame, text_col="content"):
+    """
+    精确去重：正文完全相同的样本只保留第一条。
+    """
+    duplicated = df.duplicated(subset=[text_col], keep="first")
+    print(f"精确重复样本数：{int(duplicated.sum())}")
+    return df[~duplicated].reset_index(drop=True)
+
+
+_POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+_BIT_SHIFTS = np.arange(64, dtype=np.uint64)
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH32 = np.uint64(0xFFFFFFFF)
+
+
+@lru_cache(maxsize=1 << 20)
+def _hash_token(token):
+    """稳定的 64 位 token 哈希（不受 PYTHONHASHSEED 影响）。"""
+    return int.from_bytes(hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def tokenize_for_fingerprint(text, mode=TOKEN_MODE, shingle_size=SHINGLE_SIZE):
+    """
+    将文本切分为 shingle 列表。
+    :param mode: "char" 按字符，"jieba" 按分词结果
+    :param shingle_size: 每个 shingle 包含的字符/词个数
+    :return: shingle 列表（文本为空时返回空列表）
+    """
+    if not isinstance(text, str):
+        return []
+    if mode == "jieba":
+        units = [w for w in jieba.lcut(text) if w.strip()]
+    else:
+        units = list(re.sub(r"\s+", "", text))
+    if not units:
+        return []
+    if len(units) <= shingle_size:
+        return ["".join(units)]
+    return ["".join(units[i:i + shingle_size]) for i in range(len(units) - shingle_size + 1)]
+
+
+def _iter_hash_chunks(token_lists, max_tokens=65536):
+    """
+    按 token 总数分块，返回 (文档下标, 拼接后的 token 哈希, 各文档起始偏移)。
+    空文档不会出现在结果里。
+    """
+    doc_ids, hashes, starts, total = [], [], [], 0
+    for doc_id, tokens in enumerate(token_lists):
+        if not tokens:
+            continue
+        doc_ids.append(doc_id)
+        starts.append(total)
+        hashes.extend(_hash_token(t) for t in tokens)
+        total += len(tokens)
+        if total >= max_tokens:
+            yield np.array(doc_ids), np.array(hashes, dtype=np.uint64), np.array(starts)
+            doc_ids, hashes, starts, total = [], [], [], 0
+    if doc_ids:
+        yield np.array(doc_ids), np.array(hashes, dtype=np.uint64), np.array(starts)
+
+
+def simhash_fingerprints(token_lists):
+    """
+    向量化计算 64 位 SimHash 指纹。
+    :return: (指纹数组 uint64, 有效文档掩码)
+    """
+    n = len(token_lists)
+    fingerprints = np.zeros(n, dtype=np.uint64)
+    valid = np.zeros(n, dtype=bool)
+    for doc_ids, hashes, starts in _iter_hash_chunks(token_lists):
+        # 每个 token 的 64 个比特位映射为 +1/-1，再按文档求和
+        signed = ((hashes[:, None] >> _BIT_SHIFTS) & np.uint64(1)).astype(np.int32) * 2 - 1
+        weights = np.add.reduceat(signed, starts, axis=0)
+        bits = (weights > 0).astype(np.uint64) << _BIT_SHIFTS
+        fingerprints[doc_ids] = np.bitwise_or.reduce(bits, axis=1)
+        valid[doc_ids] = True
+    return fingerprints, valid
+
+
+def minhash_signatures(token_lists, num_perm=MINHASH_NUM_PERM, seed=1):
+    """
+    向量化计算 MinHash 签名，第 i 个排列为 h_i(x) = ((a_i * x + b_i) mod p) & 0xFFFFFFFF，p = 2^61 - 1。
+    x 为 token 哈希的低 32 位，a_i ∈ [1, 2^32)，b_i ∈ [0, 2^32)。
+    :return: (签名矩阵 uint32, 形状 [n, num_perm]；有效文档掩码)
+    """
+    rng = np.random.RandomState(seed)
+    a = rng.randint(1, 1 << 32, size=num_perm, dtype=np.uint64)
+    b = rng.randint(0, 1 << 32, size=num_perm, dtype=np.uint64)
+    n = len(token_lists)
+    signatures = np.full((n, num_perm), 0xFFFFFFFF, dtype=np.uint32)
+    valid = np.zeros(n, dtype=bool)
+    for doc_ids, hashes, starts in _iter_hash_chunks(token_lists, max_tokens=max((1 << 23) // num_perm, 1024)):
+        x = (hashes & _MAX_HASH32)[:, None]
+        # a、b、x 均小于 2^32，a * x + b <= 2^64 - 2^32，uint64 运算不会回绕，结果就是精确的 (a * x + b) mod p
+        permuted = ((x * a + b) % _MERSENNE_PRIME) & _MAX_HASH32
+        signatures[doc_ids] = np.minimum.reduceat(permuted, starts, axis=0).astype(np.uint32)
+        valid[doc_ids] = True
+    return signatures, valid
+
+
+def hamming_distance(x, y):
+    """逐元素计算两组 uint64 指纹之间的汉明距离。"""
+    xor = np.ascontiguousarray(np.bitwise_xor(x, y), dtype=np.uint64)
+    return _POPCOUNT_TABLE[xor.view(np.uint8).reshape(-1, 8)].sum(axis=1)
+
+
+def _bucket_pairs(keys, doc_ids, max_bucket_size=MAX_BUCKET_SIZE):
+    """
+    LSH 分桶：key 相同的文档进入同一个桶，返回桶内候选对 (left, right)。
+    超大桶只与桶内第一个文档配对。
+    """
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    boundaries = np.flatnonzero(sorted_keys[1:] != sorted_keys[:-1]) + 1
+    starts = np.concatenate(([0], boundaries))
+    ends = np.concatenate((boundaries, [len(keys)]))
+    left, right = [], []
+    for start, end in zip(starts[ends - starts > 1], ends[ends - starts > 1]):
+        members = doc_ids[order[start:end]]
+        if len(members) > max_bucket_size:
+            left.append(np.full(len(members) - 1, members[0]))
+            right.append(members[1:])
+        else:
+            i, j = np.triu_indices(len(members), k=1)
+            left.append(members[i])
+            right.append(members[j])
+    if not left:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    return np.concatenate(left).astype(np.int64), np.concatenate(right).astype(np.int64)
+
+
+def _unique_pairs(pairs):
+    """合并多个桶产生的候选对并去重。"""
+    left = np.concatenate([p[0] for p in pairs]) if pairs else np.empty(0, dtype=np.int64)
+    right = np.concatenate([p[1] for p in pairs]) if pairs else np.empty(0, dtype=np.int64)
+    lo, hi = np.minimum(left, right), np.maximum(left, right)
+    packed = np.unique(np.stack([lo, hi], axis=1), axis=0) if len(lo) else np.empty((0, 2), dtype=np.int64)
+    return packed[:, 0], packed[:, 1]
+
+
+def simhash_candidate_pairs(fingerprints, valid, hamming_threshold=HAMMING_THRESHOLD):
+    """
+    抽屉原理分块：把 64 位切成 (阈值 + 1) 段，汉明距离 <= 阈值的两个指纹至少有一段完全相同。
+    返回经过汉明距离校验的近似重复对。
+    """
+    doc_ids = np.flatnonzero(valid)
+    fps = fingerprints[doc_ids]
+    num_blocks = hamming_threshold + 1
+    widths = [64 // num_blocks + (1 if i < 64 % num_blocks else 0) for i in range(num_blocks)]
+    pairs, offset = [], 0
+    for width in widths:
+        mask = np.uint64((1 << width) - 1)
+        keys = (fps >> np.uint64(offset)) & mask
+        pairs.append(_bucket_pairs(keys, doc_ids))
+        offset += width
+    left, right = _unique_pairs(pairs)
+    keep = hamming_distance(fingerprints[left], fingerprints[right]) <= hamming_threshold
+    return left[keep], right[keep]
+
+
+def minhash_candidate_pairs(signatures, valid, bands=MINHASH_BANDS, jaccard_threshold=JACCARD_THRESHOLD):
+    """
+    MinHash LSH：签名切成 bands 段，任意一段完全相同即为候选对，再用估计的 Jaccard 相似度校验。
+    """
+    doc_ids = np.flatnonzero(valid)
+    sigs = signatures[doc_ids].astype(np.uint64)
+    rows = signatures.shape[1] // bands
+    pairs = []
+    for band in range(bands):
+        # 将一段签名折叠为一个 64 位 key（碰撞会在之后的相似度校验中被过滤）
+        keys = np.zeros(len(doc_ids), dtype=np.uint64)
+        for col in range(band * rows, (band + 1) * rows):
+            keys = keys * np.uint64(1000003) + sigs[:, col]
+        pairs.append(_bucket_pairs(keys, doc_ids))
+    left, right = _unique_pairs(pairs)
+    similarity = (signatures[left] == signatures[right]).mean(axis=1)
+    keep = similarity >= jaccard_threshold
+    return left[keep], right[keep]
+
+
+def connected_components(n, left, right):
+    """
+    根据近似重复对求连通分量，每个分量的标签为其中最小的文档下标。
+    """
+    labels = np.arange(n)
+    while True:
+        prev = labels.copy()
+        np.minimum.at(labels, left, labels[right])
+        np.minimum.at(labels, right, labels[left])
+        labels = labels[labels]
+        if np.array_equal(labels, prev):
+            return labels
+
+
+def find_near_duplicates(df: pd.DataFrame, text_col="content", method=DEDUP_METHOD,
+                         cluster_output=CLUSTER_OUTPUT_PATH):
+    """
+    近似去重：计算 SimHash / MinHash 指纹，LSH 分桶找候选对并校验，最后按簇保留第一条样本。
+    :param method: "simhash" 或 "minhash"
+    :param cluster_output: 簇编号输出路径（csv），为 None 时不输出
+    :return: 去重后的 DataFrame
+    """
+    df = df.reset_index(drop=True)
+    token_lists = [tokenize_for_fingerprint(text) for text in tqdm(df[text_col], desc="正在计算 shingle", unit="doc")]
+
+    if method == "simhash":
+        fingerprints, valid = simhash_fingerprints(token_lists)
+        left, right = simhash_candidate_pairs(fingerprints, valid)
+        df["simhash"] = fingerprints
+    elif method == "minhash":
+        signatures, valid = minhash_signatures(token_lists)
+        left, right = minhash_candidate_pairs(signatures, valid)
+    else:
+        raise ValueError(f"不支持的去重方法：{method}")
+
+    labels = connected_components(len(df), left, right)
+    _, df["cluster_id"] = np.unique(labels, return_inverse=True)
+    is_duplicate = labels != np.arange(len(df))
+
+    print(f"近似重复对数：{len(left)}，近似重复样本数：{int(is_duplicate.sum())}，簇数：{df['cluster_id'].nunique()}")
+    if cluster_output is not None:
+        columns = [c for c in ["category", "doc_id", "cluster_id", "simhash"] if c in df.columns]
+        df[columns].assign(is_duplicate=is_duplicate).to_csv(cluster_output, index=False, encoding="utf-8")
+        print(f"簇编号已保存到：{cluster_output}")
+
+    return df[~is_duplicate].reset_index(drop=True)
 
 
 # ==========================================================
@@ -152,6 +385,7 @@ if __name__ == "__main__":
     # 2. EDA 和质量检查：分析数据并输出图表
     df = perform_eda_and_quality_check_enhanced(df)
 
+    # 3. 近似去重：SimHash / MinHash + LSH 分桶，输出簇编号
+    df = find_near_duplicates(df)
 
-
-    print("\n数据处理完毕，精确重复样本已删除，特殊字符已清理，正文长度已过滤。")
+    print("\n数据处理完毕，精确重复与近似重复样本已删除，特殊字符已清理，正文长度已过滤。")
@@ -0,0 +1,16 @@
+import os
+import matplotlib.pyplot as plt
+
+# 无界面模式（服务器/批处理）：设置环境变量 HEADLESS=1 时图表保存到文件而不是弹窗
+HEADLESS = os.getenv("HEADLESS", "0") == "1"
+FIGURE_DIR = "eda_figures"
+
+
+def show_or_save_figure(filename, headless=HEADLESS):
+    """交互模式下显示图表；无界面模式下保存到 FIGURE_DIR，避免 plt.show() 阻塞。"""
+    if headless:
+        os.makedirs(FIGURE_DIR, exist_ok=True)
+        plt.savefig(os.path.join(FIGURE_DIR, filename), dpi=150)
+        plt.close()
+    else:
+        plt.show()
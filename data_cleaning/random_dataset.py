@@ -1,6 +1,7 @@
 import os
-import pandas as pd
+import json
 import random
+import pandas as pd
 from shutil import copyfile
 from tqdm import tqdm
 
@@ -11,44 +12,135 @@ THUCNEWS_ROOT = r"E:\Graduate_doc\school_life\THUCNEWS_data\THUCNews\THUCNews1"
 TARGET_CATEGORIES = ["财经", "房产","教育", "科技", "社会", "时尚", "时政", "体育", "星座", "游戏", "娱乐"]
 OUTPUT_DIR = "random_data"
 NUM_SAMPLES = 50000  # 抽取的样本数量
+SEED = 42            # 随机种子，保证抽样可复现
+STRATIFY = False     # True 时每个分类抽取相同数量的样本
+OUTPUT_FORMAT = "txt"   # "txt"：清单 + 逐样本 txt（augment.py 直接读取）；"jsonl" / "parquet"：写入分片文件；"manifest"：只写路径清单
+SHARD_SIZE = 10000   # 每个输出分片的样本数
+
 
 # ==========================================================
-# 创建目标文件夹 (如果不存在)
+# 蓄水池抽样 (Reservoir Sampling)
 # ==========================================================
-if not os.path.exists(OUTPUT_DIR):
-    os.makedirs(OUTPUT_DIR)
+def iter_category_files(root_dir, category):
+    """用 os.scandir 逐个产出分类下的 txt 文件路径，不构建完整列表。"""
+    category_dir = os.path.join(root_dir, category)
+    if not os.path.exists(category_dir):
+        print(f"⚠️ 跳过：分类文件夹不存在 {category}")
+        return
+    with os.scandir(category_dir) as entries:
+        for entry in entries:
+            if entry.name.endswith(".txt"):
+                yield entry.path
+
+
+def reservoir_sample(items, k, rng):
+    """
+    单遍蓄水池抽样（Algorithm R）：从未知长度的迭代器中等概率抽取 k 个元素。
+    :return: 抽中的元素列表（不足 k 个时返回全部）
+    """
+    reservoir = []
+    for i, item in enumerate(items):
+        if i < k:
+            reservoir.append(item)
+        else:
+            j = rng.randint(0, i)
+            if j < k:
+                reservoir[j] = item
+    return reservoir
+
+
+def sample_files(root_dir, categories, num_samples, seed=SEED, stratify=STRATIFY):
+    """
+    遍历所有分类一次，返回抽中的 (category, file_path) 列表。
+    stratify 为 True 时按分类平均分配名额，否则在全部文件上整体抽样。
+    """
+    rng = random.Random(seed)
+    if stratify:
+        quotas = [num_samples // len(categories) + (1 if i < num_samples % len(categories) else 0)
+                  for i in range(len(categories))]
+        sampled = []
+        for category, quota in zip(categories, quotas):
+            files = tqdm(iter_category_files(root_dir, category), desc=f"正在扫描 [{category}]", unit="file")
+            picked = reservoir_sample(((category, path) for path in files), quota, rng)
+            if len(picked) < quota:
+                print(f"⚠️ 分类 {category} 只有 {len(picked)} 个文件，少于名额 {quota}")
+            sampled.extend(picked)
+    else:
+        all_files = ((category, path) for category in categories for path in iter_category_files(root_dir, category))
+        sampled = reservoir_sample(tqdm(all_files, desc="正在扫描文件", unit="file"), num_samples, rng)
+
+    # 蓄水池中的顺序与遍历顺序有关，这里再打乱一次
+    rng.shuffle(sampled)
+    return sampled
 
 
 # ==========================================================
-# 随机抽取5万条数据
+# 输出 (Output)
 # ==========================================================
-def extract_random_data(root_dir, categories, num_samples, output_dir):
-    all_files = []
-
-    # 遍历每个分类文件夹，收集所有文件的路径
-    for category in categories:
-        category_dir = os.path.join(root_dir, category)
-        if not os.path.exists(category_dir):
-            print(f"⚠️ 跳过：分类文件夹不存在 {category}")
-            continue
+def _write_shard(records, output_dir, shard_idx, output_format):
+    if output_format == "parquet":
+        path = os.path.join(output_dir, f"samples-{shard_idx:05d}.parquet")
+        pd.DataFrame(records).to_parquet(path, index=False)
+    else:
+        path = os.path.join(output_dir, f"samples-{shard_idx:05d}.jsonl")
+        with open(path, "w", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
 
-        filenames = [os.path.join(category_dir, f) for f in os.listdir(category_dir) if f.endswith(".txt")]
-        all_files.extend(filenames)
 
-    # 随机选择5万条文件
-    random_files = random.sample(all_files, num_samples)
+def write_samples(sampled, output_dir, output_format=OUTPUT_FORMAT, shard_size=SHARD_SIZE):
+    """
+    写出抽样结果：
+    - jsonl / parquet：读取被抽中的文件内容，按 shard_size 写入少量分片文件
+    - manifest：只写 manifest.jsonl（样本名、分类、源路径）
+    - txt：manifest.jsonl + 在 output_dir 中生成 sample_{i}.txt，优先创建硬链接（不复制数据），失败时复制
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    if output_format in ("manifest", "txt"):
+        with open(os.path.join(output_dir, "manifest.jsonl"), "w", encoding="utf-8") as mf:
+            for idx, (category, file_path) in enumerate(tqdm(sampled, desc="正在写入清单", unit="file")):
+                sample_name = f"sample_{idx + 1}.txt"
+                if output_format == "txt":
+                    target_path = os.path.join(output_dir, sample_name)
+                    try:
+                        if not os.path.exists(target_path):
+                            try:
+                                os.link(file_path, target_path)
+                            except OSError:  # 跨文件系统或不支持硬链接时退化为复制
+                                copyfile(file_path, target_path)
+                    except OSError as e:
+                        print(f"❌ 写入样本失败: {file_path} -> {e}")
+                        continue
+                mf.write(json.dumps({"name": sample_name, "category": category, "path": file_path},
+                                    ensure_ascii=False) + "\n")
+        return
 
-    # 将选中的文件复制到目标文件夹中
-    for idx, file_path in tqdm(enumerate(random_files), desc="正在复制文件", unit="file"):
+    records, shard_idx = [], 0
+    for idx, (category, file_path) in enumerate(tqdm(sampled, desc="正在写入分片", unit="file")):
         try:
-            # 复制文件到目标文件夹
-            target_path = os.path.join(output_dir, f"sample_{idx + 1}.txt")
-            copyfile(file_path, target_path)
+            with open(file_path, "r", encoding="utf-8") as f:
+                text = f.read()
         except Exception as e:
-            print(f"❌ 复制文件失败: {file_path} -> {e}")
+            print(f"❌ 读取文件失败: {file_path} -> {e}")
+            continue
+        records.append({"name": f"sample_{idx + 1}.txt", "category": category, "path": file_path, "text": text})
+        if len(records) >= shard_size:
+            _write_shard(records, output_dir, shard_idx, output_format)
+            records, shard_idx = [], shard_idx + 1
+    if records:
+        _write_shard(records, output_dir, shard_idx, output_format)
 
-    print(f"\n✅ 随机抽取并复制了 {num_samples} 条数据到 '{output_dir}' 文件夹中。")
+
+# ==========================================================
+# 随机抽取5万条数据
+# ==========================================================
+def extract_random_data(root_dir, categories, num_samples, output_dir, seed=SEED, stratify=STRATIFY,
+                        output_format=OUTPUT_FORMAT):
+    sampled = sample_files(root_dir, categories, num_samples, seed, stratify)
+    write_samples(sampled, output_dir, output_format)
+    print(f"\n✅ 随机抽取了 {len(sampled)} 条数据并写入 '{output_dir}' 文件夹（格式：{output_format}）。")
 
 
 # 执行抽取
-extract_random_data(THUCNEWS_ROOT, TARGET_CATEGORIES, NUM_SAMPLES, OUTPUT_DIR)
+if __name__ == "__main__":
+    extract_random_data(THUCNEWS_ROOT, TARGET_CATEGORIES, NUM_SAMPLES, OUTPUT_DIR)
@@ -1,9 +1,14 @@
 import os
+import glob
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import pandas as pd
 from tqdm import tqdm
 from collections import Counter
 import matplotlib.pyplot as plt
 import seaborn as sns
+from text_cleaner import clean_dataframe, clean_parquet_shards
+from plot_utils import HEADLESS, show_or_save_figure
+from SimHash_clean import find_exact_duplicates
 
 # ==========================================================
 # 全局配置 (Global Configuration)
@@ -12,10 +17,42 @@ THUCNEWS_ROOT = r"E:\Graduate_doc\school_life\THUCNEWS_data\THUCNews1\THUCNews1"
 
 TARGET_CATEGORIES = ["财经", "房产","教育", "科技", "社会", "时尚", "时政", "体育", "星座", "游戏", "娱乐"]
 
+# 流式读取配置：原始 txt 分片写入 Parquet，之后直接按列读取
+SHARD_DIR = "thucnews_parquet"
+CLEAN_SHARD_DIR = "thucnews_parquet_clean"  # 逐分片清洗后的输出目录（同样可断点续跑）
+SHARD_SIZE = 20000    # 每个 Parquet 分片的样本数（决定峰值内存）
+NUM_WORKERS = 16      # 并行读取文件的线程/进程数
+USE_PROCESSES = False # 读取是 IO 密集型，默认使用线程；CPU 成为瓶颈时可改为进程
+
 
 # ==========================================================
 # 函数 1: 数据读取 (Data Loading)
 # ==========================================================
+def parse_thucnews_file(category_dir, category, filename):
+    """读取单个 txt 文件并拆分出标题和正文，失败时返回 None。"""
+    file_path = os.path.join(category_dir, filename)
+    try:
+        with open(file_path, "r", encoding="utf-8") as f:
+            content = f.read().strip()
+    except Exception as e:
+        print(f"\n❌ 读取失败 {file_path}：{e}")
+        return None
+
+    # 简单的拆分逻辑
+    if "\t" in content:
+        title, text = content.split("\t", maxsplit=1)
+    else:
+        title = content[:30].strip()
+        text = content[30:].strip()
+
+    return {
+        "category": category,
+        "doc_id": filename.replace(".txt", ""),
+        "title": title,
+        "content": text
+    }
+
+
 def read_thucnews(root_dir, target_categories):
     data = []
 
@@ -30,27 +67,9 @@ def read_thucnews(root_dir, target_categories):
         filenames = [f for f in os.listdir(category_dir) if f.endswith(".txt")]
 
         for filename in tqdm(filenames, desc=f"正在处理 [{category}]", unit="doc"):
-            file_path = os.path.join(category_dir, filename)
-            try:
-                with open(file_path, "r", encoding="utf-8") as f:
-                    content = f.read().strip()
-
-                # 简单的拆分逻辑
-                if "\t" in content:
-                    title, text = content.split("\t", maxsplit=1)
-                else:
-                    title = content[:30].strip()
-                    text = content[30:].strip()
-
-                data.append({
-                    "category": category,
-                    "doc_id": filename.replace(".txt", ""),
-                    "title": title,
-                    "content": text
-                })
-            except Exception as e:
-                print(f"\n❌ 读取失败 {file_path}：{e}")
-                continue
+            record = parse_thucnews_file(category_dir, category, filename)
+            if record is not None:
+                data.append(record)
 
     df = pd.DataFrame(data)
     print("\n" + "=" * 30)
@@ -62,34 +81,104 @@ def read_thucnews(root_dir, target_categories):
 
 
 # ==========================================================
-# 函数 2: 数据分析 (EDA 和质量检查) (Enhanced version with cleaning)
+# 函数 1.1: 并行流式读取 (Parallel Streaming Ingestion)
 # ==========================================================
-def perform_eda_and_quality_check_enhanced(df: pd.DataFrame):
+def _shard_path(shard_dir, category, shard_idx):
+    return os.path.join(shard_dir, f"{category}-{shard_idx:05d}.parquet")
+
+
+def _parse_file_batch(category_dir, category, filenames):
+    return [parse_thucnews_file(category_dir, category, filename) for filename in filenames]
+
+
+def stream_thucnews_to_parquet(root_dir, target_categories, shard_dir=SHARD_DIR, shard_size=SHARD_SIZE,
+                               num_workers=NUM_WORKERS, use_processes=USE_PROCESSES):
     """
-    对已加载的 THUCNews DataFrame 进行探索性数据分析和质量检查（已修复中文乱码，包含清洗步骤）。
+    并行读取 THUCNews 原始 txt 文件，按分类分片写入 Parquet。
+    - 内存上限约为一个分片（shard_size 条样本）
+    - 文件名排序后分片，分片边界确定；已存在的分片直接跳过，因此中断后重新运行即可断点续读
+    - 分片先写入临时文件再重命名，不会留下写了一半的分片
+    :return: 分片目录
     """
+    os.makedirs(shard_dir, exist_ok=True)
+    executor_cls = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    batch_size = max(1, shard_size // (num_workers * 4))
+
+    with executor_cls(max_workers=num_workers) as executor:
+        for category in target_categories:
+            category_dir = os.path.join(root_dir, category)
+            if not os.path.exists(category_dir):
+                print(f"⚠️ 跳过：分类文件夹不存在 {category}")
+                continue
+
+            with os.scandir(category_dir) as entries:
+                filenames = sorted(e.name for e in entries if e.name.endswith(".txt"))
+            num_shards = (len(filenames) + shard_size - 1) // shard_size
+
+            pbar = tqdm(total=len(filenames), desc=f"正在处理 [{category}]", unit="doc")
+            for shard_idx in range(num_shards):
+                shard_files = filenames[shard_idx * shard_size:(shard_idx + 1) * shard_size]
+                output_path = _shard_path(shard_dir, category, shard_idx)
+                if os.path.exists(output_path):
+                    pbar.update(len(shard_files))
+                    continue
+
+                batches = [shard_files[i:i + batch_size] for i in range(0, len(shard_files), batch_size)]
+                records = []
+                for batch_records in executor.map(_parse_file_batch, [category_dir] * len(batches),
+                                                  [category] * len(batches), batches):
+                    records.extend(r for r in batch_records if r is not None)
+                    pbar.update(len(batch_records))
+
+                tmp_path = output_path + ".tmp"
+                pd.DataFrame(records, columns=["category", "doc_id", "title", "content"]).to_parquet(tmp_path, index=False)
+                os.replace(tmp_path, output_path)
+            pbar.close()
+
+    print(f"✅ 分片写入完成：{shard_dir}")
+    return shard_dir
+
+
+def list_thucnews_shards(shard_dir=SHARD_DIR, categories=None):
+    """列出分片文件，可按分类筛选。"""
+    paths = sorted(glob.glob(os.path.join(shard_dir, "*.parquet")))
+    if categories is not None:
+        paths = [p for p in paths if os.path.basename(p).rsplit("-", 1)[0] in categories]
+    return paths
+
+
+def iter_thucnews_shards(shard_dir=SHARD_DIR, columns=None, categories=None):
+    """逐个分片惰性读取，每次只在内存中保留一个分片的指定列。"""
+    for path in list_thucnews_shards(shard_dir, categories):
+        yield pd.read_parquet(path, columns=columns)
+
+
+def load_thucnews_shards(shard_dir=SHARD_DIR, columns=None, categories=None):
+    """按列读取全部分片并合并为 DataFrame。"""
+    frames = list(iter_thucnews_shards(shard_dir, columns, categories))
+    df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=columns)
+    print(f"✅ 从 {shard_dir} 加载 {len(frames)} 个分片，总样本数：{len(df)}")
+    return df
+
 
-    # 清理特殊字符（全角空格，换行符，不间断空格，制表符）
-    def clean_text(text):
-        if isinstance(text, str):
-            text = text.replace("\u3000", "")  # 替换全角空格
-            text = text.replace("\n", " ")  # 替换换行符
-            text = text.replace("\xa0", "")  # 替换不间断空格
-            text = text.replace("\t", " ")  # 替换制表符
-        return text
 
-    # 应用文本清洗到标题和正文
-    df["title"] = df["title"].apply(clean_text)
-    df["content"] = df["content"].apply(clean_text)
+# ==========================================================
+# 函数 2: 数据分析 (EDA 和质量检查) (Enhanced version with cleaning)
+# ==========================================================
+def perform_eda_and_quality_check_enhanced(df: pd.DataFrame, clean_config=None, headless=HEADLESS, clean=True):
+    """
+    对已加载的 THUCNews DataFrame 进行探索性数据分析和质量检查（已修复中文乱码，包含清洗步骤）。
+    headless 为 True 时不弹出图窗，图表保存到 FIGURE_DIR。
+    clean 为 False 时认为 df 已由 clean_parquet_shards 逐分片清洗过，不再重复清洗。
+    """
 
-    # 长度过滤：删除正文长度小于50个字符的样本
-    df = df[df["content"].apply(len) >= 50]
+    # 清理特殊字符（全角空格，换行符，不间断空格，制表符）并过滤过短正文，长度列只计算一次
+    if clean:
+        df = clean_dataframe(df, clean_config)
 
     # ==========================================================
     # 基本信息与长度计算
     # ==========================================================
-    df["title_len"] = df["title"].fillna("").apply(len)
-    df["content_len"] = df["content"].fillna("").apply(len)
     category_counts = df["category"].value_counts()
 
     # 设置字体以避免中文乱码
@@ -110,7 +199,7 @@ def perform_eda_and_quality_check_enhanced(df: pd.DataFrame):
     plt.ylabel('样本数量', fontsize=14)
     plt.xticks(rotation=45, ha='right')
     plt.tight_layout()
-    plt.show()
+    show_or_save_figure("category_counts.png", headless)
 
     # 绘制正文长度分布图
     plt.figure(figsize=(12, 6))
@@ -120,7 +209,7 @@ def perform_eda_and_quality_check_enhanced(df: pd.DataFrame):
     plt.xlabel('正文长度 (字符数)', fontsize=14)
     plt.ylabel('样本数量', fontsize=14)
     plt.tight_layout()
-    plt.show()
+    show_or_save_figure("content_len_hist.png", headless)
 
     # 检查缺失值
     print("\n缺失值统计：")
@@ -146,11 +235,15 @@ def perform_eda_and_quality_check_enhanced(df: pd.DataFrame):
 # 主执行块 (Main Execution Block)
 # ==========================================================
 if __name__ == "__main__":
-    # 1. 数据读取：加载原始数据
-    df = read_thucnews(THUCNEWS_ROOT, TARGET_CATEGORIES)
+    # 1. 数据读取：并行流式写入 Parquet 分片（已完成的分片会被跳过），再按列加载
+    stream_thucnews_to_parquet(THUCNEWS_ROOT, TARGET_CATEGORIES, SHARD_DIR)
+
+    # 2. 流式清洗：逐分片清洗并过滤过短正文，内存中只保留一个分片，再按列加载清洗后的分片
+    clean_parquet_shards(SHARD_DIR, CLEAN_SHARD_DIR)
+    df = load_thucnews_shards(CLEAN_SHARD_DIR, categories=TARGET_CATEGORIES)
 
-    # 2. EDA 和质量检查：分析数据并输出图表
-    df = perform_eda_and_quality_check_enhanced(df)
+    # 3. EDA 和质量检查：分析数据并输出图表（数据已清洗，不再重复清洗）
+    df = perform_eda_and_quality_check_enhanced(df, clean=False)
 
 
     print("\n数据处理完毕")
@@ -0,0 +1,88 @@
+import os
+import re
+import glob
+import pandas as pd
+from tqdm import tqdm
+
+# ==========================================================
+# 清洗规则配置 (Cleaning Rules)
+# ==========================================================
+# char_map: 单字符替换，通过一张 str.translate 表一次完成
+# regex_rules: 多字符/正则替换，按顺序执行
+# min_content_len: 正文长度下限（字符数）
+DEFAULT_CLEAN_CONFIG = {
+    "char_map": {
+        "\u3000": "",  # 全角空格
+        "\n": " ",    # 换行符
+        "\xa0": "",   # 不间断空格
+        "\t": " ",    # 制表符
+    },
+    "regex_rules": [],
+    "columns": ["title", "content"],
+    "min_content_len": 50,
+}
+
+
+# ==========================================================
+# 函数 1: 批量清洗 (Batch Cleaning)
+# ==========================================================
+def build_translate_table(char_map):
+    """把 {字符: 替换串} 规则编译为 str.translate 表。"""
+    for char in char_map:
+        if len(char) != 1:
+            raise ValueError(f"char_map 的键必须是单个字符，多字符规则请放到 regex_rules：{char!r}")
+    return str.maketrans(char_map)
+
+
+def clean_series(series: pd.Series, table, regex_rules=()):
+    """对一列文本执行 translate 表和正则规则，缺失值视为空串。"""
+    series = series.fillna("").astype(str).str.translate(table)
+    for pattern, repl in regex_rules:
+        series = series.str.replace(pattern, repl, regex=True)
+    return series
+
+
+def clean_dataframe(df: pd.DataFrame, config=None):
+    """
+    按配置清洗 DataFrame，并一次性计算长度列、完成长度过滤。
+    :param config: 清洗规则，缺省字段使用 DEFAULT_CLEAN_CONFIG
+    :return: 清洗后的 DataFrame（新增 title_len / content_len 列）
+    """
+    config = {**DEFAULT_CLEAN_CONFIG, **(config or {})}
+    table = build_translate_table(config["char_map"])
+    regex_rules = [(re.compile(p), r) for p, r in config["regex_rules"]]
+
+    df = df.copy()
+    for col in config["columns"]:
+        if col in df.columns:
+            df[col] = clean_series(df[col], table, regex_rules)
+            df[f"{col}_len"] = df[col].str.len()
+
+    # 长度过滤：删除正文长度小于 min_content_len 的样本
+    if "content_len" in df.columns:
+        df = df[df["content_len"] >= config["min_content_len"]]
+    return df.reset_index(drop=True)
+
+
+# ==========================================================
+# 函数 2: 流式清洗 (Streaming Cleaning over Parquet Shards)
+# ==========================================================
+def clean_parquet_shards(shard_dir, output_dir, config=None):
+    """
+    逐分片清洗 Parquet 数据并写入 output_dir，内存中只保留一个分片，与批处理使用同一套规则（clean_dataframe）。
+    已存在的输出分片会被跳过，可断点续跑。
+    :return: 清洗后保留的样本总数
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    kept = 0
+    for path in tqdm(sorted(glob.glob(os.path.join(shard_dir, "*.parquet"))), desc="正在清洗分片", unit="shard"):
+        output_path = os.path.join(output_dir, os.path.basename(path))
+        if os.path.exists(output_path):
+            continue
+        cleaned = clean_dataframe(pd.read_parquet(path), config)
+        tmp_path = output_path + ".tmp"
+        cleaned.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, output_path)
+        kept += len(cleaned)
+    print(f"✅ 清洗完成，本次新写入 {kept} 条样本到 {output_dir}")
+    return kept
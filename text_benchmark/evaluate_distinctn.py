@@ -1,11 +1,30 @@
+import os
 import json
 import re
+import hashlib
+from collections import deque
+from functools import lru_cache
+from multiprocessing import Pool
 import jieba
 import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 from tqdm import tqdm
 
 # --- 1. 配置 ---
 INPUT_FILE = 'generated_predictions_augmented.jsonl'  # 待评估的文件
+NGRAM_ORDERS = (1, 2, 3, 4)  # 需要计算的 n
+NUM_WORKERS = os.cpu_count() or 1  # 分词进程数
+CHUNK_SIZE = 512  # 每个任务包含的行数
+SELF_BLEU = True  # 是否计算 Self-BLEU 风格的跨样本重复度（需要第二遍扫描）
+HLL_PRECISION = 14  # HyperLogLog 寄存器数为 2^p，用于估计语料级不同 n-gram 数
+CMS_WIDTH = 1 << 20  # Count-Min Sketch 宽度，用于估计 n-gram 在整个语料中的出现次数
+CMS_DEPTH = 4
+
+_UINT64_MASK = (1 << 64) - 1
+_NGRAM_PRIME = np.uint64(1099511628211)
+_CMS_SEEDS = np.array([0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9, 0x27D4EB2F165667C5],
+                      dtype=np.uint64)
 
 # --- 2. 辅助函数 ---
 def clean_and_tokenize(text: str) -> list:
@@ -13,107 +32,266 @@ def clean_and_tokenize(text: str) -> list:
     # 1. 清洗文本：移除标点和特殊字符
     punctuation_pattern = r"[\s,.!?;:\"“”、，。《》（）——+-=【】*&^%$#@!<>~`'·]+"
     cleaned_text = re.sub(punctuation_pattern, "", text)
-    
+
     # 2. 使用jieba进行分词
     if not cleaned_text:
         return []
     return jieba.lcut(cleaned_text)
 
-def calculate_distinct_metrics_for_sample(tokens: list) -> tuple:
-    """为单条文本的token列表计算Distinct-1和Distinct-2。"""
+@lru_cache(maxsize=1 << 20)
+def _token_hash(token: str) -> int:
+    """稳定的 64 位 token 哈希，各进程结果一致。"""
+    return int.from_bytes(hashlib.blake2b(token.encode('utf-8'), digest_size=8).digest(), 'little')
+
+def hash_tokens(tokens: list) -> np.ndarray:
+    """把 token 列表映射为稳定的 uint64 哈希数组。"""
+    return np.array([_token_hash(t) for t in tokens], dtype=np.uint64)
+
+def _mix64(x: np.ndarray) -> np.ndarray:
+    """splitmix64 终结函数，打散 n-gram 哈希的比特分布。"""
+    x = x ^ (x >> np.uint64(30))
+    x = x * np.uint64(0xBF58476D1CE4E5B9)
+    x = x ^ (x >> np.uint64(27))
+    x = x * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+def ngram_hashes(token_hashes: np.ndarray, n: int) -> np.ndarray:
+    """向量化计算所有 n-gram 的 64 位哈希（保留重复）。"""
+    count = len(token_hashes) - n + 1
+    if count <= 0:
+        return np.empty(0, dtype=np.uint64)
+    h = token_hashes[:count].copy()
+    for k in range(1, n):
+        h = h * _NGRAM_PRIME + token_hashes[k:k + count]
+    return _mix64(h + np.uint64(n))
+
+def calculate_distinct_metrics_for_sample(tokens: list, orders=(1, 2)) -> tuple:
+    """为单条文本的token列表计算各阶 Distinct-n。"""
     if not tokens:
-        return 0.0, 0.0
-
-    # 计算 Distinct-1
-    distinct_1 = 0.0
-    # n-gram在这里就是单个词
-    ngrams_1 = [tuple([token]) for token in tokens]
-    if ngrams_1:
-        distinct_1 = len(set(ngrams_1)) / len(ngrams_1)
-        
-    # 计算 Distinct-2
-    distinct_2 = 0.0
-    if len(tokens) >= 2:
-        ngrams_2 = [tuple(tokens[i:i+2]) for i in range(len(tokens) - 1)]
-        if ngrams_2:
-            distinct_2 = len(set(ngrams_2)) / len(ngrams_2)
-            
-    return distinct_1, distinct_2
-
-# --- 3. 主评估函数 ---
-def evaluate_diversity(file_path: str):
+        return tuple(0.0 for _ in orders)
+    token_hashes = hash_tokens(tokens)
+    scores = []
+    for n in orders:
+        h = ngram_hashes(token_hashes, n)
+        scores.append(len(np.unique(h)) / len(h) if len(h) else 0.0)
+    return tuple(scores)
+
+# --- 3. 语料级统计：HyperLogLog 与 Count-Min Sketch ---
+class HyperLogLog():
+    """基于 numpy 的 HyperLogLog，用固定内存估计不同 n-gram 的数量。"""
+    def __init__(self, p=HLL_PRECISION):
+        self.p = p
+        self.m = 1 << p
+        self.registers = np.zeros(self.m, dtype=np.uint8)
+
+    def update(self, hashes: np.ndarray):
+        if len(hashes) == 0:
+            return
+        idx = (hashes >> np.uint64(64 - self.p)).astype(np.int64)
+        rest = hashes & np.uint64((1 << (64 - self.p)) - 1)
+        rank = np.full(len(hashes), 64 - self.p + 1, dtype=np.uint8)
+        nonzero = rest > 0
+        rank[nonzero] = (64 - self.p) - np.floor(np.log2(rest[nonzero].astype(np.float64))).astype(np.uint8)
+        np.maximum.at(self.registers, idx, rank)
+
+    def count(self) -> float:
+        alpha = 0.7213 / (1 + 1.079 / self.m)
+        estimate = alpha * self.m ** 2 / np.sum(np.power(2.0, -self.registers.astype(np.float64)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * self.m and zeros > 0:
+            estimate = self.m * np.log(self.m / zeros)
+        return float(estimate)
+
+class CountMinSketch():
+    """Count-Min Sketch，用固定内存估计 n-gram 在整个语料中的出现次数（只会高估）。"""
+    def __init__(self, width=CMS_WIDTH, depth=CMS_DEPTH):
+        self.width = width
+        self.depth = depth
+        self.table = np.zeros((depth, width), dtype=np.uint32)
+
+    def _indexes(self, hashes: np.ndarray):
+        return [(_mix64(hashes ^ _CMS_SEEDS[r]) & np.uint64(self.width - 1)).astype(np.int64) for r in range(self.depth)]
+
+    def update(self, hashes: np.ndarray):
+        if len(hashes) == 0:
+            return
+        for r, idx in enumerate(self._indexes(hashes)):
+            self.table[r] += np.bincount(idx, minlength=self.width).astype(np.uint32)
+
+    def query(self, hashes: np.ndarray) -> np.ndarray:
+        return np.min([self.table[r][idx] for r, idx in enumerate(self._indexes(hashes))], axis=0)
+
+def self_bleu_style_score(token_hashes: np.ndarray, orders, sketches) -> float:
     """
-    计算文件中每条生成文本的多样性，并将所有样本的多样性分数取平均作为最终结果。
+    Self-BLEU 风格的跨样本重复度：把语料中其他所有样本当作参考，
+    第 n 阶精度 = sum(min(本样本计数, 其他样本计数)) / 本样本 n-gram 总数，
+    最后取各阶精度的几何平均。其他样本计数 = 语料计数（CMS 估计）- 本样本计数。
     """
-    print(f"开始处理文件: {file_path}")
-    
-    # 用于存储每条数据的详细结果
-    per_line_results = []
-    
-    # 用于计算最终平均分：存储每条样本的d1和d2分数
-    all_d1_scores = []
-    all_d2_scores = []
-    
-    with open(file_path, 'r', encoding='utf-8') as f:
-        lines = f.readlines()
+    log_precisions = []
+    for n in orders:
+        h = ngram_hashes(token_hashes, n)
+        if len(h) == 0:
+            continue
+        grams, own = np.unique(h, return_counts=True)
+        others = sketches[n].query(grams).astype(np.int64) - own
+        clipped = np.minimum(own, np.maximum(others, 0)).sum()
+        log_precisions.append(np.log(max(clipped / len(h), 1e-9)))
+    return float(np.exp(np.mean(log_precisions))) if log_precisions else 0.0
+
+# --- 4. 多进程处理 ---
+_worker_state = {}
+
+def _init_worker(orders, sketches):
+    _worker_state['orders'] = orders
+    _worker_state['sketches'] = sketches
 
-    for i, line in enumerate(tqdm(lines, desc=f"Calculating Diversity for {file_path}")):
+def _process_chunk(chunk):
+    """
+    处理一批 (行号, 原始行)：分词、计算各阶 Distinct-n，
+    并返回该批所有 n-gram 哈希（用于主进程更新语料级统计）。
+    """
+    orders, sketches = _worker_state['orders'], _worker_state['sketches']
+    records, errors = [], []
+    chunk_hashes = {n: [] for n in orders}
+    for line_no, line in chunk:
         try:
             data = json.loads(line)
-            predict_text = data.get('predict', '')
-            
-            tokens = clean_and_tokenize(predict_text)
-            
-            if not tokens:
-                continue
-            
-            # --- 1. 计算单条样本的多样性分数 ---
-            d1_score, d2_score = calculate_distinct_metrics_for_sample(tokens)
-            
-            # --- 2. 存储每条样本的详细结果 ---
-            per_line_results.append({
-                "line_no": i + 1,
-                "token_count": len(tokens),
-                "distinct_1": round(d1_score, 4),
-                "distinct_2": round(d2_score, 4)
-            })
-            
-            # --- 3. 收集分数用于最后计算平均值 ---
-            all_d1_scores.append(d1_score)
-            all_d2_scores.append(d2_score)
-
-        except (json.JSONDecodeError, AttributeError):
-            tqdm.write(f"警告: 第 {i + 1} 行不是有效的JSON格式或内容，已跳过。")
+            tokens = clean_and_tokenize(data.get('predict', ''))
+        except (json.JSONDecodeError, AttributeError, TypeError):
+            errors.append(line_no)
             continue
-            
-    # --- 结果汇总 ---
-    
-    # 计算所有样本分数的平均值
-    final_avg_d1 = np.mean(all_d1_scores) if all_d1_scores else 0
-    final_avg_d2 = np.mean(all_d2_scores) if all_d2_scores else 0
-
-    # 准备最终的概要报告
+        if not tokens:
+            continue
+        token_hashes = hash_tokens(tokens)
+        record = {"line_no": line_no, "token_count": len(tokens)}
+        for n in orders:
+            h = ngram_hashes(token_hashes, n)
+            record[f"distinct_{n}"] = len(np.unique(h)) / len(h) if len(h) else 0.0
+            chunk_hashes[n].append(h)
+        if sketches is not None:
+            record["self_bleu"] = self_bleu_style_score(token_hashes, orders, sketches)
+        records.append(record)
+    chunk_hashes = {n: np.concatenate(hs) if hs else np.empty(0, dtype=np.uint64) for n, hs in chunk_hashes.items()}
+    return records, chunk_hashes, errors
+
+def _iter_chunks(file_path, chunk_size):
+    """流式读取 JSONL，按 chunk_size 行分批，不会一次性读入整个文件。"""
+    chunk = []
+    with open(file_path, 'r', encoding='utf-8') as f:
+        for i, line in enumerate(f):
+            if not line.strip():
+                continue
+            chunk.append((i + 1, line))
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+def _imap_bounded(pool, fn, iterable, max_in_flight):
+    """有序 imap，但同时在途的任务数有上限，保证内存有界。"""
+    in_flight = deque()
+    for item in iterable:
+        in_flight.append(pool.apply_async(fn, (item,)))
+        if len(in_flight) >= max_in_flight:
+            yield in_flight.popleft().get()
+    while in_flight:
+        yield in_flight.popleft().get()
+
+def _run_pass(file_path, orders, sketches, num_workers, chunk_size, desc):
+    if num_workers <= 1:
+        _init_worker(orders, sketches)
+        yield from (_process_chunk(chunk) for chunk in tqdm(_iter_chunks(file_path, chunk_size), desc=desc, unit="chunk"))
+        return
+    with Pool(num_workers, initializer=_init_worker, initargs=(orders, sketches)) as pool:
+        results = _imap_bounded(pool, _process_chunk, _iter_chunks(file_path, chunk_size), num_workers * 2)
+        yield from tqdm(results, desc=desc, unit="chunk")
+
+# --- 5. 主评估函数 ---
+def evaluate_diversity(file_path: str, output_path: str = None, orders=NGRAM_ORDERS, num_workers=NUM_WORKERS,
+                       chunk_size=CHUNK_SIZE, self_bleu=SELF_BLEU):
+    """
+    流式计算文件中每条生成文本的多样性：
+    - 样本级 Distinct-n（逐行写入 Parquet，内存有界）
+    - 语料级 Distinct-n（HyperLogLog 估计不同 n-gram 数 / n-gram 总数）
+    - Self-BLEU 风格的跨样本重复度（可选，需要第二遍扫描）
+    :return: 概要报告 dict
+    """
+    print(f"开始处理文件: {file_path}")
+    orders = tuple(orders)
+    hlls = {n: HyperLogLog() for n in orders}
+    sketches = {n: CountMinSketch() for n in orders} if self_bleu else None
+    total_ngrams = {n: 0 for n in orders}
+    sums = {f"distinct_{n}": 0.0 for n in orders}
+    if self_bleu:
+        sums["self_bleu"] = 0.0
+    valid_count = 0
+    writer = None
+
+    # 第一遍：更新语料级统计；不计算 Self-BLEU 时同时输出样本级结果
+    for records, chunk_hashes, errors in _run_pass(file_path, orders, None, num_workers, chunk_size, "Pass 1/2" if self_bleu else "Calculating Diversity"):
+        for line_no in errors:
+            tqdm.write(f"警告: 第 {line_no} 行不是有效的JSON格式或内容，已跳过。")
+        for n, h in chunk_hashes.items():
+            hlls[n].update(h)
+            total_ngrams[n] += len(h)
+            if sketches is not None:
+                sketches[n].update(h)
+        if not self_bleu:
+            writer = _write_records(writer, records, output_path)
+            valid_count += len(records)
+            for record in records:
+                for key in sums:
+                    sums[key] += record[key]
+
+    # 第二遍：有了语料级 n-gram 计数后，计算每条样本的 Self-BLEU 风格得分
+    if self_bleu:
+        for records, _, _ in _run_pass(file_path, orders, sketches, num_workers, chunk_size, "Pass 2/2"):
+            writer = _write_records(writer, records, output_path)
+            valid_count += len(records)
+            for record in records:
+                for key in sums:
+                    sums[key] += record[key]
+
+    if writer is not None:
+        writer.close()
+
     summary_results = {
         "file_path": file_path,
-        "total_valid_texts": len(per_line_results),
-        "average_distinct_1": f"{final_avg_d1:.4f}",
-        "average_distinct_2": f"{final_avg_d2:.4f}"
+        "total_valid_texts": valid_count,
     }
-    
-    return per_line_results, summary_results
+    for n in orders:
+        summary_results[f"average_distinct_{n}"] = round(sums[f"distinct_{n}"] / valid_count, 4) if valid_count else 0.0
+    for n in orders:
+        corpus_distinct = min(hlls[n].count(), total_ngrams[n]) / total_ngrams[n] if total_ngrams[n] else 0.0
+        summary_results[f"corpus_distinct_{n}"] = round(corpus_distinct, 4)
+        summary_results[f"total_{n}grams"] = total_ngrams[n]
+    if self_bleu:
+        summary_results["average_self_bleu"] = round(sums["self_bleu"] / valid_count, 4) if valid_count else 0.0
+    return summary_results
 
-# --- 4. 运行评估 ---
+def _write_records(writer, records, output_path):
+    """把一批样本级结果追加写入 Parquet。"""
+    if output_path is None or not records:
+        return writer
+    table = pa.Table.from_pylist(records)
+    if writer is None:
+        writer = pq.ParquetWriter(output_path, table.schema)
+    writer.write_table(table)
+    return writer
+
+# --- 6. 运行评估 ---
 if __name__ == "__main__":
-    # 执行评估
-    detailed_results, final_summary = evaluate_diversity(INPUT_FILE)
-    
-    # 保存详细的评估结果到文件
-    if detailed_results:
-        detailed_results.append(final_summary)  # 在详细结果中添加最终概要
-        OUTPUT_FILE = f"diversity_results_{INPUT_FILE}"
-        with open(OUTPUT_FILE, 'w', encoding='utf-8') as f:
-            json.dump(detailed_results, f, ensure_ascii=False, indent=4)
-        print(f"\n详细的评估结果已保存到: {OUTPUT_FILE}")
+    stem = os.path.splitext(os.path.basename(INPUT_FILE))[0]
+    OUTPUT_FILE = f"diversity_results_{stem}.parquet"
+    SUMMARY_FILE = f"diversity_summary_{stem}.json"
+
+    # 执行评估，样本级结果流式写入 Parquet
+    final_summary = evaluate_diversity(INPUT_FILE, OUTPUT_FILE)
+    with open(SUMMARY_FILE, 'w', encoding='utf-8') as f:
+        json.dump(final_summary, f, ensure_ascii=False, indent=2)
+    print(f"\n样本级评估结果已保存到: {OUTPUT_FILE}")
+    print(f"概要报告已保存到: {SUMMARY_FILE}")
 
     # 打印最终的概要报告
     print("\n" + "="*50)
@@ -122,8 +300,9 @@ if __name__ == "__main__":
     print(f"评估文件: {final_summary['file_path']}")
     print(f"有效文本数量: {final_summary['total_valid_texts']}")
     print("-" * 50)
-    print(f"  - Average Distinct-1 (词汇丰富度): {final_summary['average_distinct_1']}")
-    print(f"  - Average Distinct-2 (短语丰富度): {final_summary['average_distinct_2']}")
+    for n in NGRAM_ORDERS:
+        print(f"  - Average Distinct-{n}: {final_summary[f'average_distinct_{n}']:.4f}"
+              f"    Corpus Distinct-{n}: {final_summary[f'corpus_distinct_{n}']:.4f}")
+    if SELF_BLEU:
+        print(f"  - Self-BLEU 风格重复度 (越低越多样): {final_summary['average_self_bleu']:.4f}")
     print("="*50)
-    
-    
\ No newline at end of file
@@ -2,28 +2,37 @@ import os
 import json
 import time
 import re
-from zai import ZhipuAiClient
+import sqlite3
+import asyncio
+import hashlib
+from openai import AsyncOpenAI, RateLimitError
 from tqdm import tqdm
-import numpy as np
-import concurrent.futures
 
 # --- 1. 配置 ---
-# API配置
-API_KEY = "2dce28f531864ae6b382bfd4d2dd3828.dnK3H2D5cZYf6DoQ"
+# API配置（智谱的 OpenAI 兼容接口；设置 JUDGE_BASE_URL 可指向 mock_judge_server.py 做离线压测）
+API_KEY = os.getenv("ZHIPU_APIKEY", "2dce28f531864ae6b382bfd4d2dd3828.dnK3H2D5cZYf6DoQ")
+BASE_URL = os.getenv("JUDGE_BASE_URL", "https://open.bigmodel.cn/api/paas/v4/")
 MODEL_NAME = "glm-4.5-flash"
 TEMPERATURE = 0.7
 
 # 文件名配置
 INPUT_FILE = 'generated_predictions_augmented.jsonl'  # 待评估文件名
-OUTPUT_FILE = f"glm4eval_results_{INPUT_FILE.replace('.jsonl', '.json')}"
+OUTPUT_FILE = f"glm4eval_results_{os.path.splitext(INPUT_FILE)[0]}.jsonl"  # 逐条结果，完成即写入
+SUMMARY_FILE = f"glm4eval_summary_{INPUT_FILE.replace('.jsonl', '.json')}"
 ERROR_LOG_FILE = f"glm4eval_errors_{INPUT_FILE.replace('.jsonl', '.log')}"
+CACHE_FILE = "glm4eval_cache.sqlite"  # 评分结果缓存，按 (模型, 温度, prompt) 的内容哈希复用
 
-# 并发与数据量配置
-CONCURRENCY_LEVEL = 2  # 设置并发请求数
+# 并发与数据量配置：并发数在 [MIN_CONCURRENCY, MAX_CONCURRENCY] 之间根据 429 与延迟自适应调整
+INITIAL_CONCURRENCY = 2
+MIN_CONCURRENCY = 1
+MAX_CONCURRENCY = 32
+LATENCY_TARGET = 30  # 单次请求延迟超过该值（秒）时视为服务端过载，降低并发
+DECREASE_COOLDOWN = 5  # 两次降低并发之间的最短间隔（秒）
 MAX_SAMPLES_TO_EVALUATE = None # 设置为 None 则评估所有数据
 
 # API调用配置
 MAX_RETRIES = 3
+MAX_THROTTLE_RETRIES = 10  # 429 单独计数，不消耗 MAX_RETRIES
 REQUEST_TIMEOUT = 120
 RATE_LIMIT_DELAY = 1
 
@@ -87,129 +96,289 @@ def parse_json_from_response(response_text):
             except json.JSONDecodeError: return None
     return None
 
-def log_error(line_num, error_type, content):
-    with open(ERROR_LOG_FILE, 'a', encoding='utf-8') as f:
-        f.write(f"Line {line_num}: [{error_type}]\nContent: {content}\n\n")
-
-def save_final_results(summary, detailed_results, file_path):
-    final_data = {"summary": summary, "detailed_results": detailed_results}
-    with open(file_path, 'w', encoding='utf-8') as f:
-        json.dump(final_data, f, ensure_ascii=False, indent=4)
-
-def get_summary(results):
-    if not results: return {}
-    score_keys = [key for key in results[0].keys() if key.endswith('_score')]
-    summary = {
-        "evaluation_file": INPUT_FILE, "model_used": MODEL_NAME,
-        "total_valid_samples": len(results), "average_scores": {}
-    }
-    for key in score_keys:
-        scores = [r.get(key) for r in results if isinstance(r.get(key), int)]
-        if scores: summary["average_scores"][key] = round(np.mean(scores), 4)
-    return summary
-
-# --- 4. 处理单条数据的函数 (用于并发) ---
-def process_single_item(data, line_num, client):
-    """处理单条数据，包括API调用和重试逻辑。"""
+class InputFileError(Exception):
+    """读取或解析输入文件失败，与评分过程中的其他错误区分开。"""
+
+def _iter_input_data(file_path):
+    with open(file_path, 'r', encoding='utf-8') as f:
+        if file_path.endswith('.jsonl'):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+            return
+        full_data = json.load(f)
+    if isinstance(full_data, list): yield from full_data
+    elif "detailed_results" in full_data and isinstance(full_data["detailed_results"], list): yield from full_data["detailed_results"]
+    else: raise ValueError("在JSON文件中找不到可评估的数据列表")
+
+def iter_input_data(file_path):
+    """逐条产出待评估数据；JSONL 按行流式读取，JSON 文件只能整体加载。读取或解析失败时抛出 InputFileError。"""
     try:
-        prompt_text = data.get('prompt', '')
-        predict_text = data.get('predict', '')
-
-        if not predict_text.strip():
-            log_error(line_num, "Skipped: Predict text is empty.", "")
-            return None
-        
-        formatted_prompt = PROMPT_TEMPLATE.format(prompt_text=prompt_text, predict_text=predict_text)
-        
-        for attempt in range(MAX_RETRIES):
+        yield from _iter_input_data(file_path)
+    except (OSError, UnicodeDecodeError, ValueError) as e:  # json.JSONDecodeError 是 ValueError 的子类
+        raise InputFileError(str(e)) from e
+
+def cache_key(formatted_prompt):
+    """缓存键：模型、温度与完整 prompt 的内容哈希，模板或模型变化时自然失效。"""
+    payload = json.dumps([MODEL_NAME, TEMPERATURE, formatted_prompt], ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+class ResponseCache():
+    """SQLite 评分缓存：重跑或 A/B 对比时，相同的 (prompt, predict) 不再重复调用 API。"""
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, model TEXT, response TEXT, created_at REAL)')
+        self.conn.commit()
+
+    def get(self, key):
+        row = self.conn.execute('SELECT response FROM responses WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, key, response_json):
+        self.conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)',
+                          (key, MODEL_NAME, json.dumps(response_json, ensure_ascii=False), time.time()))
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+class AdaptiveConcurrency():
+    """
+    AIMD 并发控制：请求成功且延迟正常时每个窗口并发 +1；
+    遇到 429 或延迟超过 LATENCY_TARGET 时并发减半（同一窗口内只减一次）。
+    """
+    def __init__(self, initial=INITIAL_CONCURRENCY, minimum=MIN_CONCURRENCY, maximum=MAX_CONCURRENCY,
+                 latency_target=LATENCY_TARGET):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_target = latency_target
+        self.in_flight = 0
+        self.last_decrease = 0.0
+        self.throttled = 0
+        self.condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self):
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def on_success(self, latency):
+        if latency > self.latency_target:
+            self._decrease()
+        else:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+    def on_throttle(self):
+        self.throttled += 1
+        self._decrease()
+
+    def _decrease(self):
+        now = time.monotonic()
+        # 一个窗口内的请求共享同一次拥塞信号，避免连续 429 把并发一路降到最低
+        if now - self.last_decrease > DECREASE_COOLDOWN:
+            self.limit = max(self.minimum, self.limit / 2)
+            self.last_decrease = now
+
+# --- 4. 评分引擎 (asyncio) ---
+class JudgeRunner():
+    """
+    异步评分引擎：
+    - 自适应并发（AdaptiveConcurrency）
+    - 内容哈希缓存（ResponseCache），同一次运行中相同的请求只发送一次
+    - 结果完成即写入 JSONL，错误日志只打开一次
+    """
+    def __init__(self, client, cache, output_file, error_file):
+        self.client = client
+        self.cache = cache
+        self.output = open(output_file, 'w', encoding='utf-8')
+        self.errors = open(error_file, 'a', encoding='utf-8')
+        self.concurrency = AdaptiveConcurrency()
+        self.pending = {}  # key -> Future，合并同一次运行中重复的请求
+        self.stats = {"api_calls": 0, "cache_hits": 0, "deduplicated": 0, "failed": 0}
+        self.score_sums = {}
+        self.score_counts = {}
+        self.valid_samples = 0
+
+    def log_error(self, line_num, error_type, content):
+        self.errors.write(f"Line {line_num}: [{error_type}]\nContent: {content}\n\n")
+        self.errors.flush()
+
+    def write_result(self, result):
+        self.output.write(json.dumps(result, ensure_ascii=False) + "\n")
+        self.output.flush()
+        self.valid_samples += 1
+        for key, value in result.items():
+            if key.endswith('_score') and isinstance(value, int):
+                self.score_sums[key] = self.score_sums.get(key, 0) + value
+                self.score_counts[key] = self.score_counts.get(key, 0) + 1
+
+    async def call_api(self, formatted_prompt, line_num):
+        """调用评分模型，429 时降低并发并退避重试，其余错误最多重试 MAX_RETRIES 次。"""
+        attempt, throttle_retries, response_content = 0, 0, None
+        while attempt < MAX_RETRIES:
+            delay = 0
+            await self.concurrency.acquire()
+            start = time.monotonic()
             try:
-                response = client.chat.completions.create(
-                    model=MODEL_NAME, 
+                self.stats["api_calls"] += 1
+                response = await self.client.chat.completions.create(
+                    model=MODEL_NAME,
                     messages=[{"role": "user", "content": formatted_prompt}],
                     response_format={"type": "json_object"}, # 结构化输出
-                    thinking={"type": "disabled"},  # 禁止深度思考模式,
+                    extra_body={"thinking": {"type": "disabled"}},  # 禁止深度思考模式
                     temperature=TEMPERATURE, timeout=REQUEST_TIMEOUT, max_tokens=3072
                 )
+                self.concurrency.on_success(time.monotonic() - start)
                 response_content = response.choices[0].message.content
                 response_json = parse_json_from_response(response_content)
                 if response_json:
-                    response_json['original_line_num'] = data.get('line_num', line_num)
                     return response_json
+                attempt += 1
+            except RateLimitError as e:
+                self.concurrency.on_throttle()
+                throttle_retries += 1
+                if throttle_retries > MAX_THROTTLE_RETRIES:
+                    self.log_error(line_num, "Rate limited after max retries", str(e))
+                    return None
+                delay = RATE_LIMIT_DELAY * min(2 ** throttle_retries, 60)
             except Exception as e:
-                if attempt < MAX_RETRIES - 1:
-                    time.sleep(RATE_LIMIT_DELAY * (attempt + 1))
-                else:
-                    log_error(line_num, "API Error after max retries", str(e))
-        
-        log_error(line_num, "Failed to get valid JSON response", response_content if 'response_content' in locals() else 'No response')
-        return None
+                attempt += 1
+                if attempt >= MAX_RETRIES:
+                    self.log_error(line_num, "API Error after max retries", str(e))
+                    return None
+                delay = RATE_LIMIT_DELAY * attempt
+            finally:
+                await self.concurrency.release()
+            if delay:  # 先归还并发名额再退避，等待中的请求不占用名额
+                await asyncio.sleep(delay)
 
-    except Exception as e:
-        log_error(line_num, "Unexpected error in main processing loop", str(e))
+        self.log_error(line_num, "Failed to get valid JSON response", response_content or 'No response')
         return None
 
-# --- 5. 主评估流程 (并发模式) ---
-def main():
+    async def judge(self, formatted_prompt, key, line_num):
+        cached = self.cache.get(key)
+        if cached is not None:
+            self.stats["cache_hits"] += 1
+            return cached
+        if key in self.pending:
+            self.stats["deduplicated"] += 1
+            return await self.pending[key]
+        future = asyncio.get_running_loop().create_future()
+        self.pending[key] = future
+        try:
+            response_json = await self.call_api(formatted_prompt, line_num)
+            if response_json:
+                self.cache.put(key, response_json)
+            future.set_result(response_json)
+            return response_json
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            del self.pending[key]
+
+    async def process_single_item(self, data, line_num):
+        """处理单条数据：查缓存 / 合并重复请求 / 调用 API，完成后立即写出结果。"""
+        try:
+            prompt_text = data.get('prompt', '')
+            predict_text = data.get('predict', '')
+
+            if not predict_text.strip():
+                self.log_error(line_num, "Skipped: Predict text is empty.", "")
+                return
+
+            formatted_prompt = PROMPT_TEMPLATE.format(prompt_text=prompt_text, predict_text=predict_text)
+            response_json = await self.judge(formatted_prompt, cache_key(formatted_prompt), line_num)
+            if response_json is None:
+                self.stats["failed"] += 1
+                return
+            result = dict(response_json)
+            result['original_line_num'] = data.get('line_num', line_num)
+            self.write_result(result)
+        except Exception as e:
+            self.stats["failed"] += 1
+            self.log_error(line_num, "Unexpected error in main processing loop", str(e))
+
+    async def run(self, items, max_samples=None):
+        """
+        流式提交任务：同时存在的任务数受当前并发上限约束，输入文件不会被一次性读入内存。
+        """
+        tasks = set()
+        pbar = tqdm(desc=f"Evaluating with {MODEL_NAME}", unit="sample")
+        for i, data in enumerate(items):
+            if max_samples is not None and i >= max_samples:
+                break
+            # 缓存命中的任务几乎不占时间，这里留出一倍余量保证请求管道始终是满的
+            while len(tasks) >= 2 * max(int(self.concurrency.limit), 1):
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                pbar.update(len(done))
+                pbar.set_postfix(concurrency=int(self.concurrency.limit), throttled=self.concurrency.throttled)
+            tasks.add(asyncio.create_task(self.process_single_item(data, i + 1)))
+        while tasks:
+            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            pbar.update(len(done))
+        pbar.close()
+
+    def get_summary(self):
+        summary = {
+            "evaluation_file": INPUT_FILE, "model_used": MODEL_NAME,
+            "total_valid_samples": self.valid_samples, "average_scores": {},
+            "run_stats": {**self.stats, "throttled": self.concurrency.throttled,
+                          "final_concurrency": int(self.concurrency.limit)}
+        }
+        for key in self.score_sums:
+            summary["average_scores"][key] = round(self.score_sums[key] / self.score_counts[key], 4)
+        return summary
+
+    def close(self):
+        self.output.close()
+        self.errors.close()
+
+# --- 5. 主评估流程 ---
+async def evaluate(input_file=INPUT_FILE, output_file=OUTPUT_FILE, max_samples=MAX_SAMPLES_TO_EVALUATE):
+    client = AsyncOpenAI(api_key=API_KEY, base_url=BASE_URL, max_retries=0)  # 重试与限流由 JudgeRunner 自己控制
+    cache = ResponseCache(CACHE_FILE)
+    runner = JudgeRunner(client, cache, output_file, ERROR_LOG_FILE)
     try:
-        client = ZhipuAiClient(api_key=API_KEY)
-    except Exception as e:
-        print(f"初始化 ZhipuAiClient 失败: {e}")
-        return
+        await runner.run(iter_input_data(input_file), max_samples)
+    finally:
+        runner.close()
+        cache.close()
+        await client.close()
+    return runner.get_summary()
 
+def main():
+    print(f"开始评估 {INPUT_FILE} (初始并发数: {INITIAL_CONCURRENCY}, 上限: {MAX_CONCURRENCY}, 接口: {BASE_URL})。")
     try:
-        with open(INPUT_FILE, 'r', encoding='utf-8') as f:
-            if INPUT_FILE.endswith('.jsonl'):
-                lines = f.readlines()
-                input_data = [json.loads(line) for line in lines if line.strip()]
-            else:
-                full_data = json.load(f)
-                if isinstance(full_data, list): input_data = full_data
-                elif "detailed_results" in full_data and isinstance(full_data["detailed_results"], list): input_data = full_data["detailed_results"]
-                elif "predict" in full_data[0]: input_data = full_data
-                else: raise ValueError("在JSON文件中找不到可评估的数据列表")
-    except Exception as e:
+        final_summary = asyncio.run(evaluate())
+    except InputFileError as e:
         print(f"读取或解析输入文件 {INPUT_FILE} 时失败: {e}")
         return
 
-    # 根据配置对数据进行切片
-    if MAX_SAMPLES_TO_EVALUATE is not None:
-        input_data = input_data[:MAX_SAMPLES_TO_EVALUATE]
-    
-    print(f"成功提取 {len(input_data)} 条数据进行评估 (并发数: {CONCURRENCY_LEVEL})。")
-
-    detailed_results = []
-    with concurrent.futures.ThreadPoolExecutor(max_workers=CONCURRENCY_LEVEL) as executor:
-        # 提交所有任务
-        future_to_line_num = {executor.submit(process_single_item, data, i + 1, client): i + 1 for i, data in enumerate(input_data)}
-        
-        # 使用tqdm显示并发处理进度
-        for future in tqdm(concurrent.futures.as_completed(future_to_line_num), total=len(input_data), desc=f"Evaluating with {MODEL_NAME}"):
-            result = future.result()
-            if result:
-                detailed_results.append(result)
-
     print("\n评估流程全部完成。正在生成最终报告...")
+    with open(SUMMARY_FILE, 'w', encoding='utf-8') as f:
+        json.dump(final_summary, f, ensure_ascii=False, indent=4)
 
-    # 排序结果，确保输出文件顺序与输入文件一致
-    detailed_results.sort(key=lambda x: x['original_line_num'])
-
-    final_summary = get_summary(detailed_results)
-    save_final_results(final_summary, detailed_results, OUTPUT_FILE)
-
-    print(f"评估报告已成功保存到: {OUTPUT_FILE}")
+    print(f"逐条评分结果已保存到: {OUTPUT_FILE}（按完成顺序，original_line_num 为原始行号）")
+    print(f"评估报告已成功保存到: {SUMMARY_FILE}")
     print("\n" + "="*50)
     print(f"           {MODEL_NAME} Evaluation Summary")
     print("="*50)
     for key, value in final_summary.items():
-        if key == "average_scores":
+        if key in ("average_scores", "run_stats"):
             print("-" * 50)
             for metric, score in value.items():
-                print(f"  - Average {metric}: {score}")
+                print(f"  - {'Average ' if key == 'average_scores' else ''}{metric}: {score}")
         else:
             print(f"{key}: {value}")
     print("="*50)
 
 if __name__ == "__main__":
     main()
-    
-    
\ No newline at end of file
@@ -1,59 +1,180 @@
 import gradio as gr
 import json
 import os
-from collections import Counter
+import time
+import sqlite3
+import threading
+import numpy as np
 
 # --- 1. 全局配置 ---
 # 配置两个需要对比的模型输出文件
 FILE_A = "pred/generated_predictions_cleaned.jsonl"    # 模型 A (例如：增强前)
 FILE_B = "generated_predictions_augmented.jsonl"  # 模型 B (例如：增强后)
 
-# 自动生成评分文件名
+# 自动生成评分文件名：SQLite 保存逐条评分，JSON 为导出的汇总报告（旧版评分文件会被自动导入）
 SCORES_FILE = f"{os.path.splitext(FILE_A)[0]}_vs_{os.path.splitext(os.path.basename(FILE_B))[0]}_scores.json"
+SCORES_DB = SCORES_FILE.replace('.json', '.sqlite')
+DEFAULT_ANNOTATOR = "default"
+CHOICES = ["模型 A 更好", "模型 B 更好", "平局 / 质量相当"]
 
 # --- 2. 数据加载与状态管理 ---
-merged_data = []
-scores = {}
+class JsonlIndex():
+    """
+    JSONL 行偏移索引：启动时只扫描一遍换行符位置，之后按行号 O(1) 随机读取。
+    索引缓存在 <文件>.idx.npy，文件大小和修改时间不变时直接复用；目录只读时只保留内存中的索引。
+    """
+    def __init__(self, path, chunk_size=1 << 24):
+        self.path = path
+        stat = os.stat(path)
+        index_path = f"{path}.idx.npy"
+        cached = np.load(index_path) if os.path.exists(index_path) else None
+        if cached is not None and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            self.offsets = cached[2:]
+        else:
+            self.offsets = self._build(path, stat.st_size, chunk_size)
+            try:
+                np.save(index_path, np.concatenate([[stat.st_size, stat.st_mtime_ns], self.offsets]).astype(np.int64))
+            except OSError as e:
+                print(f"⚠️ 无法写入索引缓存 {index_path}（{e}），本次使用内存中的索引")
+        self.fd = os.open(path, os.O_RDONLY)
+
+    @staticmethod
+    def _build(path, size, chunk_size):
+        """返回每一非空行的 [起始, 结束) 偏移，形状为 (2 * 行数,)。"""
+        starts, ends, pos = [np.zeros(1, dtype=np.int64)], [], 0
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                newlines = np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == ord('\n')) + pos
+                ends.append(newlines)
+                starts.append(newlines + 1)
+                pos += len(chunk)
+        starts = np.concatenate(starts).astype(np.int64)
+        ends = np.concatenate(ends + [np.array([size])]).astype(np.int64)
+        keep = ends - starts > 0  # 跳过空行（含文件末尾换行之后的空串）
+        return np.stack([starts[keep], ends[keep]], axis=1).ravel()
+
+    def __len__(self):
+        return len(self.offsets) // 2
+
+    def __getitem__(self, i):
+        start, end = self.offsets[2 * i], self.offsets[2 * i + 1]
+        # os.pread 不依赖文件指针，多个请求线程可以同时读取
+        return json.loads(os.pread(self.fd, int(end - start), int(start)).decode('utf-8').strip())
+
+class ScoreStore():
+    """
+    评分存储（SQLite，WAL 模式）：每次评分只写一行，并在同一事务中增量维护胜/平计数，
+    不再每次点击都重写整个 JSON。按评测人区分评分，多人可以同时评测。
+    """
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        conn = self._conn()
+        conn.executescript('''
+            CREATE TABLE IF NOT EXISTS scores (
+                idx INTEGER NOT NULL,
+                annotator TEXT NOT NULL,
+                choice TEXT NOT NULL,
+                updated_at REAL,
+                PRIMARY KEY (idx, annotator)
+            );
+            CREATE TABLE IF NOT EXISTS counters (
+                annotator TEXT NOT NULL,
+                choice TEXT NOT NULL,
+                n INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (annotator, choice)
+            );
+        ''')
+
+    def _conn(self):
+        # 每个线程一个连接，写入时由 SQLite 的文件锁保证多进程/多线程安全
+        if getattr(self.local, 'conn', None) is None:
+            self.local.conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            self.local.conn.execute('PRAGMA journal_mode=WAL')
+        return self.local.conn
+
+    def set(self, index, choice, annotator=DEFAULT_ANNOTATOR):
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT choice FROM scores WHERE idx = ? AND annotator = ?', (index, annotator)).fetchone()
+            old = row[0] if row else None
+            if old != choice:
+                conn.execute('INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?)', (index, annotator, choice, time.time()))
+                if old is not None:
+                    conn.execute('UPDATE counters SET n = n - 1 WHERE annotator = ? AND choice = ?', (annotator, old))
+                conn.execute('INSERT INTO counters VALUES (?, ?, 1) ON CONFLICT (annotator, choice) DO UPDATE SET n = n + 1',
+                             (annotator, choice))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def get(self, index, annotator=DEFAULT_ANNOTATOR):
+        row = self._conn().execute('SELECT choice FROM scores WHERE idx = ? AND annotator = ?', (index, annotator)).fetchone()
+        return row[0] if row else None
+
+    def counts(self, annotator=None):
+        """返回 {choice: 次数}；annotator 为 None 时汇总所有评测人。"""
+        if annotator is None:
+            rows = self._conn().execute('SELECT choice, SUM(n) FROM counters GROUP BY choice').fetchall()
+        else:
+            rows = self._conn().execute('SELECT choice, n FROM counters WHERE annotator = ?', (annotator,)).fetchall()
+        return {choice: n for choice, n in rows if n}
+
+    def all_scores(self, annotator=DEFAULT_ANNOTATOR):
+        rows = self._conn().execute('SELECT idx, choice FROM scores WHERE annotator = ? ORDER BY idx', (annotator,)).fetchall()
+        return {str(idx): choice for idx, choice in rows}
+
+    def import_legacy(self, json_path, annotator=DEFAULT_ANNOTATOR):
+        """数据库为空时导入旧版 JSON 评分文件，兼容新旧两种格式。"""
+        if not os.path.exists(json_path) or self._conn().execute('SELECT 1 FROM scores LIMIT 1').fetchone():
+            return 0
+        with open(json_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        # 兼容新格式 (带summary) 和旧格式 (只有scores)
+        legacy = data["scores"] if isinstance(data, dict) and "scores" in data else data
+        for index, choice in legacy.items():
+            self.set(int(index), choice, annotator)
+        return len(legacy)
+
+data_a = None
+data_b = None
+store = None
 
 def load_data():
-    """从两个文件中加载数据并将它们按行合并。"""
-    global merged_data
-    merged_data = []
-    data_a, data_b = [], []
-    try:
-        with open(FILE_A, 'r', encoding='utf-8') as f:
-            for line in f: data_a.append(json.loads(line.strip()))
-    except FileNotFoundError: return 0
+    """为两个文件建立行偏移索引，按行号对齐，不把内容读入内存。"""
+    global data_a, data_b
+    if data_a is not None and data_b is not None:
+        return min(len(data_a), len(data_b))
     try:
-        with open(FILE_B, 'r', encoding='utf-8') as f:
-            for line in f: data_b.append(json.loads(line.strip()))
+        data_a, data_b = JsonlIndex(FILE_A), JsonlIndex(FILE_B)
     except FileNotFoundError: return 0
-
-    min_len = min(len(data_a), len(data_b))
-    for i in range(min_len):
-        merged_data.append({
-            "prompt": data_a[i].get("prompt", "N/A"),
-            "predict_A": data_a[i].get("predict", "N/A"),
-            "predict_B": data_b[i].get("predict", "N/A")
-        })
-    print(f"数据加载完成，共 {len(merged_data)} 条可供评测。")
-    return len(merged_data)
+    num_samples = min(len(data_a), len(data_b))
+    print(f"数据索引完成，共 {num_samples} 条可供评测。")
+    return num_samples
 
 def load_scores():
-    """加载评分，兼容新旧两种格式。"""
-    global scores
-    if os.path.exists(SCORES_FILE):
-        with open(SCORES_FILE, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            # 兼容新格式 (带summary) 和旧格式 (只有scores)
-            if isinstance(data, dict) and "scores" in data:
-                scores = data["scores"]
-            else:
-                scores = data
-            scores = {str(k): v for k, v in scores.items()}
-        print(f"成功加载 {len(scores)} 条已有评分。")
-    else:
-        scores = {}
+    """打开评分数据库，首次运行时导入旧版 JSON 评分。"""
+    global store
+    if store is not None:
+        return
+    store = ScoreStore(SCORES_DB)
+    imported = store.import_legacy(SCORES_FILE)
+    if imported:
+        print(f"成功导入 {imported} 条旧版评分。")
+    print(f"评分数据库: {SCORES_DB}，已有评分 {sum(store.counts().values())} 条。")
+
+def get_merged_sample(index):
+    sample_a, sample_b = data_a[index], data_b[index]
+    return {
+        "prompt": sample_a.get("prompt", "N/A"),
+        "predict_A": sample_a.get("predict", "N/A"),
+        "predict_B": sample_b.get("predict", "N/A")
+    }
 
 # --- 3. 核心交互函数 ---
 def create_colored_html(prompt, predict):
@@ -65,24 +186,25 @@ def create_colored_html(prompt, predict):
         f"</div>"
     )
 
-def get_sample(index):
+def get_sample(index, annotator=DEFAULT_ANNOTATOR):
     """获取指定索引的数据并准备显示。"""
     index = int(index)
-    sample = merged_data[index]
+    sample = get_merged_sample(index)
     html_a = create_colored_html(sample.get("prompt"), sample.get("predict_A"))
     html_b = create_colored_html(sample.get("prompt"), sample.get("predict_B"))
-    current_choice = scores.get(str(index))
+    current_choice = store.get(index, annotator or DEFAULT_ANNOTATOR)
     rating_status = f"状态: 已评分 ({current_choice})" if current_choice else "状态: 尚未评分"
-    status = f"正在查看第 {index + 1} / {len(merged_data)} 条"
+    status = f"正在查看第 {index + 1} / {min(len(data_a), len(data_b))} 条"
     return html_a, html_b, current_choice, status, rating_status
 
-def get_score_stats(total_samples_count):
-    """计算核心统计数据并返回一个字典。"""
-    rated_count = len(scores)
+def get_score_stats(total_samples_count, annotator=None):
+    """根据增量维护的计数器计算核心统计数据；annotator 为 None 时汇总所有评测人。"""
+    counts = store.counts(annotator)
+    rated_count = sum(counts.values())
     if rated_count == 0:
-        return {"rated_count": 0, "win_a": 0, "win_b": 0, "tie": 0, "win_a_p": 0, "win_b_p": 0, "tie_p": 0}
-    
-    counts = Counter(scores.values())
+        return {"rated_count": 0, "total_count": total_samples_count, "win_a": 0, "win_b": 0, "tie": 0,
+                "win_a_p": 0, "win_b_p": 0, "tie_p": 0}
+
     win_a = counts.get("模型 A 更好", 0)
     win_b = counts.get("模型 B 更好", 0)
     tie = counts.get("平局 / 质量相当", 0)
@@ -96,24 +218,28 @@ def get_score_stats(total_samples_count):
         "tie_p": f"{tie/rated_count:.2%}",
     }
 
-def generate_analysis_text(stats):
+def generate_analysis_text(stats, overall=None):
     """根据统计数据字典生成供显示的文本。"""
     if stats['rated_count'] == 0:
-        return "尚未对任何样本进行评分。"
-    
-    return (
-        f"已评分/总量: {stats['rated_count']} / {stats['total_count']}\n"
-        f"模型 A 胜: {stats['win_a']} ({stats['win_a_p']})\n"
-        f"模型 B 胜: {stats['win_b']} ({stats['win_b_p']})\n"
-        f"平局: {stats['tie']} ({stats['tie_p']})"
-    )
+        text = "尚未对任何样本进行评分。"
+    else:
+        text = (
+            f"已评分/总量: {stats['rated_count']} / {stats['total_count']}\n"
+            f"模型 A 胜: {stats['win_a']} ({stats['win_a_p']})\n"
+            f"模型 B 胜: {stats['win_b']} ({stats['win_b_p']})\n"
+            f"平局: {stats['tie']} ({stats['tie_p']})"
+        )
+    if overall is not None and overall['rated_count'] != stats['rated_count']:
+        text += f"\n全部评测人: A {overall['win_a']} / B {overall['win_b']} / 平 {overall['tie']}"
+    return text
 
-def save_scores_and_summary(total_samples_count):
-    """【核心修改】保存包含概要和详细评分的完整JSON文件。"""
-    stats = get_score_stats(total_samples_count)
+def save_scores_and_summary(total_samples_count, annotator=DEFAULT_ANNOTATOR):
+    """导出包含概要和详细评分的完整JSON文件（按需导出，评分本身已实时写入数据库）。"""
+    stats = get_score_stats(total_samples_count, annotator)
     summary = {
         "model_a_file": FILE_A,
         "model_b_file": FILE_B,
+        "annotator": annotator,
         "rated_samples": stats['rated_count'],
         "total_samples": stats['total_count'],
         "score_distribution": {
@@ -127,22 +253,24 @@ def save_scores_and_summary(total_samples_count):
             "ties": stats['tie_p']
         }
     }
-    final_data = {"summary": summary, "scores": scores}
-    with open(SCORES_FILE, 'w', encoding='utf-8') as f:
+    final_data = {"summary": summary, "scores": store.all_scores(annotator)}
+    tmp_path = SCORES_FILE + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
         json.dump(final_data, f, indent=4, ensure_ascii=False)
+    os.replace(tmp_path, SCORES_FILE)
+    return f"已导出 {stats['rated_count']} 条评分到 {SCORES_FILE}"
 
-def update_score_and_analysis(index, choice, total_samples_count):
-    """【核心修改】评分后，立即更新状态、保存并刷新分析结果。"""
+def update_score_and_analysis(index, choice, total_samples_count, annotator=DEFAULT_ANNOTATOR):
+    """评分后只写入一行并增量更新计数器，然后刷新分析结果。"""
     if index is None or choice is None:
         return "状态未知", "分析结果待更新"
     
-    index = int(index)
-    scores[str(index)] = choice
-    save_scores_and_summary(total_samples_count)
+    annotator = annotator or DEFAULT_ANNOTATOR
+    store.set(int(index), choice, annotator)
     
     rating_status = f"状态: 已评分 ({choice})"
-    stats = get_score_stats(total_samples_count)
-    analysis_text = generate_analysis_text(stats)
+    analysis_text = generate_analysis_text(get_score_stats(total_samples_count, annotator),
+                                           get_score_stats(total_samples_count))
     
     return rating_status, analysis_text
 
@@ -165,7 +293,7 @@ with gr.Blocks(theme=gr.themes.Soft(primary_hue="blue"), title= "生成文本质
     gr.Markdown("---")
 
     score_radio = gr.Radio(
-        ["模型 A 更好", "模型 B 更好", "平局 / 质量相当"], 
+        CHOICES,
         label="哪个续写更好？",
         info="请综合考虑流畅度、连贯性、信息量和相关性。"
     )
@@ -173,6 +301,7 @@ with gr.Blocks(theme=gr.themes.Soft(primary_hue="blue"), title= "生成文本质
     with gr.Row(equal_height=True):
         with gr.Column(min_width=250):
             gr.Markdown("#### 导航")
+            annotator_input = gr.Textbox(label="评测人", value=DEFAULT_ANNOTATOR)
             with gr.Row():
                 prev_button = gr.Button("⬅️ 上一条")
                 next_button = gr.Button("下一条 ➡️")
@@ -187,39 +316,43 @@ with gr.Blocks(theme=gr.themes.Soft(primary_hue="blue"), title= "生成文本质
         with gr.Column(min_width=300):
             # 【核心修改】分析框现在直接显示，不再需要按钮
             gr.Markdown("#### 实时分析结果")
-            analysis_output = gr.Textbox(label="评分分布", lines=4, interactive=False)
+            analysis_output = gr.Textbox(label="评分分布", lines=5, interactive=False)
+            export_button = gr.Button("导出评分报告")
 
     # --- 5. 事件处理逻辑 ---
     
     # 【核心修改】评分选项改变时，调用新函数更新状态和分析结果
     score_radio.change(
         update_score_and_analysis, 
-        inputs=[current_index, score_radio, total_samples], 
+        inputs=[current_index, score_radio, total_samples, annotator_input], 
         outputs=[rating_status_text, analysis_output]
     )
 
-    def go_to_and_update(index, total):
+    def go_to_and_update(index, total, annotator):
         new_index = int(index) if total > 0 and 0 <= int(index) < total else current_index.value
-        html_a, html_b, choice, status, rating_status = get_sample(new_index)
+        html_a, html_b, choice, status, rating_status = get_sample(new_index, annotator)
         return new_index, html_a, html_b, choice, status, rating_status
 
-    def prev_sample(index, total): return go_to_and_update(max(0, int(index) - 1), total)
-    def next_sample(index, total): return go_to_and_update(min(total - 1, int(index) + 1), total)
+    def prev_sample(index, total, annotator): return go_to_and_update(max(0, int(index) - 1), total, annotator)
+    def next_sample(index, total, annotator): return go_to_and_update(min(total - 1, int(index) + 1), total, annotator)
 
     outputs_for_nav = [current_index, prediction_a_html, prediction_b_html, score_radio, status_text, rating_status_text]
     
-    prev_button.click(prev_sample, inputs=[current_index, total_samples], outputs=outputs_for_nav)
-    next_button.click(next_sample, inputs=[current_index, total_samples], outputs=outputs_for_nav)
-    go_button.click(go_to_and_update, inputs=[index_input, total_samples], outputs=outputs_for_nav)
-    index_input.submit(go_to_and_update, inputs=[index_input, total_samples], outputs=outputs_for_nav)
+    prev_button.click(prev_sample, inputs=[current_index, total_samples, annotator_input], outputs=outputs_for_nav)
+    next_button.click(next_sample, inputs=[current_index, total_samples, annotator_input], outputs=outputs_for_nav)
+    go_button.click(go_to_and_update, inputs=[index_input, total_samples, annotator_input], outputs=outputs_for_nav)
+    index_input.submit(go_to_and_update, inputs=[index_input, total_samples, annotator_input], outputs=outputs_for_nav)
+    # 切换评测人时刷新当前样本的评分状态
+    annotator_input.submit(go_to_and_update, inputs=[current_index, total_samples, annotator_input], outputs=outputs_for_nav)
+    export_button.click(save_scores_and_summary, inputs=[total_samples, annotator_input], outputs=[rating_status_text])
 
     def on_load():
+        # 索引和数据库在进程内只初始化一次，所有浏览器会话共享
         num_samples = load_data()
         load_scores()
         html_a, html_b, choice, status, rating_status = get_sample(0)
-        # 【核心修改】加载时也计算一次分析结果
-        stats = get_score_stats(num_samples)
-        analysis_text = generate_analysis_text(stats)
+        # 加载时也计算一次分析结果
+        analysis_text = generate_analysis_text(get_score_stats(num_samples, DEFAULT_ANNOTATOR), get_score_stats(num_samples))
         return num_samples, 0, html_a, html_b, choice, status, rating_status, analysis_text
     
     # 【核心修改】demo.load的输出增加了 analysis_output
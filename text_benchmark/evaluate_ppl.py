@@ -1,15 +1,22 @@
+import os
 import json
 import re
 import numpy as np
 import torch
-from lmppl import MaskedLM 
+from tqdm import tqdm
+from transformers import AutoModelForMaskedLM, AutoTokenizer
 
 # --- 1. 配置---
 MODEL_NAME = '/home/remote1/lvshuyang/Models/hfl/chinese-bert-wwm-ext'  # 本地模型路径
 INPUT_FILE = 'generated_predictions_augmented.jsonl' # 待评估的文件
-BATCH_SIZE = 16     # 批次大小
+BATCH_SIZE = 16     # 批次大小（每个批次的掩码序列条数）
 PPL_THRESHOLD = 500 # PPL阈值，来识别和过滤异常值
 DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
+MAX_LENGTH = 512    # 最大token长度
+POOL_LINES = 256    # 跨文档调度：每次从多少行中汇集句子、按长度分桶后统一计算
+NUM_MASK_PASSES = None  # None：精确伪困惑度（每个 token 单独掩码一次）；整数 k：近似模式，每句只做 k 次前向
+NUM_THREADS = os.cpu_count() or 1  # CPU 推理时 PyTorch 的线程数
+USE_FP16 = False    # 仅在 GPU 上生效：半精度更快，但结果与 fp32 的 lmppl 基线及 PPL_THRESHOLD 不再严格可比
 
 # --- 2. 句子拆分函数---
 def split_sentences(text):
@@ -25,81 +32,177 @@ def split_sentences(text):
         result.append(sentences[-1].strip())
     return result
 
-# --- 3. 主评估流程 ---
-def evaluate_fluency(model_name, file_path, device, batch_size):
+# --- 3. 掩码语言模型伪困惑度 ---
+class MaskedLMScorer():
+    """
+    掩码语言模型伪困惑度 (pseudo-perplexity)：PPL = exp(平均每个 token 被掩码后的负对数似然)。
+    - 精确模式：每个 token 单独掩码一次，一句 n 个 token 需要 n 次前向
+    - 近似模式 (num_mask_passes=k)：第 g 次前向同时掩码位置 g, g+k, g+2k, ...，一句只需 min(k, n) 次前向
+    所有句子的掩码序列按长度排序后组成固定大小的批次，减少 padding 和调用开销。
+    """
+    def __init__(self, model_name, device=DEVICE, max_length=MAX_LENGTH, num_threads=NUM_THREADS, fp16=USE_FP16):
+        if device == 'cpu' and num_threads:
+            torch.set_num_threads(num_threads)
+        self.device = device
+        self.max_length = max_length
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.model = AutoModelForMaskedLM.from_pretrained(model_name).to(device).eval()
+        if fp16 and device != 'cpu':
+            self.model.half()
+
+    def get_perplexity(self, sentences, batch_size=BATCH_SIZE, num_mask_passes=NUM_MASK_PASSES):
+        """计算一批句子（可来自不同文档）的伪困惑度，返回与输入顺序一致的列表。"""
+        encoded = self.tokenizer(sentences, truncation=True, max_length=self.max_length)['input_ids']
+        lengths = np.array([len(ids) for ids in encoded])
+        num_tokens = np.maximum(lengths - 2, 0)  # 不计 [CLS] / [SEP]
+
+        # 每一行是 (句子下标, 掩码组号)，按句子长度排序后切成批次
+        passes = num_tokens if num_mask_passes is None else np.minimum(num_tokens, num_mask_passes)
+        row_sentence = np.repeat(np.arange(len(sentences)), passes)
+        row_group = np.concatenate([np.arange(p) for p in passes]) if len(passes) else np.empty(0, dtype=np.int64)
+        order = np.argsort(lengths[row_sentence], kind='stable')
+        row_sentence, row_group = row_sentence[order], row_group[order]
+
+        nll_sum = torch.zeros(len(sentences), dtype=torch.float64)
+        nll_count = torch.zeros(len(sentences), dtype=torch.float64)
+        pad_id = self.tokenizer.pad_token_id or 0
+        with torch.inference_mode():
+            for start in range(0, len(row_sentence), batch_size):
+                rows = row_sentence[start:start + batch_size]
+                groups = row_group[start:start + batch_size]
+                max_len = int(lengths[rows].max())
+                input_ids = torch.full((len(rows), max_len), pad_id, dtype=torch.long)
+                for r, s in enumerate(rows):
+                    input_ids[r, :lengths[s]] = torch.tensor(encoded[s])
+
+                # 掩码位置：第 1..n 个 token 中 (位置-1) % 组数 == 组号 的位置
+                positions = torch.arange(max_len).unsqueeze(0)
+                n = torch.from_numpy(num_tokens[rows]).unsqueeze(1)
+                k = torch.from_numpy(passes[rows]).unsqueeze(1).clamp(min=1)
+                mask = (positions >= 1) & (positions <= n) & ((positions - 1) % k == torch.from_numpy(groups).unsqueeze(1))
+                targets = input_ids[mask]
+                input_ids[mask] = self.tokenizer.mask_token_id
+                attention_mask = (positions < torch.from_numpy(lengths[rows]).unsqueeze(1)).long()
+
+                logits = self.model(input_ids=input_ids.to(self.device),
+                                    attention_mask=attention_mask.to(self.device)).logits
+                log_probs = torch.log_softmax(logits[mask.to(self.device)].float(), dim=-1)
+                nll = -log_probs.gather(1, targets.to(self.device).unsqueeze(1)).squeeze(1).double().cpu()
+
+                # 把每个被掩码 token 的 NLL 累加回所属句子
+                token_sentence = torch.from_numpy(rows).unsqueeze(1).expand_as(mask)[mask]
+                nll_sum.index_add_(0, token_sentence, nll)
+                nll_count.index_add_(0, token_sentence, torch.ones_like(nll))
+
+        ppl = torch.exp(nll_sum / nll_count.clamp(min=1))
+        return [float(p) if c > 0 else float('nan') for p, c in zip(ppl, nll_count)]
+
+    def get_document_perplexity(self, texts, batch_size=BATCH_SIZE, num_mask_passes=NUM_MASK_PASSES):
+        """
+        跨文档计算：汇集多篇文本拆出的句子一起分桶计算，再按区间拆回各篇。
+        :return: 每篇文本的句子 PPL 列表（无有效句子时为空列表）
+        """
+        pooled_sentences, spans = [], []
+        for text in texts:
+            sentences = split_sentences(text)
+            spans.append((len(pooled_sentences), len(sentences)))
+            pooled_sentences.extend(sentences)
+        pooled_scores = self.get_perplexity(pooled_sentences, batch_size, num_mask_passes) if pooled_sentences else []
+        return [[s for s in pooled_scores[offset:offset + count] if not np.isnan(s)] for offset, count in spans]
+
+# --- 4. 主评估流程 ---
+def _iter_line_pools(file_path, pool_lines):
+    """流式读取文件，每次产出 pool_lines 行 (行号, 原始行)。"""
+    pool = []
+    with open(file_path, 'r', encoding='utf-8') as f:
+        for i, line in enumerate(f):
+            pool.append((i + 1, line))
+            if len(pool) >= pool_lines:
+                yield pool
+                pool = []
+    if pool:
+        yield pool
+
+def evaluate_fluency(model_name, file_path, device, batch_size, pool_lines=POOL_LINES, num_mask_passes=NUM_MASK_PASSES,
+                     fp16=USE_FP16):
     print(f"正在从本地路径加载MaskedLM模型: {model_name} 到设备: {device}")
-    
+
     try:
-        scorer = MaskedLM(
-            model=model_name, 
-            max_length=512 # 最大token长度
-        )
+        scorer = MaskedLMScorer(model_name, device=device, max_length=MAX_LENGTH, fp16=fp16)
     except Exception as e:
         print(f"加载模型失败，请检查路径是否正确。错误: {e}")
         return None
 
-    print("模型加载完毕。开始处理文件...")
-    
+    mode = "精确" if num_mask_passes is None else f"近似 (每句 {num_mask_passes} 次前向)"
+    print(f"模型加载完毕。开始处理文件... 伪困惑度模式: {mode}")
+
     results = []
     all_ppl_scores = []
-    
-    with open(file_path, 'r', encoding='utf-8') as f:
-        lines = f.readlines()
-        
-    # 对每一行的数据进行评测
-    for i, line in enumerate(lines):
-        try:
-            data = json.loads(line)
-            # 将 prompt 和 predict 拼接
-            predict_text = data.get('prompt', '') + data.get('predict', '')
+    total_lines = 0
+
+    for pool in tqdm(_iter_line_pools(file_path, pool_lines), desc="Scoring pools", unit="pool"):
+        # 汇集多行的文本一起计算，算完后再拆回各行
+        line_nos, texts = [], []
+        for line_no, line in pool:
+            total_lines += 1
+            try:
+                data = json.loads(line)
+                # 将 prompt 和 predict 拼接
+                predict_text = data.get('prompt', '') + data.get('predict', '')
+            except json.JSONDecodeError:
+                print(f"警告：第 {line_no} 行不是有效的JSON格式，已跳过。")
+                continue
 
             if not predict_text.strip():
-                print(f"处理第 {i + 1} 行时发生错误: {'预测文本为空，已跳过。'}")
+                print(f"处理第 {line_no} 行时发生错误: {'预测文本为空，已跳过。'}")
                 continue
 
-            sentences = split_sentences(predict_text)
+            line_nos.append(line_no)
+            texts.append(predict_text)
 
-            if not sentences:
-                print(f"处理第 {i + 1} 行时发生错误: {'无法拆分出有效句子，已跳过。'}")
-                continue
+        if not texts:
+            continue
+        try:
+            pooled_scores = scorer.get_document_perplexity(texts, batch_size=batch_size, num_mask_passes=num_mask_passes)
+        except Exception as e:
+            print(f"处理第 {pool[0][0]}-{pool[-1][0]} 行时发生错误: {e}")
+            continue
 
-            # 计算PPL
-            ppl_scores = scorer.get_perplexity(sentences, batch_size=batch_size)
+        for line_no, ppl_scores in zip(line_nos, pooled_scores):
+            if not ppl_scores:
+                print(f"处理第 {line_no} 行时发生错误: {'无法拆分出有效句子，已跳过。'}")
+                continue
 
             # 检查是否存在异常PPL值，如果存在则跳过该样本
             if any(score > PPL_THRESHOLD for score in ppl_scores):
-                print(f"警告：第 {i + 1} 行包含PPL异常值 (>{PPL_THRESHOLD})，已忽略该样本。异常值: {max(ppl_scores):.2f}")
-                continue 
+                print(f"警告：第 {line_no} 行包含PPL异常值 (>{PPL_THRESHOLD})，已忽略该样本。异常值: {max(ppl_scores):.2f}")
+                continue
 
             avg_ppl = np.mean(ppl_scores)
             all_ppl_scores.append(avg_ppl)
-            
+
             # 记录结果
             results.append({
-                "line_no": i + 1,
-                "sentence_count": len(sentences),
+                "line_no": line_no,
+                "sentence_count": len(ppl_scores),
                 "ppl_scores": ppl_scores,
                 "average_ppl": avg_ppl
             })
 
-            if (i + 1) % 10 == 0 or (i + 1) == len(lines):
-                print(f"已处理 {i + 1}/{len(lines)} 条数据，当前平均PPL: {np.mean(all_ppl_scores):.4f}")
-
-        except json.JSONDecodeError:
-            print(f"警告：第 {i + 1} 行不是有效的JSON格式，已跳过。")
-        except Exception as e:
-            print(f"处理第 {i + 1} 行时发生错误: {e}")
+        print(f"已处理 {total_lines} 条数据，当前平均PPL: {np.mean(all_ppl_scores) if all_ppl_scores else 0:.4f}")
 
     total_avg_ppl = np.mean(all_ppl_scores) if all_ppl_scores else 0
 
     # 将最终总结 append 到结果列表中
     results.append({
                 "test_file": file_path,
-                "total_samples": len(lines),
+                "total_samples": total_lines,
                 "total_valid_samples": len(all_ppl_scores),
-                "total_average_ppl": total_avg_ppl
+                "total_average_ppl": total_avg_ppl,
+                "mask_passes": num_mask_passes,
+                "fp16": fp16 and device != 'cpu'
             })
-    
+
     # 打印最终摘要
     print("\n" + "="*50)
     print("              Fluency Score Summary (PPL)")
@@ -109,19 +212,17 @@ def evaluate_fluency(model_name, file_path, device, batch_size):
     print("-" * 50)
     print(f"  - Average Perplexity (文本流畅度↓): {total_avg_ppl:.4f}")
     print("="*50)
-    
+
     return results, total_avg_ppl
 
-# --- 4. 运行评估 ---
+# --- 5. 运行评估 ---
 if __name__ == "__main__":
     # 执行评估
     evaluation_results, total_ppl = evaluate_fluency(MODEL_NAME, INPUT_FILE, DEVICE, BATCH_SIZE)
-    
+
     # 保存详细的评估结果到文件
     if evaluation_results:
         OUTPUT_FILE = f"fluency_results_{INPUT_FILE}"
         with open(OUTPUT_FILE, 'w', encoding='utf-8') as outfile:
             json.dump(evaluation_results, outfile, ensure_ascii=False, indent=4)
         print(f"详细评估结果已保存到 {OUTPUT_FILE}")
-        
-        
\ No newline at end of file
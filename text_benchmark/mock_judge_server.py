@@ -0,0 +1,116 @@
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# --- 模拟评分服务 ---
+# 提供与 OpenAI / 智谱兼容的 POST {prefix}/chat/completions 接口，返回随机评分，用于离线压测 evaluate_glm.py：
+#   python mock_judge_server.py --port 8765 --latency 0.5 --capacity 8
+#   JUDGE_BASE_URL=http://127.0.0.1:8765/v1 python evaluate_glm.py
+# 同时在途的请求超过 capacity 时返回 429，用来验证自适应并发能否收敛到服务端容量附近。
+
+
+class MockJudgeState():
+    def __init__(self, latency, jitter, capacity, error_rate):
+        self.latency = latency
+        self.jitter = jitter
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.in_flight = 0
+        self.stats = {"requests": 0, "throttled": 0, "errors": 0, "max_in_flight": 0}
+        self.lock = threading.Lock()
+
+    def enter(self):
+        with self.lock:
+            self.stats["requests"] += 1
+            if self.capacity and self.in_flight >= self.capacity:
+                self.stats["throttled"] += 1
+                return False
+            self.in_flight += 1
+            self.stats["max_in_flight"] = max(self.stats["max_in_flight"], self.in_flight)
+            return True
+
+    def leave(self):
+        with self.lock:
+            self.in_flight -= 1
+
+
+def make_completion(model):
+    scores = {key: random.randint(1, 5) for key in
+              ("coherence_score", "informativeness_score", "relevance_score", "news_style_score")}
+    content = json.dumps({"analysis": "mock judge", **scores}, ensure_ascii=False)
+    return {
+        "id": f"mock-{random.getrandbits(32):08x}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}],
+        "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+    }
+
+
+def make_handler(state):
+    class MockJudgeHandler(BaseHTTPRequestHandler):
+        def _send(self, code, payload):
+            body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            # GET /stats 查看压测统计
+            with state.lock:
+                self._send(200, {**state.stats, "in_flight": state.in_flight})
+
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            if not self.path.endswith("/chat/completions"):
+                self._send(404, {"error": {"message": f"unknown path {self.path}"}})
+                return
+            if not state.enter():
+                self._send(429, {"error": {"message": "rate limited", "type": "rate_limit_error"}})
+                return
+            try:
+                time.sleep(max(0.0, random.gauss(state.latency, state.jitter)))
+                if random.random() < state.error_rate:
+                    with state.lock:
+                        state.stats["errors"] += 1
+                    self._send(500, {"error": {"message": "mock server error"}})
+                else:
+                    self._send(200, make_completion(request.get("model", "mock")))
+            finally:
+                state.leave()
+
+        def log_message(self, format, *args):
+            pass
+
+    return MockJudgeHandler
+
+
+def serve(host="127.0.0.1", port=8765, latency=0.5, jitter=0.1, capacity=8, error_rate=0.0):
+    state = MockJudgeState(latency, jitter, capacity, error_rate)
+    server = ThreadingHTTPServer((host, port), make_handler(state))
+    server.daemon_threads = True
+    return server, state
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="离线模拟评分服务")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.5, help="平均响应延迟（秒）")
+    parser.add_argument("--jitter", type=float, default=0.1, help="延迟标准差（秒）")
+    parser.add_argument("--capacity", type=int, default=8, help="同时在途请求上限，超过返回 429；0 表示不限")
+    parser.add_argument("--error_rate", type=float, default=0.0, help="随机返回 500 的概率")
+    args = parser.parse_args()
+
+    server, state = serve(args.host, args.port, args.latency, args.jitter, args.capacity, args.error_rate)
+    print(f"✅ 模拟评分服务已启动: http://{args.host}:{args.port}/v1 (capacity={args.capacity}, latency={args.latency}s)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(f"\n压测统计: {state.stats}")
@@ -0,0 +1,343 @@
+import os
+import json
+import time
+import queue
+import asyncio
+import hashlib
+import argparse
+import threading
+from multiprocessing import Pool
+import jieba
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+from evaluate_distinctn import (clean_and_tokenize, hash_tokens, ngram_hashes, HyperLogLog, CountMinSketch,
+                                self_bleu_style_score)
+
+try:
+    from nltk.translate.bleu_score import SmoothingFunction, sentence_bleu
+    from rouge_chinese import Rouge
+except ImportError:
+    sentence_bleu = None
+
+# --- 统一评测入口 ---
+# 一次读取、一次分词（结果缓存为 Parquet），CPU 指标在进程池中计算，模型指标（PPL）在单独的加速器队列中计算，
+# LLM 评分（GLM）在异步线程中进行，最后按 line_no 合并为一张列式结果表。
+#   python run_benchmark.py --input generated_predictions.jsonl --metrics distinct,self_bleu,bleu_rouge,ppl
+ALL_METRICS = ("distinct", "self_bleu", "bleu_rouge", "ppl", "glm")
+DEFAULT_METRICS = "distinct,self_bleu,bleu_rouge,ppl"
+CACHE_DIR = ".benchmark_cache"
+
+
+# --- 1. 解析与分词（只做一次，并缓存） ---
+def _file_fingerprint(file_path):
+    stat = os.stat(file_path)
+    payload = f"{os.path.abspath(file_path)}|{stat.st_size}|{stat.st_mtime_ns}"
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()[:16]
+
+
+def _iter_chunks(file_path, chunk_size):
+    chunk = []
+    with open(file_path, 'r', encoding='utf-8') as f:
+        for i, line in enumerate(f):
+            if not line.strip():
+                continue
+            chunk.append((i + 1, line))
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+
+def _tokenize_chunk(chunk):
+    """
+    解析一批 JSONL 行并分词：
+    - distinct_tokens：与 evaluate_distinctn.py 相同的清洗 + 分词，用于 Distinct-n / Self-BLEU
+    - predict_tokens / label_tokens：原文直接分词，与 eval_bleu_rouge.py 一致，用于 ROUGE
+    """
+    rows = []
+    for line_no, line in chunk:
+        try:
+            data = json.loads(line)
+        except json.JSONDecodeError:
+            continue
+        predict, label = data.get('predict', '') or '', data.get('label', '') or ''
+        rows.append({
+            "line_no": line_no,
+            "prompt": data.get('prompt', '') or '',
+            "predict": predict,
+            "label": label,
+            "distinct_tokens": clean_and_tokenize(predict),
+            "predict_tokens": jieba.lcut(predict),
+            "label_tokens": jieba.lcut(label),
+        })
+    return rows
+
+
+def load_parsed(file_path, pool, cache_dir=CACHE_DIR, chunk_size=512):
+    """返回解析并分词后的 DataFrame；同一文件（路径、大小、修改时间不变）第二次运行直接读缓存。"""
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_path = os.path.join(cache_dir, f"parsed-{_file_fingerprint(file_path)}.parquet")
+    if os.path.exists(cache_path):
+        print(f"✅ 使用分词缓存: {cache_path}")
+        return pd.read_parquet(cache_path)
+
+    rows = []
+    for chunk_rows in tqdm(pool.imap(_tokenize_chunk, _iter_chunks(file_path, chunk_size)), desc="解析与分词", unit="chunk"):
+        rows.extend(chunk_rows)
+    df = pd.DataFrame(rows, columns=["line_no", "prompt", "predict", "label",
+                                     "distinct_tokens", "predict_tokens", "label_tokens"])
+    tmp_path = cache_path + ".tmp"
+    df.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, cache_path)
+    return df
+
+
+# --- 2. CPU 指标（进程池） ---
+_worker_state = {}
+
+
+def _init_worker(orders, metrics, sketches=None):
+    _worker_state.update(orders=orders, metrics=metrics, sketches=sketches)
+
+
+def bleu_rouge_for_sample(predict, label, predict_tokens, label_tokens):
+    """与 LLaMA-Factory scripts/eval_bleu_rouge.py 相同的口径：字级 BLEU-4，词级 ROUGE-1/2/L（F 值 ×100）。"""
+    bleu_score = sentence_bleu([list(label)], list(predict), smoothing_function=SmoothingFunction().method3)
+    hypothesis, reference = " ".join(predict_tokens), " ".join(label_tokens)
+    if len(hypothesis.split()) == 0 or len(reference.split()) == 0:
+        result = {"rouge-1": {"f": 0.0}, "rouge-2": {"f": 0.0}, "rouge-l": {"f": 0.0}}
+    else:
+        result = Rouge().get_scores(hypothesis, reference)[0]
+    metric_result = {k: round(v["f"] * 100, 4) for k, v in result.items()}
+    metric_result["bleu-4"] = round(bleu_score * 100, 4)
+    return metric_result
+
+
+def _cpu_metrics_chunk(chunk):
+    """计算一批样本的 CPU 指标，并返回该批的 n-gram 哈希用于语料级统计。"""
+    orders, metrics, sketches = _worker_state['orders'], _worker_state['metrics'], _worker_state['sketches']
+    records, chunk_hashes = [], {n: [] for n in orders}
+    for line_no, predict, label, distinct_tokens, predict_tokens, label_tokens in chunk:
+        record = {"line_no": line_no, "token_count": len(distinct_tokens)}
+        if len(distinct_tokens):
+            token_hashes = hash_tokens(distinct_tokens)
+            if sketches is not None:
+                record["self_bleu"] = self_bleu_style_score(token_hashes, orders, sketches)
+            else:
+                for n in orders:
+                    h = ngram_hashes(token_hashes, n)
+                    record[f"distinct_{n}"] = len(np.unique(h)) / len(h) if len(h) else 0.0
+                    chunk_hashes[n].append(h)
+        if sketches is None and "bleu_rouge" in metrics:  # 与 eval_bleu_rouge.py 一致，空 label / predict 记为 0
+            record.update(bleu_rouge_for_sample(predict, label, predict_tokens, label_tokens))
+        records.append(record)
+    chunk_hashes = {n: np.concatenate(hs) if hs else np.empty(0, dtype=np.uint64) for n, hs in chunk_hashes.items()}
+    return records, chunk_hashes
+
+
+def _iter_metric_chunks(df, chunk_size):
+    columns = ["line_no", "predict", "label", "distinct_tokens", "predict_tokens", "label_tokens"]
+    for start in range(0, len(df), chunk_size):
+        yield list(df[columns].iloc[start:start + chunk_size].itertuples(index=False, name=None))
+
+
+# --- 3. 模型指标（加速器队列） ---
+def _load_ppl_scorer(args):
+    """在主线程中加载 PPL 模型；加载失败时返回 None，由调用方跳过 ppl 指标。"""
+    from evaluate_ppl import MaskedLMScorer
+    try:
+        return MaskedLMScorer(args.ppl_model, device=args.device, fp16=args.ppl_fp16)
+    except Exception as e:
+        print(f"⚠️ 无法加载 PPL 模型 {args.ppl_model}（{e}），跳过 ppl 指标，可通过 --ppl_model 指定模型。")
+        return None
+
+
+def _accelerator_worker(jobs, results, scorer, args):
+    """
+    独占加速器的线程：模型已在主线程加载，依次消费队列中的批次，与 CPU 进程池并行运行。
+    """
+    from evaluate_ppl import PPL_THRESHOLD
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        line_nos, texts = job
+        try:
+            scores = scorer.get_document_perplexity(texts, batch_size=args.batch_size, num_mask_passes=args.mask_passes)
+        except Exception as e:
+            print(f"❌ PPL 计算失败（第 {line_nos[0]}-{line_nos[-1]} 行）: {e}")
+            continue
+        for line_no, ppl_scores in zip(line_nos, scores):
+            if ppl_scores:
+                # 与 evaluate_ppl.py 一致：句子 PPL 超过阈值的样本记为缺失
+                results[line_no] = np.nan if max(ppl_scores) > PPL_THRESHOLD else float(np.mean(ppl_scores))
+
+
+def _put_job(jobs, job, accelerator):
+    """向加速器队列投递批次；线程已退出时放弃投递，避免主线程在满队列上永久阻塞。"""
+    while accelerator.is_alive():
+        try:
+            jobs.put(job, timeout=1)
+            return True
+        except queue.Full:
+            continue
+    print("❌ PPL 线程已退出，停止投递剩余批次。")
+    return False
+
+
+def _run_glm(df, output_dir, stem):
+    """在独立线程的事件循环中运行 GLM 评分，返回 {line_no: 各项评分}。"""
+    import evaluate_glm
+    from openai import AsyncOpenAI
+
+    output_file = os.path.join(output_dir, f"glm4eval_results_{stem}.jsonl")
+    error_file = os.path.join(output_dir, f"glm4eval_errors_{stem}.log")
+    items = ({"prompt": p, "predict": q, "line_num": n} for n, p, q in zip(df["line_no"], df["prompt"], df["predict"]))
+
+    async def run():
+        client = AsyncOpenAI(api_key=evaluate_glm.API_KEY, base_url=evaluate_glm.BASE_URL, max_retries=0)
+        cache = evaluate_glm.ResponseCache(evaluate_glm.CACHE_FILE)
+        runner = evaluate_glm.JudgeRunner(client, cache, output_file, error_file)
+        try:
+            await runner.run(items)
+        finally:
+            runner.close()
+            cache.close()
+            await client.close()
+
+    asyncio.run(run())
+    scores = {}
+    with open(output_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            result = json.loads(line)
+            scores[result['original_line_num']] = {f"glm_{k}": v for k, v in result.items() if k.endswith('_score')}
+    return scores
+
+
+# --- 4. 主流程 ---
+def run_benchmark(args):
+    metrics = set(args.metrics.split(','))
+    unknown = metrics - set(ALL_METRICS)
+    if unknown:
+        raise ValueError(f"未知指标: {sorted(unknown)}，可选: {ALL_METRICS}")
+    if "bleu_rouge" in metrics and sentence_bleu is None:
+        print("⚠️ 未安装 nltk / rouge_chinese，跳过 bleu_rouge 指标。")
+        metrics.discard("bleu_rouge")
+    # PPL 模型在启动任何线程之前加载，失败时直接跳过，避免加速器线程崩溃后主线程阻塞在队列上
+    scorer = _load_ppl_scorer(args) if "ppl" in metrics else None
+    if scorer is None:
+        metrics.discard("ppl")
+    orders = tuple(int(n) for n in args.orders.split(','))
+    stem = os.path.splitext(os.path.basename(args.input))[0]
+    os.makedirs(args.output_dir, exist_ok=True)
+    start_time = time.time()
+
+    with Pool(args.num_workers, initializer=_init_worker, initargs=(orders, metrics)) as pool:
+        df = load_parsed(args.input, pool, args.cache_dir, args.chunk_size)
+        print(f"共 {len(df)} 条有效样本，指标: {sorted(metrics)}")
+
+        # 模型指标：加速器线程先启动，与 CPU 进程池重叠执行
+        ppl_results, jobs, accelerator = {}, queue.Queue(maxsize=4), None
+        if scorer is not None:
+            accelerator = threading.Thread(target=_accelerator_worker, args=(jobs, ppl_results, scorer, args),
+                                           daemon=True)
+            accelerator.start()
+        glm_results, glm_thread = {}, None
+        if "glm" in metrics:
+            glm_thread = threading.Thread(target=lambda: glm_results.update(_run_glm(df, args.output_dir, stem)), daemon=True)
+            glm_thread.start()
+
+        records, hlls, total_ngrams = [], {n: HyperLogLog() for n in orders}, {n: 0 for n in orders}
+        sketches = {n: CountMinSketch() for n in orders} if "self_bleu" in metrics else None
+        cpu_results = pool.imap(_cpu_metrics_chunk, _iter_metric_chunks(df, args.chunk_size))
+        for start in tqdm(range(0, len(df), args.chunk_size), desc="计算指标", unit="chunk"):
+            if accelerator is not None:
+                # 加速器需要 prompt + predict 拼接后的文本（与 evaluate_ppl.py 一致）
+                part = df.iloc[start:start + args.chunk_size]
+                if not _put_job(jobs, (part["line_no"].tolist(), (part["prompt"] + part["predict"]).tolist()),
+                                accelerator):
+                    accelerator = None
+            chunk_records, chunk_hashes = next(cpu_results)
+            records.extend(chunk_records)
+            for n, h in chunk_hashes.items():
+                hlls[n].update(h)
+                total_ngrams[n] += len(h)
+                if sketches is not None:
+                    sketches[n].update(h)
+        if accelerator is not None:
+            _put_job(jobs, None, accelerator)
+
+    # Self-BLEU 需要完整的语料 n-gram 计数，使用缓存的分词结果再扫描一次（不再分词）
+    if sketches is not None:
+        with Pool(args.num_workers, initializer=_init_worker, initargs=(orders, metrics, sketches)) as pool:
+            self_bleu = {}
+            for chunk_records, _ in tqdm(pool.imap(_cpu_metrics_chunk, _iter_metric_chunks(df, args.chunk_size)),
+                                         desc="Self-BLEU", unit="chunk"):
+                self_bleu.update({r["line_no"]: r.get("self_bleu", np.nan) for r in chunk_records})
+        for record in records:
+            record["self_bleu"] = self_bleu.get(record["line_no"], np.nan)
+
+    if accelerator is not None:
+        accelerator.join()
+    if glm_thread is not None:
+        glm_thread.join()
+
+    # 合并为一张列式结果表
+    table = pd.DataFrame(records)
+    if "distinct" not in metrics:
+        table = table.drop(columns=[c for c in table.columns if c.startswith("distinct_")])
+    if "ppl" in metrics:
+        table["ppl"] = table["line_no"].map(ppl_results)
+    if "glm" in metrics:
+        table = table.merge(pd.DataFrame.from_dict(glm_results, orient="index").rename_axis("line_no").reset_index(),
+                            on="line_no", how="left")
+    results_path = os.path.join(args.output_dir, f"benchmark_results_{stem}.parquet")
+    table.to_parquet(results_path, index=False)
+
+    summary = {"input_file": args.input, "total_valid_samples": len(table), "metrics": sorted(metrics),
+               "averages": {c: round(float(table[c].mean()), 4) for c in table.columns
+                            if c not in ("line_no", "token_count") and table[c].notna().any()}}
+    if "distinct" in metrics:
+        summary["corpus_distinct"] = {
+            n: round(min(hlls[n].count(), total_ngrams[n]) / total_ngrams[n], 4) if total_ngrams[n] else 0.0
+            for n in orders}
+    summary["elapsed_seconds"] = round(time.time() - start_time, 2)
+    summary_path = os.path.join(args.output_dir, f"benchmark_summary_{stem}.json")
+    with open(summary_path, 'w', encoding='utf-8') as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+
+    print(f"\n✅ 结果表已保存到: {results_path}")
+    print(f"✅ 概要报告已保存到: {summary_path}")
+    print("\n" + "="*50)
+    print("           Benchmark Summary")
+    print("="*50)
+    for metric, value in summary["averages"].items():
+        print(f"  - {metric}: {value:.4f}")
+    for n, value in summary.get("corpus_distinct", {}).items():
+        print(f"  - corpus_distinct_{n}: {value:.4f}")
+    print("="*50)
+    return table, summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="一次遍历数据，计算 text_benchmark 的全部指标")
+    parser.add_argument("--input", type=str, default="generated_predictions.jsonl", help="待评估的 JSONL 文件")
+    parser.add_argument("--output_dir", type=str, default="benchmark_results")
+    parser.add_argument("--metrics", type=str, default=DEFAULT_METRICS, help=f"逗号分隔，可选: {','.join(ALL_METRICS)}")
+    parser.add_argument("--orders", type=str, default="1,2,3,4", help="Distinct-n 的 n，逗号分隔")
+    parser.add_argument("--num_workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--chunk_size", type=int, default=256)
+    parser.add_argument("--cache_dir", type=str, default=CACHE_DIR)
+    parser.add_argument("--ppl_model", type=str, default='/home/remote1/lvshuyang/Models/hfl/chinese-bert-wwm-ext')
+    parser.add_argument("--device", type=str, default=None, help="PPL 模型所在设备，缺省自动选择")
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--mask_passes", type=int, default=None, help="伪困惑度近似模式的前向次数，缺省为精确模式")
+    parser.add_argument("--ppl_fp16", action="store_true", help="GPU 上以半精度计算 PPL（更快，但与 fp32 基线不严格可比）")
+    args = parser.parse_args()
+    if args.device is None:
+        import torch
+        args.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+    run_benchmark(args)